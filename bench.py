@@ -0,0 +1,320 @@
+"""
+Benchmarks the image pipeline on synthetic photos.
+
+Each case is a generated JPEG of a given size and orientation, with or without
+EXIF metadata. Every stage of the pipeline is timed separately, along with the
+whole of `process_image`, and each case runs in a fresh process so that its
+peak memory can be measured.
+
+    MODE=test python bench.py --save baseline.json
+    MODE=test python bench.py --compare baseline.json
+
+Resized images are stored with a local storage backend, and posts are
+written, in a temporary directory.
+"""
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import makedirs
+from os.path import join
+from unittest.mock import patch
+
+import PIL
+from PIL import Image, ImageOps
+
+import server
+from postindex import PostIndex
+from storage import LocalStorage
+
+# Megapixels of each synthetic photo, and its dimensions in landscape.
+SIZES = {
+    12: (4000, 3000),
+    24: (6000, 4000),
+    48: (8000, 6000),
+}
+
+ORIENTATIONS = [ 'landscape', 'portrait' ]
+
+STAGES = [
+    'decode',
+    'exif',
+    'transpose',
+    'resize',
+    'encode',
+    'upload',
+    'create_post',
+    'process_image',
+]
+
+# Changes smaller than these are ignored when comparing with a baseline, since
+# they're within the noise of a single run.
+MIN_TIME_CHANGE = 0.005
+MIN_RSS_CHANGE = 5.0
+
+# EXIF tag IDs.
+ORIENTATION = 0x0112
+DATETIME = 0x0132
+
+
+def make_photo(megapixels, orientation, exif):
+    """
+    Generates a synthetic photo: a smooth fractal with some noise on top, which
+    compresses roughly like a real photo.
+
+    Portrait photos with EXIF are stored sideways, with an Orientation tag,
+    like most phone cameras do.
+
+    Returns
+    -------
+    The photo, encoded as JPEG bytes.
+    """
+
+    width, height = SIZES[megapixels]
+    if orientation == 'portrait' and not exif:
+        width, height = height, width
+
+    small = Image.effect_mandelbrot((800, 600), (-2, -1.5, 1, 1.5), 64)
+    base = Image.merge('RGB', [
+        small,
+        small.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+        Image.linear_gradient('L').resize(small.size),
+    ])
+    base = base.resize((width, height), Image.Resampling.BICUBIC)
+    noise = Image.effect_noise((width, height), 32).convert('RGB')
+    img = Image.blend(base, noise, 0.1)
+
+    buffer = io.BytesIO()
+    if exif:
+        img_exif = Image.Exif()
+        img_exif[DATETIME] = '2021:06:05 14:03:01'
+        img_exif[ORIENTATION] = 6 if orientation == 'portrait' else 1
+        img.save(buffer, format = 'JPEG', quality = 90, exif = img_exif)
+    else:
+        img.save(buffer, format = 'JPEG', quality = 90)
+
+    return buffer.getvalue()
+
+
+def time_stages(photo, blog_path):
+    """
+    Times each stage of the pipeline once.
+
+    Returns
+    -------
+    A dictionary mapping stage names to durations, in seconds.
+    """
+
+    times = {}
+
+    def timed(stage, f, *args):
+        start = time.perf_counter()
+        result = f(*args)
+        times[stage] = times.get(stage, 0) + time.perf_counter() - start
+        return result
+
+    img = timed('decode', lambda: server.decode_image(Image.open(io.BytesIO(photo))))
+    taken = timed('exif', server.get_img_date, img)
+    img = timed('transpose', lambda: ImageOps.exif_transpose(img).convert('RGB'))
+    resized = timed('resize', server.resize_image, img)
+    widths = [ r.size[0] for r in resized ]
+
+    buffers = [ timed('encode', server.encode_image, r) for r in resized ]
+    for width, buffer in zip(widths, buffers):
+        with buffer:
+            timed('upload', server.upload_file, '0-%d.jpg' % width, buffer)
+
+    post_object = {
+        'oid': 0,
+        'summary': 'Benchmark',
+        'taken': taken,
+        'og_image': '0-%d.jpg' % max(widths),
+        'content': server.create_img_tag(0, widths, 'Benchmark'),
+    }
+    timed('create_post', server.create_post, post_object)
+
+    post_object = { 'oid': 1, 'summary': 'Benchmark' }
+    timed('process_image', server.process_image, post_object, io.BytesIO(photo))
+
+    return times
+
+
+def run_case(photo, repeat):
+    """
+    Runs one benchmark case. This is meant to run in a fresh process.
+
+    Parameters
+    ----------
+    photo: The photo to run the pipeline on, as JPEG bytes.
+    repeat: The number of times to run the pipeline.
+
+    Returns
+    -------
+    A dictionary with the median time of each stage, in seconds, and the
+    process's peak resident memory, in megabytes.
+    """
+
+    logging.disable(logging.CRITICAL)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as blog_path:
+        makedirs(join(blog_path, '_posts'))
+        index = PostIndex(join(blog_path, 'posts.db'), join(blog_path, '_posts'))
+        with patch.multiple(
+            server,
+            storage = LocalStorage(join(blog_path, 'assets')),
+            blog_path = blog_path,
+            post_index = index,
+            DRY = None,
+        ):
+            runs = [ time_stages(photo, blog_path) for _ in range(repeat) ]
+
+    result = {
+        stage: statistics.median(run[stage] for run in runs)
+        for stage in STAGES
+    }
+
+    # `ru_maxrss` is in kilobytes on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = round(peak_rss / 1024, 1)
+    result['pipeline_rss_mb'] = round((peak_rss - baseline_rss) / 1024, 1)
+    result['source_bytes'] = len(photo)
+    return result
+
+
+def case_name(megapixels, orientation, exif):
+    return '{0}mp-{1}-{2}'.format(megapixels, orientation, 'exif' if exif else 'noexif')
+
+
+def run(sizes, repeat):
+    """
+    Runs every benchmark case for the given sizes, each in its own process.
+
+    Returns
+    -------
+    A dictionary of results, suitable for saving as JSON.
+    """
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'machine': platform.machine(),
+            'repeat': repeat,
+        },
+        'cases': {},
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for megapixels in sizes:
+        for orientation in ORIENTATIONS:
+            for exif in [ True, False ]:
+                name = case_name(megapixels, orientation, exif)
+                print('Running {0}'.format(name), file = sys.stderr)
+                # Generating a photo takes a lot more memory than processing
+                # it, so it happens in a process of its own.
+                with ProcessPoolExecutor(1, mp_context = context) as pool:
+                    photo = pool.submit(make_photo, megapixels, orientation, exif).result()
+                with ProcessPoolExecutor(1, mp_context = context) as pool:
+                    results['cases'][name] = pool.submit(run_case, photo, repeat).result()
+
+    return results
+
+
+def compare(baseline, results, threshold):
+    """
+    Compares benchmark results with a saved baseline.
+
+    Parameters
+    ----------
+    baseline: A dictionary of results from an earlier run.
+    results: A dictionary of results from this run.
+    threshold: How much slower (or larger), as a fraction, a measurement can
+    get before it's counted as a regression. Tiny absolute changes are never
+    counted.
+
+    Returns
+    -------
+    A list of (case, measurement, baseline value, new value) tuples, one for
+    each regression.
+    """
+
+    regressions = []
+    for name, case in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        for key, value in case.items():
+            if key not in STAGES + [ 'pipeline_rss_mb' ]:
+                continue
+            old = baseline['cases'][name].get(key)
+            if old is None:
+                continue
+            floor = MIN_RSS_CHANGE if key == 'pipeline_rss_mb' else MIN_TIME_CHANGE
+            if value > old * (1 + threshold) and value - old > floor:
+                regressions.append((name, key, old, value))
+    return regressions
+
+
+def print_results(results):
+    columns = STAGES + [ 'pipeline_rss_mb' ]
+    print('case'.ljust(24) + ''.join(c.rjust(16) for c in columns))
+    for name, case in results['cases'].items():
+        values = [ '%.4f' % case[c] if c in STAGES else '%.1f' % case[c] for c in columns ]
+        print(name.ljust(24) + ''.join(v.rjust(16) for v in values))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--sizes',
+        default = ','.join(str(s) for s in SIZES),
+        help = 'comma-separated megapixel sizes to run (default: %(default)s)',
+    )
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs per case (default: %(default)s)')
+    parser.add_argument('--save', metavar = 'PATH', help = 'save the results as JSON')
+    parser.add_argument('--compare', metavar = 'PATH', help = 'compare with a saved baseline')
+    parser.add_argument(
+        '--threshold',
+        type = float,
+        default = 0.15,
+        help = 'slowdown, as a fraction, that counts as a regression (default: %(default)s)',
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [ int(s) for s in args.sizes.split(',') ]
+    for s in sizes:
+        if s not in SIZES:
+            parser.error('unknown size {0}; choose from {1}'.format(s, ', '.join(str(s) for s in SIZES)))
+
+    results = run(sizes, args.repeat)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for name, key, old, new in regressions:
+            print('REGRESSION {0} {1}: {2:.4f} -> {3:.4f}'.format(name, key, old, new))
+        if regressions:
+            return 1
+        print('No regressions')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
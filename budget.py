@@ -0,0 +1,39 @@
+import threading
+from contextlib import contextmanager
+
+
+class MemoryBudget:
+    """
+    Limits how much memory concurrent tasks can use between them. Each task
+    reserves an estimate of what it needs before it starts, and waits while
+    the reservations already held would take it over the limit.
+
+    A task that needs more than the whole budget isn't refused: it waits until
+    nothing else is reserved and then runs alone.
+
+    Parameters
+    ----------
+    limit: The number of bytes that can be reserved at once.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.reserved = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        """
+        Reserves `size` bytes for the duration of a block.
+        """
+
+        with self._cond:
+            while self.reserved and self.reserved + size > self.limit:
+                self._cond.wait()
+            self.reserved += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved -= size
+                self._cond.notify_all()
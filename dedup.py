@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deliveries (
+    key TEXT PRIMARY KEY,
+    oid INTEGER,
+    variants TEXT,
+    used REAL NOT NULL
+);
+'''
+
+def content_key(subject, digests):
+    """
+    Computes a key that identifies an upload by its content.
+
+    Parameters
+    ----------
+    subject: The upload's subject.
+    digests: A list of SHA-256 hex digests, one for each attachment's content,
+    in order.
+
+    Returns
+    -------
+    A hex digest of the subject and the attachments' digests.
+    """
+
+    digest = hashlib.sha256(subject.encode('utf-8'))
+    for d in digests:
+        # Separate the parts so that moving bytes between them changes the key.
+        digest.update(b'\0' + d.encode('ascii'))
+    return digest.hexdigest()
+
+
+class DedupCache:
+    """
+    A bounded, persistent record of the uploads that have been accepted,
+    stored in a SQLite database, so repeat deliveries of the same email can be
+    recognized and ignored.
+
+    An upload's entry is created (without an OID) as soon as it's accepted, so
+    a repeat that arrives while the original is still being processed is
+    recognized too. Once the original is published, the entry records its OID
+    and the files it uploaded. If it fails, the entry is removed, so that a
+    later delivery is processed normally.
+
+    Parameters
+    ----------
+    path: The path of the SQLite database file.
+    max_entries: The number of published uploads to remember. Beyond this, the
+    least recently seen are forgotten.
+    """
+
+    def __init__(self, path, max_entries = 1000):
+        self.path = path
+        self.max_entries = max_entries
+
+    @contextmanager
+    def _transaction(self):
+        with closing(sqlite3.connect(self.path, timeout = 30, isolation_level = None)) as db:
+            db.executescript(SCHEMA)
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def claim(self, key):
+        """
+        Records that an upload has been accepted, unless it already has been.
+
+        Returns
+        -------
+        None if the upload is new. Otherwise, a dictionary with the `oid` and
+        `variants` of the original upload; both are None if the original is
+        still being processed.
+        """
+
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT oid, variants FROM deliveries WHERE key = ?', (key,),
+            ).fetchone()
+
+            if row is not None:
+                db.execute('UPDATE deliveries SET used = ? WHERE key = ?', (time.time(), key))
+                oid, variants = row
+                return {
+                    'oid': oid,
+                    'variants': None if variants is None else json.loads(variants),
+                }
+
+            db.execute(
+                'INSERT INTO deliveries (key, used) VALUES (?, ?)', (key, time.time()),
+            )
+
+    def finish(self, key, oid, variants):
+        """
+        Records the result of publishing an upload.
+
+        Parameters
+        ----------
+        key: The upload's key.
+        oid: The OID of the post that was made.
+        variants: A list of the names of the files that were uploaded.
+        """
+
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?)',
+                (key, oid, json.dumps(variants), time.time()),
+            )
+
+            # Forget the least recently seen published uploads. Uploads that
+            # are still being processed are never evicted.
+            db.execute('''
+                DELETE FROM deliveries WHERE key IN (
+                    SELECT key FROM deliveries WHERE oid IS NOT NULL
+                    ORDER BY used DESC, rowid DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+
+    def release(self, key):
+        """
+        Forgets an upload that couldn't be published, so that it can be
+        retried.
+        """
+
+        with self._transaction() as db:
+            db.execute('DELETE FROM deliveries WHERE key = ?', (key,))
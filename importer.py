@@ -0,0 +1,245 @@
+"""
+Imports a directory or archive of photos as image posts, one post per photo.
+
+    python importer.py ~/Pictures/old-blog
+    python importer.py old-blog.zip --workers 4
+
+Photos are numbered in the order they were taken (going by their EXIF dates;
+photos without one come last, by file name), then decoded, resized, encoded
+and uploaded by a pool of processes, one per core. The posts are written as
+the photos finish, and published in a single commit and push at the end.
+
+Progress is saved to a checkpoint file as it goes (next to the source, by
+default), so an interrupted import picks up where it left off when it's run
+again, without numbering or uploading any photo twice.
+"""
+
+import argparse
+import json
+import logging
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from os import cpu_count, replace, walk
+from os.path import abspath, isdir, join, relpath
+
+import server
+from probe import UnsupportedImage, probe
+
+
+@contextmanager
+def source_dir(source):
+    """
+    Yields the directory to import photos from: `source` itself, or a
+    temporary directory that an archive has been unpacked into.
+    """
+
+    if isdir(source):
+        yield source
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.unpack_archive(source, tmp)
+        yield tmp
+
+
+def list_photos(root):
+    """
+    Returns the paths of the files in a directory and its subdirectories,
+    relative to it, skipping hidden files.
+    """
+
+    photos = []
+    for dirpath, dirnames, filenames in walk(root):
+        dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+        photos.extend(
+            relpath(join(dirpath, f), root).replace('\\', '/')
+            for f in filenames if not f.startswith('.')
+        )
+    return sorted(photos)
+
+
+def capture_time(path):
+    """
+    Reads the date and time a photo was taken from its EXIF metadata, from
+    its header alone (see `probe`).
+
+    Returns
+    -------
+    A 'YYYY:MM:DD HH:MM:SS' string (which sorts chronologically), an empty
+    string if the photo has no date, or None if it isn't an image.
+    """
+
+    try:
+        info = probe(path)
+    except (UnsupportedImage, OSError):
+        return None
+
+    return info.get('datetime_original') or info.get('datetime') or ''
+
+
+def process_photo(path, oid):
+    """
+    Runs a photo through the image pipeline in a worker process.
+
+    Returns
+    -------
+    The post object for the photo, ready for `server.create_post`.
+    """
+
+    post_object = { 'oid': oid, 'summary': '' }
+    with open(path, 'rb') as f:
+        server.process_image(post_object, f)
+    return post_object
+
+
+class Checkpoint:
+    """
+    The progress of an import, saved as JSON. Each photo is recorded with the
+    OID it was given, then the path of its post once it's been written, and
+    whether that post has been committed.
+
+    Parameters
+    ----------
+    path: The path of the checkpoint file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.photos = json.load(f)['photos']
+        except FileNotFoundError:
+            self.photos = {}
+
+    def save(self):
+        # A dry run doesn't write posts, so it mustn't record them as written.
+        if server.DRY:
+            return
+
+        # Write a new file and rename it over the old one, so that an
+        # interruption never leaves a half-written checkpoint.
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({ 'photos': self.photos }, f, indent = 2)
+        replace(self.path + '.tmp', self.path)
+
+
+def allocate_oids(count):
+    # In a dry run, OIDs aren't used up, so number the photos from the next one.
+    if server.DRY:
+        start = server.post_index.peek()
+        return list(range(start, start + count))
+    return [ server.post_index.allocate() for _ in range(count) ]
+
+
+def import_photos(source, checkpoint, workers = None):
+    """
+    Imports every photo in a directory or archive that hasn't been imported
+    already, and publishes the new posts in one commit.
+
+    Parameters
+    ----------
+    source: The path of a directory, or an archive that `shutil` can unpack.
+    checkpoint: A `Checkpoint` to record progress in.
+    workers: The number of worker processes. Defaults to one per core.
+
+    Returns
+    -------
+    A list of (photo, error) pairs for the photos that failed.
+    """
+
+    failures = []
+    workers = workers or cpu_count()
+
+    if not server.DRY:
+        server.sync.fetch()
+        server.sync.update()
+
+    with source_dir(source) as root, ProcessPoolExecutor(workers) as pool:
+        names = [ n for n in list_photos(root) if n not in checkpoint.photos ]
+
+        # Number new photos in the order they were taken.
+        times = pool.map(capture_time, [ join(root, n) for n in names ], chunksize = 16)
+        found = []
+        for name, taken in zip(names, times):
+            if taken is None:
+                logging.warning('Skipping {0}: not an image'.format(name))
+            else:
+                found.append((taken or '~', name))
+        found.sort()
+
+        for (_, name), oid in zip(found, allocate_oids(len(found))):
+            checkpoint.photos[name] = { 'oid': oid, 'post': None, 'committed': False }
+        checkpoint.save()
+
+        pending = sorted(
+            (photo['oid'], name) for name, photo in checkpoint.photos.items()
+            if photo['post'] is None
+        )
+        logging.info('Importing {0} photos with {1} workers'.format(len(pending), workers))
+
+        futures = {
+            pool.submit(process_photo, join(root, name), oid): name
+            for oid, name in pending
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            if future.exception() is not None:
+                logging.error('Failed to import {0}: {1}'.format(name, future.exception()))
+                failures.append((name, future.exception()))
+                continue
+
+            with server.sync.lock:
+                checkpoint.photos[name]['post'] = server.create_post(future.result())
+            checkpoint.save()
+
+    posts = sorted(
+        (photo['oid'], photo['post']) for photo in checkpoint.photos.values()
+        if photo['post'] is not None and not photo['committed']
+    )
+    if posts:
+        message = 'Import posts {0} to {1}'.format(posts[0][0], posts[-1][0])
+        errors = server.update_site(posts, message)
+        for name, photo in checkpoint.photos.items():
+            if (photo['oid'], photo['post']) in errors:
+                failures.append((name, errors[(photo['oid'], photo['post'])]))
+            elif photo['post'] is not None:
+                photo['committed'] = True
+        checkpoint.save()
+
+    return failures
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument('source', help = 'directory or archive of photos')
+    parser.add_argument(
+        '--workers',
+        type = int,
+        default = cpu_count(),
+        help = 'worker processes (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        metavar = 'PATH',
+        help = 'file to save progress in (default: SOURCE.import.json)',
+    )
+    args = parser.parse_args(argv)
+
+    source = abspath(args.source).rstrip('/')
+    checkpoint = Checkpoint(args.checkpoint or source + '.import.json')
+
+    failures = import_photos(source, checkpoint, args.workers)
+
+    imported = sum(1 for photo in checkpoint.photos.values() if photo['committed'])
+    print('Imported {0} photos, {1} failed'.format(imported, len(failures)))
+    for name, error in failures:
+        print('Failed to import {0}: {1}'.format(name, error))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+from email.message import Message
+
+CHUNK_SIZE = 64 * 1024
+
+# The most bytes of headers a single part may have.
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class RequestTooLarge(Exception):
+    """
+    Raised when a request body, or a part of it, is larger than allowed.
+    """
+
+
+class MultipartError(ValueError):
+    """
+    Raised when a request body isn't valid `multipart/form-data`.
+    """
+
+
+def parse_content_type(content_type):
+    """
+    Gets the boundary of a `multipart/form-data` request.
+
+    Parameters
+    ----------
+    content_type: The value of the request's Content-Type header.
+
+    Returns
+    -------
+    The boundary, as bytes.
+    """
+
+    header = Message()
+    header['content-type'] = content_type or ''
+    boundary = header.get_param('boundary')
+    if header.get_content_type() != 'multipart/form-data' or not boundary:
+        raise MultipartError('Not a multipart/form-data request')
+    return boundary.encode('latin-1')
+
+
+class Part:
+    """
+    One part of a `multipart/form-data` body. Iterating over it yields the
+    part's content in chunks, as it's read from the request.
+    """
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+
+        disposition = Message()
+        disposition['content-disposition'] = headers.get('content-disposition', '')
+        self.name = disposition.get_param('name', header = 'content-disposition')
+        self.filename = disposition.get_param('filename', header = 'content-disposition')
+
+    def __iter__(self):
+        return self._reader._read_body()
+
+    def read(self, limit):
+        """
+        Reads the whole part into memory.
+
+        Parameters
+        ----------
+        limit: The most bytes to read. Raises `RequestTooLarge` beyond this.
+        """
+
+        data = bytearray()
+        for chunk in self:
+            data += chunk
+            if len(data) > limit:
+                raise RequestTooLarge('Field {0} is too large'.format(self.name))
+        return bytes(data)
+
+
+class MultipartReader:
+    """
+    Reads a `multipart/form-data` body from a stream, a fixed-size chunk at a
+    time, so the body never has to be held in memory (or on disk) as a whole.
+
+    Iterating over the reader yields each `Part` in turn. A part's content must
+    be read before moving on to the next part; whatever is left unread is
+    skipped.
+
+    Parameters
+    ----------
+    stream: A readable file object, like a WSGI request's `wsgi.input`.
+    boundary: The multipart boundary, as bytes.
+    length: The number of bytes to read from the stream, usually the request's
+    Content-Length. Nothing beyond this is read.
+    chunk_size: The number of bytes to read at a time.
+    """
+
+    def __init__(self, stream, boundary, length, chunk_size = CHUNK_SIZE):
+        self._stream = stream
+        self._remaining = length
+        self._chunk_size = chunk_size
+        self._delimiter = b'\r\n--' + boundary
+        self._buffer = bytearray()
+        self._in_body = False
+
+    def _fill(self):
+        if self._remaining <= 0:
+            raise MultipartError('Unexpected end of multipart body')
+        data = self._stream.read(min(self._chunk_size, self._remaining))
+        if not data:
+            raise MultipartError('Unexpected end of multipart body')
+        self._remaining -= len(data)
+        self._buffer += data
+
+    def _read_until(self, separator, limit):
+        while True:
+            index = self._buffer.find(separator)
+            if index >= 0:
+                data = bytes(self._buffer[:index])
+                del self._buffer[:index + len(separator)]
+                return data
+            if len(self._buffer) > limit:
+                raise MultipartError('Multipart headers are too large')
+            self._fill()
+
+    def _read_body(self):
+        if not self._in_body:
+            return
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                chunk = bytes(self._buffer[:index])
+                del self._buffer[:index + len(self._delimiter)]
+                self._in_body = False
+                if chunk:
+                    yield chunk
+                return
+
+            # Hold back enough bytes that a delimiter split across two reads is
+            # still found.
+            keep = len(self._delimiter) - 1
+            if len(self._buffer) > keep:
+                chunk = bytes(self._buffer[:-keep])
+                del self._buffer[:-keep]
+                yield chunk
+            self._fill()
+
+    def __iter__(self):
+        # Skip the preamble. The first boundary isn't preceded by a newline.
+        self._buffer[:0] = b'\r\n'
+        self._read_until(self._delimiter, MAX_HEADER_SIZE + len(self._delimiter))
+
+        while True:
+            # After each boundary comes either `--`, which ends the body, or a
+            # newline and the next part's headers.
+            while len(self._buffer) < 2:
+                self._fill()
+            if self._buffer[:2] == b'--':
+                return
+            self._read_until(b'\r\n', MAX_HEADER_SIZE)
+
+            headers = {}
+            header_size = 0
+            while True:
+                line = self._read_until(b'\r\n', MAX_HEADER_SIZE)
+                header_size += len(line)
+                if not line:
+                    break
+                if header_size > MAX_HEADER_SIZE:
+                    raise MultipartError('Multipart headers are too large')
+                name, sep, value = line.decode('utf-8', 'replace').partition(':')
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+
+            self._in_body = True
+            yield Part(self, headers)
+
+            # Skip whatever the caller didn't read.
+            for _ in self._read_body():
+                pass
@@ -0,0 +1,337 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from os import listdir, makedirs, remove, rename
+from os.path import join
+from shutil import copyfileobj, rmtree
+
+INCOMING = 'incoming'
+PENDING = 'pending'
+ACTIVE = 'active'
+FAILED = 'failed'
+
+JOB_FILE = 'job.json'
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted to a queue that is already at capacity.
+    """
+
+
+class Spool:
+    """
+    A job whose files are being written to the queue's `incoming` directory.
+
+    Parameters
+    ----------
+    id: The job's ID.
+    path: The directory the job's files are written to.
+    """
+
+    def __init__(self, id, path):
+        self.id = id
+        self.path = path
+        self.files = []
+
+    def open(self, name):
+        """
+        Opens a new file in the job's directory for writing.
+        """
+
+        self.files.append(name)
+        return open(join(self.path, name), 'wb')
+
+    def discard(self, name):
+        """
+        Deletes a file that was written to the job's directory, leaving it out
+        of the job.
+        """
+
+        self.files.remove(name)
+        remove(join(self.path, name))
+
+
+class JobQueue:
+    """
+    A persistent, on-disk queue of upload jobs, drained by a pool of
+    background worker threads.
+
+    Each job is a directory holding a `job.json` file and the files that were
+    spooled with it. A job moves between the `incoming`, `pending`, `active`
+    and `failed` subdirectories of the queue's path using atomic renames, so
+    jobs survive restarts and a job is only ever claimed by one worker.
+
+    Parameters
+    ----------
+    path: The directory in which jobs are spooled.
+    handler: A function that is called with each job dictionary. If it raises,
+    the job is moved to the `failed` directory. It may also return a `Future`,
+    in which case the job stays active until the future resolves, and the
+    worker moves on to the next job in the meantime.
+    workers: The number of worker threads that drain the queue.
+    max_depth: The maximum number of pending and active jobs. Submitting a job
+    beyond this raises `QueueFull`.
+    poll_interval: How often (in seconds) idle workers check for new jobs.
+    """
+
+    def __init__(self, path, handler, workers = 1, max_depth = 100, poll_interval = 1.0):
+        self.path = path
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._ready = False
+
+    def _dir(self, state, job_id = ''):
+        return join(self.path, state, job_id)
+
+    def _setup(self):
+        if self._ready:
+            return
+        for state in (INCOMING, PENDING, ACTIVE, FAILED):
+            makedirs(self._dir(state), exist_ok = True)
+        self._ready = True
+
+    def depth(self):
+        """
+        Returns a dictionary with the number of jobs in each state.
+        """
+
+        self._setup()
+        return {
+            state: len(listdir(self._dir(state)))
+            for state in (PENDING, ACTIVE, FAILED)
+        }
+
+    def _check_depth(self):
+        depth = self.depth()
+        if depth[PENDING] + depth[ACTIVE] >= self.max_depth:
+            raise QueueFull('Upload queue is full ({0} jobs)'.format(self.max_depth))
+
+    def spool(self):
+        """
+        Starts a new job, whose files can be written directly into the queue.
+        The job isn't visible to the workers until it's passed to `submit`.
+
+        Returns
+        -------
+        A `Spool` for the new job.
+        """
+
+        self._setup()
+        self._check_depth()
+
+        job_id = '{0}-{1}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        spool = Spool(job_id, self._dir(INCOMING, job_id))
+        makedirs(spool.path)
+        return spool
+
+    def submit(self, spool, data, files = None):
+        """
+        Makes a spooled job available to the workers.
+
+        Parameters
+        ----------
+        spool: A `Spool` from `spool`.
+        data: A JSON-serializable dictionary of job data.
+        files: The names of the job's files, in order. Defaults to all of the
+        spooled files, in the order they were written.
+
+        Returns
+        -------
+        The ID of the new job.
+        """
+
+        with self._lock:
+            self._check_depth()
+
+            with open(join(spool.path, JOB_FILE), 'w') as out:
+                json.dump(dict(data, files = spool.files if files is None else files), out)
+
+            rename(spool.path, self._dir(PENDING, spool.id))
+
+        logging.info('Queued job {0}'.format(spool.id))
+
+        with self._wakeup:
+            self._wakeup.notify()
+
+        return spool.id
+
+    def discard(self, spool):
+        """
+        Throws away a spooled job that won't be submitted.
+        """
+
+        rmtree(spool.path, ignore_errors = True)
+
+    def enqueue(self, data, files):
+        """
+        Spools a job to disk and makes it available to the workers.
+
+        Parameters
+        ----------
+        data: A JSON-serializable dictionary of job data.
+        files: A dictionary mapping file names to readable file objects. Each
+        one is copied into the job's directory.
+
+        Returns
+        -------
+        The ID of the new job.
+        """
+
+        spool = self.spool()
+        try:
+            for name, f in files.items():
+                with spool.open(name) as out:
+                    copyfileobj(f, out)
+            return self.submit(spool, data)
+        except Exception:
+            self.discard(spool)
+            raise
+
+    def recover(self):
+        """
+        Returns jobs that were active when the process last stopped to the
+        pending queue, and removes half-written incoming jobs.
+        """
+
+        self._setup()
+
+        for job_id in listdir(self._dir(ACTIVE)):
+            logging.info('Requeueing interrupted job {0}'.format(job_id))
+            rename(self._dir(ACTIVE, job_id), self._dir(PENDING, job_id))
+
+        for job_id in listdir(self._dir(INCOMING)):
+            rmtree(self._dir(INCOMING, job_id), ignore_errors = True)
+
+    def claim(self):
+        """
+        Claims the oldest pending job.
+
+        Returns
+        -------
+        A job dictionary, or None if there are no pending jobs. The dictionary
+        includes the job's `id` and the `path` of its directory, along with the
+        data it was enqueued with.
+        """
+
+        for job_id in sorted(listdir(self._dir(PENDING))):
+            active = self._dir(ACTIVE, job_id)
+            try:
+                rename(self._dir(PENDING, job_id), active)
+            except FileNotFoundError:
+                # Another worker claimed it first.
+                continue
+
+            with open(join(active, JOB_FILE)) as f:
+                job = json.load(f)
+
+            job['id'] = job_id
+            job['path'] = active
+            return job
+
+    def complete(self, job):
+        """
+        Removes a finished job and its files.
+        """
+
+        logging.info('Finished job {0}'.format(job['id']))
+        rmtree(self._dir(ACTIVE, job['id']), ignore_errors = True)
+
+    def fail(self, job):
+        """
+        Moves a job that could not be processed to the `failed` directory, so
+        it can be inspected or requeued by hand.
+        """
+
+        logging.info('Job {0} failed'.format(job['id']))
+        rename(self._dir(ACTIVE, job['id']), self._dir(FAILED, job['id']))
+
+    def run_once(self):
+        """
+        Claims and handles a single job.
+
+        Returns
+        -------
+        True if a job was handled, or False if the queue was empty.
+        """
+
+        job = self.claim()
+        if job is None:
+            return False
+
+        try:
+            result = self.handler(job)
+        except Exception as e:
+            logging.exception(e)
+            self.fail(job)
+            return True
+
+        if isinstance(result, Future):
+            result.add_done_callback(lambda f: self._finish(job, f))
+        else:
+            self.complete(job)
+
+        return True
+
+    def _finish(self, job, future):
+        if future.exception() is not None:
+            logging.error('Job {0} failed: {1}'.format(job['id'], future.exception()))
+            self.fail(job)
+        else:
+            self.complete(job)
+
+    def _work(self):
+        while not self._stopping:
+            if self.run_once():
+                continue
+            with self._wakeup:
+                self._wakeup.wait(self.poll_interval)
+
+    def start(self, recover = True):
+        """
+        Recovers interrupted jobs and starts the worker threads.
+
+        Parameters
+        ----------
+        recover: Whether to recover interrupted jobs first. When several
+        processes share a queue, only one of them should, before any of them
+        start, or it would requeue jobs the others are working on.
+        """
+
+        if recover:
+            self.recover()
+        else:
+            self._setup()
+        self._stopping = False
+
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target = self._work,
+                name = 'upload-worker-{0}'.format(i),
+                daemon = True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Asks the worker threads to stop after their current job and waits for
+        them to exit.
+        """
+
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,209 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# The default histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    The base class of metrics. A metric has one value (or set of values) for
+    each combination of its labels' values.
+
+    Parameters
+    ----------
+    name: The metric's name.
+    help: A description of the metric.
+    labelnames: The names of the metric's labels.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{0} takes labels {1}'.format(self.name, ', '.join(self.labelnames)))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields a (name, labels, value) tuple for each of the metric's samples.
+        """
+
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, key, value
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help),
+            '# TYPE {0} {1}'.format(self.name, self.type),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A count that only goes up.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down.
+    """
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Increments the gauge for the duration of a block.
+        """
+
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations (usually durations) in cumulative buckets.
+
+    Parameters
+    ----------
+    buckets: The upper bounds of the buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames = (), buckets = BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([ 0 ] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of a block, in seconds.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = { k: (list(counts), total) for k, (counts, total) in self._values.items() }
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', format_value(float(bound))),), cumulative
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, cumulative
+
+
+class Registry:
+    """
+    A collection of metrics that can be rendered in the Prometheus text
+    format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def on_collect(self, f):
+        """
+        Registers a function that's called before the metrics are rendered,
+        to update values that are only worth computing when asked for.
+        """
+
+        self._collectors.append(f)
+        return f
+
+    def render(self):
+        """
+        Returns all of the metrics in the Prometheus text format.
+        """
+
+        for f in self._collectors:
+            f()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
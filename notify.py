@@ -1,8 +1,19 @@
+import hashlib
+import itertools
 import json
-from os import environ, listdir, path
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import environ, path
 from configparser import ConfigParser
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from postindex import PostIndex
 
 DRY = environ.get('DRY')
 
@@ -16,12 +27,70 @@ if not config.has_section(MODE):
 
 blog_path = config.get(MODE, 'blog-path', fallback=path.join(UPLOADER_DIR, 'blog'))
 
+post_index = PostIndex(
+    config.get(MODE, 'index-path', fallback=path.join(UPLOADER_DIR, 'posts.db')),
+    path.join(blog_path, '_posts'),
+)
+
+# Responses with these statuses are worth retrying.
+RETRY_STATUSES = { 429, 500, 502, 503, 504 }
+
+class RateLimiter:
+
+    # Spaces out calls to `wait` so that no more than `rate` of them return
+    # each second, across all threads.
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+def post_with_retry(session, url, limiter = None, **kwargs):
+
+    # Retries rate-limited requests, server errors, connection failures and
+    # timeouts with exponential backoff, honoring Retry-After when SendGrid
+    # sends it.
+
+    attempts = config.getint(MODE, 'notify-attempts', fallback=5)
+    backoff = config.getfloat(MODE, 'notify-backoff', fallback=1.0)
+    kwargs.setdefault('timeout', config.getfloat(MODE, 'notify-timeout', fallback=10.0))
+
+    for attempt in range(attempts):
+        if limiter is not None:
+            limiter.wait()
+
+        last_attempt = attempt == attempts - 1
+        try:
+            response = session.post(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if last_attempt:
+                raise
+            retry_after = None
+        else:
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                break
+            retry_after = response.headers.get('Retry-After')
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = backoff * 2 ** attempt * (1 + random.random())
+        time.sleep(delay)
+
+    response.raise_for_status()
+    return response
+
 def compute_new_post_count():
 
-    all_posts = listdir(path.join(blog_path, '_posts'))
-    all_posts = [ int(p.split('.')[0].split('-')[-1]) for p in all_posts ]
-    all_posts = sorted(all_posts)
-    latest = all_posts[-1]
+    latest = post_index.latest()
 
     with open(path.join(UPLOADER_DIR, 'latest.txt'), 'r+') as f:
         old_latest = int(f.read().strip())
@@ -32,40 +101,66 @@ def compute_new_post_count():
             f.write(str(latest) + '\n')
             f.truncate()
 
-    return latest - old_latest
+    # Count the posts rather than subtracting OIDs, which can have gaps.
+    return post_index.count_after(old_latest)
 
-def send_update(recipient, new_count):
+def render(template, new_count):
 
     if new_count == 1:
         has, post, it = ('has', 'post', 'it')
     else:
         has, post, it = ('have', 'posts', 'them')
 
-    address = recipient['address']
-    text_content = recipient['text'].format(
-        n = new_count,
-        has = has,
-        post = post,
-        it = it,
-    )
-    html_content = recipient['html'].format(
+    return template.format(
         n = new_count,
         has = has,
         post = post,
         it = it,
     )
 
-    data = {
-        'personalizations': [
+def build_personalization(recipient, config_bcc = True):
+
+    address = recipient['address']
+    personalization = {
+        'to': [
             {
-                'to': [
-                    {
-                        'email': address,
-                    },
-                ],
-                'subject': 'New photos on {}'.format(config.get(MODE, 'domain')),
-            }
+                'email': address,
+            },
         ],
+        'subject': 'New photos on {}'.format(config.get(MODE, 'domain')),
+    }
+
+    bcc_email = None
+    if 'bcc' in recipient:
+        bcc_email = recipient['bcc']
+    elif config_bcc and 'notify-bcc' in config[MODE]:
+        bcc_email = config.get(MODE, 'notify-bcc')
+
+    # SendGrid rejects personalizations that list an address twice.
+    if bcc_email and bcc_email.lower() != address.lower():
+        personalization['bcc'] = [
+            {
+                'email': bcc_email,
+            },
+        ]
+
+    return personalization
+
+def send_batch(recipients, new_count, session = requests, limiter = None, config_bcc = True):
+
+    # Sends one request with a personalization for each of the recipients, who
+    # must all share the same templates. The `notify-bcc` address is only
+    # copied on the first personalization that has no bcc of its own (and only
+    # if `config_bcc` is set), so it gets one copy of each distinct email.
+
+    personalizations = []
+    for recipient in recipients:
+        personalizations.append(build_personalization(recipient, config_bcc))
+        if 'bcc' in personalizations[-1] and 'bcc' not in recipient:
+            config_bcc = False
+
+    data = {
+        'personalizations': personalizations,
         'from': {
             'email': config.get(MODE, 'notify-from'),
             'name': config.get(MODE, 'notify-name'),
@@ -76,50 +171,192 @@ def send_update(recipient, new_count):
         'content': [
             {
                 'type': 'text/plain',
-                'value': text_content,
+                'value': render(recipients[0]['text'], new_count),
             },
             {
                 'type': 'text/html',
-                'value': html_content,
+                'value': render(recipients[0]['html'], new_count),
             },
         ],
     }
 
-    bcc_email = None
-    if 'bcc' in recipient:
-        bcc_email = recipient['bcc']
-    elif 'notify-bcc' in config[MODE]:
-        bcc_email = config.get(MODE, 'notify-bcc')
-
-    if bcc_email:
-        data['personalizations'][0]['bcc'] = [
-            {
-                'email': bcc_email,
-            },
-        ]
-
-    print('Sending update to %s' % address)
+    if len(recipients) == 1:
+        print('Sending update to %s' % recipients[0]['address'])
+    else:
+        print('Sending update to %d recipients' % len(recipients))
 
     if not DRY:
-        response = requests.post(
+        post_with_retry(
+            session,
             config.get(MODE, 'notify-url'),
+            limiter = limiter,
             headers = {
                 'Content-Type': 'application/json',
                 'Authorization': 'Bearer {}'.format(config.get(MODE, 'sendgrid-key'))
             },
             json = data,
         )
-        response.raise_for_status()
+
+def send_update(recipient, new_count, session = requests, limiter = None):
+    send_batch([ recipient ], new_count, session, limiter)
+
+# SendGrid accepts at most this many recipients (to, cc and bcc, across every
+# personalization) in one request.
+MAX_RECIPIENTS = 1000
+
+def read_recipients(file_path, chunk_size = 64 * 1024):
+
+    # Yields the recipients listed in a file one at a time, without reading
+    # the whole file into memory. A `.jsonl` file has one recipient object per
+    # line. Otherwise, the file is parsed incrementally as JSON of the form
+    # {"recipients": [...]}.
+
+    with open(file_path) as f:
+        if file_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer = ''
+        eof = False
+
+        def fill():
+            nonlocal buffer, eof
+            data = f.read(chunk_size)
+            eof = not data
+            buffer += data
+
+        # Find the start of the recipients list.
+        while True:
+            match = re.search(r'"recipients"\s*:\s*\[', buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            if eof:
+                raise ValueError('No recipients list in %s' % file_path)
+            # Keep the tail, in case the key is split across reads.
+            buffer = buffer[-64:]
+            fill()
+
+        while True:
+            index = len(buffer) - len(buffer.lstrip(' \t\r\n,'))
+            buffer = buffer[index:]
+            if not buffer:
+                if eof:
+                    raise ValueError('Unterminated recipients list in %s' % file_path)
+                fill()
+                continue
+            if buffer[0] == ']':
+                return
+            try:
+                recipient, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            buffer = buffer[end:]
+            yield recipient
+
+def batch_recipients(recipients, seen = None):
+
+    # Groups recipients who share the same templates, and so get the same email,
+    # into batches that fit in one request. Yields (batch, first) pairs, where
+    # `first` is True for the first batch of each group. `seen` is a set of the
+    # groups that have been batched before, which is updated, so that groups
+    # spread across several calls are only marked first once.
+
+    seen = set() if seen is None else seen
+    groups = {}
+    for recipient in recipients:
+        groups.setdefault((recipient['text'], recipient['html']), []).append(recipient)
+
+    for (text, html), group in groups.items():
+        key = hashlib.sha256((text + '\0' + html).encode('utf-8')).digest()
+        first = key not in seen
+        seen.add(key)
+
+        batch, count = [], 0
+        for recipient in group:
+            size = 2 if 'bcc' in recipient else 1
+            # Leave room for the `notify-bcc` address.
+            if batch and count + size > MAX_RECIPIENTS - 1:
+                yield batch, first
+                batch, count, first = [], 0, False
+            batch.append(recipient)
+            count += size
+        yield batch, first
+
+def send_updates(recipients, new_count):
+
+    # Sends updates to every recipient over a pool of keep-alive connections,
+    # a few requests at a time, with one request per batch of recipients that
+    # get the same email. A failure doesn't stop the others from being sent.
+    # Recipients can be any iterable; they're read a chunk at a time, and only
+    # a few batches are in flight at once, so memory use stays flat however
+    # many there are. Returns the number of recipients sent to, and a list of
+    # (address, error) pairs for the ones that failed.
+
+    workers = config.getint(MODE, 'notify-workers', fallback=8)
+    chunk_size = config.getint(MODE, 'notify-chunk-size', fallback=5000)
+    limiter = RateLimiter(config.getfloat(MODE, 'notify-rate', fallback=10.0))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    sent = 0
+    failures = []
+    in_flight = {}
+    seen = set()
+
+    def collect(futures):
+        nonlocal sent
+        for future in futures:
+            batch = in_flight.pop(future)
+            error = future.exception()
+            if error is None:
+                sent += len(batch)
+            else:
+                failures.extend((r['address'], error) for r in batch)
+
+    recipients = iter(recipients)
+    with session, ThreadPoolExecutor(workers) as pool:
+        while True:
+            chunk = list(itertools.islice(recipients, chunk_size))
+            if not chunk:
+                break
+            for batch, first in batch_recipients(chunk, seen):
+                if len(in_flight) >= 2 * workers:
+                    done, _ = wait(in_flight, return_when = FIRST_COMPLETED)
+                    collect(done)
+                future = pool.submit(send_batch, batch, new_count, session, limiter, first)
+                in_flight[future] = batch
+        collect(list(in_flight))
+
+    return sent, failures
+
+def recipients_path():
+
+    # Subscribers are listed in emails.jsonl if it exists, or emails.json.
+    jsonl_path = path.join(UPLOADER_DIR, 'emails.jsonl')
+    if path.exists(jsonl_path):
+        return jsonl_path
+    return path.join(UPLOADER_DIR, 'emails.json')
 
 if __name__ == '__main__':
 
     new_post_count = compute_new_post_count()
 
     if new_post_count > 0:
-        with open(path.join(UPLOADER_DIR, 'emails.json')) as f:
-            emails = json.load(f)
-
-        for recipient in emails['recipients']:
-            send_update(recipient, new_post_count)
+        recipients = read_recipients(recipients_path())
+        sent, failures = send_updates(recipients, new_post_count)
 
-        print('Updates sent successfully')
+        print('Sent %d updates, %d failed' % (sent, len(failures)))
+        for address, error in failures:
+            print('Failed to send update to %s: %s' % (address, error))
+        if failures:
+            sys.exit(1)
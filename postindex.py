@@ -0,0 +1,250 @@
+import logging
+import re
+import sqlite3
+from contextlib import closing, contextmanager
+from os import listdir, remove, stat
+from os.path import join
+
+# Post file names look like `2017-01-16-3.md`: the date, then the OID.
+POST_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2})-(\d+)\.md$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    oid INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    date TEXT NOT NULL,
+    taken TEXT,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+def read_front_matter(file_path):
+    """
+    Reads the simple `key: value` pairs from a post's front matter.
+
+    Parameters
+    ----------
+    file_path: The path to a post file.
+
+    Returns
+    -------
+    A dictionary of front matter values, with surrounding quotes removed.
+    """
+
+    front_matter = {}
+    with open(file_path) as f:
+        if f.readline().strip() != '---':
+            return front_matter
+        for line in f:
+            line = line.strip()
+            if line == '---':
+                break
+            key, sep, value = line.partition(':')
+            if sep:
+                value = value.strip()
+                if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"':
+                    value = value[1:-1]
+                front_matter[key.strip()] = value
+    return front_matter
+
+
+class PostIndex:
+    """
+    A persistent index of the blog's posts, stored in a SQLite database, that
+    hands out new OIDs.
+
+    The index is updated as posts are written. It's rebuilt from the posts
+    directory whenever the directory has changed behind its back (e.g. after
+    pulling posts that were made elsewhere), which is detected by comparing the
+    directory's modification time with the one recorded at the last update.
+
+    Parameters
+    ----------
+    path: The path of the SQLite database file.
+    posts_path: The path of the blog's `_posts` directory.
+    """
+
+    def __init__(self, path, posts_path):
+        self.path = path
+        self.posts_path = posts_path
+
+    @contextmanager
+    def _transaction(self):
+        with closing(sqlite3.connect(self.path, timeout = 30, isolation_level = None)) as db:
+            db.executescript(SCHEMA)
+            # Take the write lock up front, so that concurrent allocations
+            # (from other threads or processes) are serialized.
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def _get_state(self, db, key, default = None):
+        row = db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_state(self, db, key, value):
+        db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def _posts_mtime(self):
+        return stat(self.posts_path).st_mtime_ns
+
+    def _rebuild(self, db):
+        logging.info('Rebuilding post index from {0}'.format(self.posts_path))
+
+        mtime = self._posts_mtime()
+        db.execute('DELETE FROM posts')
+
+        for file_name in listdir(self.posts_path):
+            match = POST_NAME.match(file_name)
+            if match is None:
+                logging.warning('Skipping unrecognized post {0}'.format(file_name))
+                continue
+            date, oid = match.groups()
+            front_matter = read_front_matter(join(self.posts_path, file_name))
+            db.execute(
+                'INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)',
+                (int(oid), file_name, date, front_matter.get('taken'), front_matter.get('summary')),
+            )
+
+        # Never hand out an OID twice, even one that was allocated for a post
+        # that hasn't been written yet.
+        latest = db.execute('SELECT max(oid) FROM posts').fetchone()[0]
+        next_oid = max(self._get_state(db, 'next_oid', 0), 0 if latest is None else latest + 1)
+        self._set_state(db, 'next_oid', next_oid)
+        self._set_state(db, 'posts_mtime', mtime)
+
+    def _refresh(self, db):
+        if self._get_state(db, 'posts_mtime') != self._posts_mtime():
+            self._rebuild(db)
+
+    def rebuild(self):
+        """
+        Rebuilds the index from the posts directory.
+        """
+
+        with self._transaction() as db:
+            self._rebuild(db)
+
+    def allocate(self):
+        """
+        Atomically allocates a new OID. OIDs are never handed out twice.
+
+        Returns
+        -------
+        The new OID.
+        """
+
+        with self._transaction() as db:
+            self._refresh(db)
+            oid = self._get_state(db, 'next_oid')
+            self._set_state(db, 'next_oid', oid + 1)
+        return oid
+
+    def peek(self):
+        """
+        Returns the OID that the next call to `allocate` will return, without
+        allocating it.
+        """
+
+        with self._transaction() as db:
+            self._refresh(db)
+            return self._get_state(db, 'next_oid')
+
+    def latest(self):
+        """
+        Returns the OID of the latest post, or None if there are no posts.
+        """
+
+        with self._transaction() as db:
+            self._refresh(db)
+            return db.execute('SELECT max(oid) FROM posts').fetchone()[0]
+
+    def count_after(self, oid):
+        """
+        Returns the number of posts with OIDs greater than `oid`. OIDs can
+        have gaps (where a post failed after its OID was allocated), so this
+        can be less than the difference between the OIDs.
+        """
+
+        with self._transaction() as db:
+            self._refresh(db)
+            return db.execute('SELECT count(*) FROM posts WHERE oid > ?', (oid,)).fetchone()[0]
+
+    @contextmanager
+    def record(self, oid, file_name, date, taken = None, summary = None):
+        """
+        A context manager within which a new post is written to the posts
+        directory. Once the block finishes, the post is added to the index.
+
+        Parameters
+        ----------
+        oid: The post's OID.
+        file_name: The name of the post's file.
+        date: The post's date, as an ISO date string.
+        taken: The date the post's image was captured, if known.
+        summary: The post's summary, if any.
+        """
+
+        before = self._posts_mtime()
+        yield
+
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)',
+                (oid, file_name, date, taken, summary),
+            )
+            next_oid = self._get_state(db, 'next_oid', 0)
+            self._set_state(db, 'next_oid', max(next_oid, oid + 1))
+
+            # If the index was up to date before this post was written, it's
+            # still up to date now. Otherwise, leave it to be rebuilt.
+            if self._get_state(db, 'posts_mtime') == before:
+                self._set_state(db, 'posts_mtime', self._posts_mtime())
+
+    def remove(self, oid, file_name):
+        """
+        Deletes a post that was written but never published from the posts
+        directory, and removes it from the index. Its OID isn't handed out
+        again.
+
+        Parameters
+        ----------
+        oid: The post's OID.
+        file_name: The name of the post's file.
+        """
+
+        before = self._posts_mtime()
+        try:
+            remove(join(self.posts_path, file_name))
+        except FileNotFoundError:
+            pass
+
+        with self._transaction() as db:
+            db.execute('DELETE FROM posts WHERE oid = ?', (oid,))
+            if self._get_state(db, 'posts_mtime') == before:
+                self._set_state(db, 'posts_mtime', self._posts_mtime())
+
+    def get(self, oid):
+        """
+        Looks up a post by its OID.
+
+        Returns
+        -------
+        A dictionary with the post's `oid`, `filename`, `date`, `taken` and
+        `summary`, or None if there's no such post.
+        """
+
+        with self._transaction() as db:
+            self._refresh(db)
+            row = db.execute('SELECT * FROM posts WHERE oid = ?', (oid,)).fetchone()
+        if row is not None:
+            return dict(zip([ 'oid', 'filename', 'date', 'taken', 'summary' ], row))
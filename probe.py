@@ -0,0 +1,213 @@
+"""
+Reads an image's format, dimensions and EXIF dates and orientation from its
+header, without decoding any pixels.
+
+JPEG and PNG headers are parsed directly: only the markers (or chunks) before
+the image data are read, and the rest are skipped over. Other formats are
+identified by Pillow, which also only reads their headers until an image is
+loaded.
+"""
+
+import struct
+
+from PIL import Image, UnidentifiedImageError
+
+# EXIF tags.
+ORIENTATION = 0x0112
+DATETIME = 0x0132
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# JPEG markers that stand alone, without a length or any data.
+JPEG_STANDALONE = { 0x01, *range(0xD0, 0xD8) }
+
+# JPEG start-of-frame markers, which hold the image's dimensions. The others in
+# the range are DHT (0xC4), JPG (0xC8) and DAC (0xCC).
+JPEG_SOF = set(range(0xC0, 0xD0)) - { 0xC4, 0xC8, 0xCC }
+
+# TIFF field types, by their size in bytes.
+TIFF_TYPE_SIZES = { 1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8 }
+
+
+class UnsupportedImage(ValueError):
+    """
+    Raised when a file isn't an image in a format that can be read.
+    """
+
+
+def parse_exif(data):
+    """
+    Reads the orientation and dates from EXIF data (a TIFF header and its
+    IFDs). Malformed data is read as far as it makes sense.
+
+    Returns
+    -------
+    A dictionary of the `orientation`, `datetime` and `datetime_original`
+    found. Missing values are left out.
+    """
+
+    result = {}
+
+    try:
+        order = { b'II': '<', b'MM': '>' }[data[:2]]
+    except KeyError:
+        return result
+
+    def unpack(fmt, offset):
+        return struct.unpack_from(order + fmt, data, offset)
+
+    def read_ifd(offset):
+        entries = {}
+        count, = unpack('H', offset)
+        for i in range(count):
+            tag, type, n, value = unpack('HHI4s', offset + 2 + i * 12)
+            size = TIFF_TYPE_SIZES.get(type, 1) * n
+            if size > 4:
+                value_offset, = unpack('I', offset + 2 + i * 12 + 8)
+                value = data[value_offset:value_offset + size]
+            entries[tag] = (type, value)
+        return entries
+
+    def ascii(entry):
+        return entry[1].split(b'\0', 1)[0].decode('ascii', 'replace').strip() or None
+
+    try:
+        ifd0 = read_ifd(unpack('I', 4)[0])
+        if ORIENTATION in ifd0:
+            result['orientation'] = struct.unpack(order + 'H', ifd0[ORIENTATION][1][:2])[0]
+        if DATETIME in ifd0:
+            result['datetime'] = ascii(ifd0[DATETIME])
+        if EXIF_IFD in ifd0:
+            exif_ifd = read_ifd(struct.unpack(order + 'I', ifd0[EXIF_IFD][1])[0])
+            if DATETIME_ORIGINAL in exif_ifd:
+                result['datetime_original'] = ascii(exif_ifd[DATETIME_ORIGINAL])
+    except struct.error:
+        pass
+
+    return { k: v for k, v in result.items() if v is not None }
+
+
+def probe_jpeg(fp):
+    info = { 'format': 'JPEG' }
+
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            break
+        if byte != b'\xff':
+            continue
+        # Markers can be padded with any number of 0xFF bytes.
+        marker = fp.read(1)
+        while marker == b'\xff':
+            marker = fp.read(1)
+        if not marker:
+            break
+        marker = marker[0]
+
+        if marker in JPEG_STANDALONE or marker == 0x00:
+            continue
+        # Stop at the start of the image data, or the end of the image.
+        if marker in (0xDA, 0xD9):
+            break
+
+        length, = struct.unpack('>H', fp.read(2))
+        if marker == 0xE1 and 'exif' not in info:
+            segment = fp.read(length - 2)
+            if segment.startswith(b'Exif\0\0'):
+                info['exif'] = True
+                info.update(parse_exif(segment[6:]))
+        elif marker in JPEG_SOF:
+            _, height, width = struct.unpack('>BHH', fp.read(5))
+            info['width'], info['height'] = width, height
+            break
+        else:
+            fp.seek(length - 2, 1)
+
+    info.pop('exif', None)
+    if 'width' not in info:
+        raise UnsupportedImage('JPEG has no frame header')
+    return info
+
+
+def probe_png(fp):
+    fp.seek(len(PNG_SIGNATURE), 1)
+    info = { 'format': 'PNG' }
+
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack('>I4s', header)
+        if kind == b'IHDR':
+            info['width'], info['height'] = struct.unpack('>II', fp.read(8))
+            fp.seek(length - 8 + 4, 1)
+        elif kind == b'eXIf':
+            info.update(parse_exif(fp.read(length)))
+            fp.seek(4, 1)
+        elif kind in (b'IDAT', b'IEND'):
+            break
+        else:
+            fp.seek(length + 4, 1)
+
+    if 'width' not in info:
+        raise UnsupportedImage('PNG has no header')
+    return info
+
+
+def probe_pillow(fp):
+    try:
+        img = Image.open(fp)
+    except UnidentifiedImageError as e:
+        raise UnsupportedImage(str(e))
+
+    # Don't close the image, which would close a file it was given.
+    exif = img.getexif()
+    info = {
+        'format': img.format,
+        'width': img.size[0],
+        'height': img.size[1],
+        'orientation': exif.get(ORIENTATION),
+        'datetime': exif.get(DATETIME),
+        'datetime_original': exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL),
+    }
+    return { k: v for k, v in info.items() if v is not None }
+
+
+def probe(fp):
+    """
+    Reads an image's header.
+
+    Parameters
+    ----------
+    fp: A seekable file object, or the path of a file. A file object is
+    rewound to where it started afterwards.
+
+    Returns
+    -------
+    A dictionary with the image's `format` (Pillow's name for it, such as
+    'JPEG'), `width` and `height`, and its EXIF `orientation`, `datetime` and
+    `datetime_original` (as 'YYYY:MM:DD HH:MM:SS' strings) if it has them.
+    Raises `UnsupportedImage` if the file isn't a readable image.
+    """
+
+    if isinstance(fp, str):
+        with open(fp, 'rb') as f:
+            return probe(f)
+
+    start = fp.tell()
+    try:
+        signature = fp.read(len(PNG_SIGNATURE))
+        fp.seek(start)
+        try:
+            if signature.startswith(b'\xff\xd8'):
+                fp.seek(2, 1)
+                return probe_jpeg(fp)
+            if signature == PNG_SIGNATURE:
+                return probe_png(fp)
+        except struct.error:
+            raise UnsupportedImage('Image header is truncated')
+        return probe_pillow(fp)
+    finally:
+        fp.seek(start)
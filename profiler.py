@@ -0,0 +1,146 @@
+import cProfile
+import datetime
+import hmac
+import io
+import itertools
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os import listdir, makedirs, remove
+from os.path import join, splitext
+
+
+class Profiler:
+    """
+    Profiles selected requests with cProfile and tracemalloc, and writes what
+    it finds to a directory: a `.pstats` file that can be loaded with `pstats`
+    or snakeviz, and a `.txt` report with the peak memory use, the slowest
+    functions and the top allocation sites. Only the newest profiles are kept.
+
+    A request is profiled if it's the `every`th since the last one, or if it
+    carries the profiling token. When neither is configured, deciding costs a
+    single comparison.
+
+    cProfile only sees the thread it was started on, but tracemalloc traces
+    every thread, so work handed off to thread pools shows up in the memory
+    report but not in the timings. Because tracemalloc is process-wide, only one
+    profile is captured at a time; a request that's selected while another is
+    being profiled runs unprofiled.
+
+    Parameters
+    ----------
+    path: The directory to write profiles to.
+    every: Profile every this many requests. 0 turns sampling off.
+    token: A secret that profiles any request that sends it. None turns this
+    off.
+    keep: The number of profiles to keep.
+    top: The number of functions and allocation sites in each report.
+    """
+
+    def __init__(self, path, every = 0, token = None, keep = 20, top = 25):
+        self.path = path
+        self.every = every
+        self.token = token
+        self.keep = keep
+        self.top = top
+        self.enabled = bool(every or token)
+
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def sample(self, token = None):
+        """
+        Decides whether to profile a request.
+
+        Parameters
+        ----------
+        token: The profiling token sent with the request, if any.
+        """
+
+        if not self.enabled:
+            return False
+        if self.token and token and hmac.compare_digest(token, self.token):
+            return True
+        return bool(self.every) and next(self._count) % self.every == 0
+
+    @contextmanager
+    def profile(self, name):
+        """
+        Profiles a block and writes the results.
+
+        Parameters
+        ----------
+        name: A name for the profile, used in its file names.
+        """
+
+        if not self._lock.acquire(blocking = False):
+            logging.info('Not profiling {0}: another profile is running'.format(name))
+            yield
+            return
+
+        try:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if not tracing:
+                    tracemalloc.stop()
+                try:
+                    self._write(name, profile, snapshot, elapsed, peak)
+                except Exception as e:
+                    logging.error('Failed to write profile {0}: {1}'.format(name, e))
+        finally:
+            self._lock.release()
+
+    def _write(self, name, profile, snapshot, elapsed, peak):
+        makedirs(self.path, exist_ok = True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        base = join(self.path, '{0}-{1}'.format(stamp, name))
+
+        profile.dump_stats(base + '.pstats')
+
+        stats = io.StringIO()
+        pstats.Stats(profile, stream = stats).sort_stats('cumulative').print_stats(self.top)
+
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        lines = [
+            'Profile of {0}'.format(name),
+            'Elapsed: {0:.3f} s'.format(elapsed),
+            'Peak traced memory: {0:.1f} MB'.format(peak / 1024 / 1024),
+            '',
+            'Top allocation sites (still allocated at the end):',
+        ]
+        lines.extend('  {0}'.format(s) for s in snapshot.statistics('lineno')[:self.top])
+        lines.extend([ '', stats.getvalue() ])
+
+        with open(base + '.txt', 'w') as f:
+            f.write('\n'.join(lines))
+
+        logging.info('Wrote profile {0}'.format(base))
+        self._rotate()
+
+    def _rotate(self):
+        # File names start with a timestamp, so they sort oldest first.
+        profiles = sorted({ splitext(f)[0] for f in listdir(self.path) })
+        for base in profiles[:max(len(profiles) - self.keep, 0)]:
+            for ext in ('.pstats', '.txt'):
+                try:
+                    remove(join(self.path, base + ext))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,278 @@
+import fcntl
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+
+class CommitBatcher:
+    """
+    Folds posts that are written in quick succession into a single commit and
+    push, so a burst of uploads only republishes the site once.
+
+    Posts are collected until none have arrived for `window` seconds, or until
+    `max_batch` posts are waiting, and are then handed to `publish` together on
+    a background thread.
+
+    Parameters
+    ----------
+    publish: A function that is called with a list of batched items. It
+    returns a dictionary mapping the items that couldn't be published to the
+    errors that prevented it. If it raises, every item in the batch fails.
+    window: The number of seconds to wait for more posts before publishing.
+    max_batch: The maximum number of posts to publish at once.
+    """
+
+    def __init__(self, publish, window = 5.0, max_batch = 20):
+        self.publish = publish
+        self.window = window
+        self.max_batch = max_batch
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._last_submit = None
+        self._thread = None
+        self._stopping = False
+
+    def submit(self, item):
+        """
+        Adds an item to the next batch.
+
+        Returns
+        -------
+        A `Future` that resolves once the item has been published, or fails
+        with the error that stopped it from being published.
+        """
+
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._run,
+                    name = 'commit-batcher',
+                    daemon = True,
+                )
+                self._thread.start()
+            self._pending.append((item, future))
+            self._last_submit = time.monotonic()
+            self._cond.notify()
+        return future
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    if self._stopping or len(self._pending) >= self.max_batch:
+                        break
+                    remaining = self._last_submit + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                elif self._stopping:
+                    return []
+                else:
+                    self._cond.wait()
+
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            return batch
+
+    def _publish(self, batch):
+        items = [ item for item, _ in batch ]
+        try:
+            errors = self.publish(items) or {}
+        except Exception as e:
+            logging.exception(e)
+            errors = { item: e for item in items }
+
+        for item, future in batch:
+            if item in errors:
+                future.set_exception(errors[item])
+            else:
+                future.set_result(item)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._publish(batch)
+
+    def stop(self):
+        """
+        Publishes any waiting items right away and stops the background thread.
+        """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+class RepoLock:
+    """
+    A reentrant lock that, when given a path, also holds an exclusive `flock`
+    on that file while it's held, so that several server processes sharing a
+    repository take turns with it too.
+
+    Parameters
+    ----------
+    path: The path of the lock file, or None to only lock between threads.
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1 and self.path is not None:
+            try:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except Exception:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._depth -= 1
+                self._lock.release()
+                raise
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SiteSync:
+    """
+    Keeps the local blog repository in step with its remote without fetching
+    on every upload.
+
+    A background thread fetches the remote branch every `interval` seconds.
+    Before posts are allocated or committed, `update` brings the local branch
+    up to date with whatever was last fetched, which only touches the working
+    tree when the remote has actually moved.
+
+    Every git command runs in the repository's directory (rather than changing
+    the process's working directory), and everything that touches the working
+    tree or the local branch holds `lock`, so the repository can be used safely
+    from several threads, and from several processes if `lock_path` is given.
+
+    Parameters
+    ----------
+    git: A GitPython `Git` object for the blog repository.
+    remote: The name of the remote to sync with.
+    branch: The name of the branch to sync.
+    interval: The number of seconds between fetches.
+    lock_path: The path of a file to lock the repository with between
+    processes.
+    """
+
+    def __init__(self, git, remote = 'origin', branch = 'master', interval = 60.0, lock_path = None):
+        self.git = git
+        self.remote = remote
+        self.branch = branch
+        self.interval = interval
+        self.lock = RepoLock(lock_path)
+
+        self._fetch_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def upstream(self):
+        return '{0}/{1}'.format(self.remote, self.branch)
+
+    def fetch(self):
+        """
+        Fetches the remote branch. This only updates remote-tracking refs, so it
+        doesn't hold up commits while it waits on the network.
+        """
+
+        with self._fetch_lock:
+            self.git.fetch(self.remote, self.branch)
+
+    def update(self):
+        """
+        Brings the local branch up to date with the last fetched state of the
+        remote branch. Local commits that haven't been pushed yet are rebased
+        on top of it.
+
+        Returns
+        -------
+        True if the local branch changed, or False if the remote hadn't moved.
+        """
+
+        with self.lock:
+            behind = int(self.git.rev_list('--count', 'HEAD..' + self.upstream))
+            if behind == 0:
+                return False
+
+            logging.info('Updating blog from {0} ({1} new commits)'.format(self.upstream, behind))
+            ahead = int(self.git.rev_list('--count', self.upstream + '..HEAD'))
+            if ahead:
+                self.git.rebase(self.upstream)
+            else:
+                self.git.merge('--ff-only', self.upstream)
+            return True
+
+    def push(self):
+        """
+        Pushes the local branch. If the push is rejected because the remote
+        moved since it was last fetched, fetches, updates and tries once more.
+        """
+
+        with self.lock:
+            try:
+                self.git.push(self.remote, self.branch)
+            except Exception as e:
+                logging.warning('Push failed, retrying after fetching: {0}'.format(e))
+                self.fetch()
+                self.update()
+                self.git.push(self.remote, self.branch)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.fetch()
+            except Exception as e:
+                logging.warning('Failed to fetch blog repository: {0}'.format(e))
+
+    def start(self):
+        """
+        Fetches and updates the repository, then starts fetching periodically
+        in the background.
+        """
+
+        self.fetch()
+        self.update()
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target = self._run, name = 'site-sync', daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background fetches.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,145 @@
+"""
+Picks JPEG encoder settings per image, to hit a perceptual quality target with
+as few bytes as possible.
+
+Quality is measured with SSIM (the structural similarity index), computed over
+non-overlapping blocks with Pillow's own image operations. 1.0 means the
+images are identical; around 0.98 is hard to tell apart from the original.
+"""
+
+import io
+import time
+
+from PIL import Image, ImageMath
+
+# Constants from the SSIM paper, for 8-bit images.
+C1 = (0.01 * 255) ** 2
+C2 = (0.03 * 255) ** 2
+
+# The values of Pillow's `subsampling` option.
+SUBSAMPLING_444 = 0
+SUBSAMPLING_420 = 2
+
+
+# ImageMath.eval was renamed unsafe_eval in Pillow 10.3 (and removed in 12),
+# but either evaluates the same string expressions.
+image_eval = getattr(ImageMath, 'unsafe_eval', None) or ImageMath.eval
+
+
+def mean(img):
+    return img.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+
+def ssim(a, b, block = 8):
+    """
+    Computes the structural similarity of two single-band images of the same
+    size.
+
+    Parameters
+    ----------
+    a, b: The `PIL.Image`s to compare.
+    block: The size of the blocks the statistics are computed over, in pixels.
+
+    Returns
+    -------
+    The mean SSIM over all the blocks.
+    """
+
+    x = a.convert('F')
+    y = b.convert('F')
+
+    def block_mean(expression):
+        return image_eval(expression, x = x, y = y).reduce(block)
+
+    mx = x.reduce(block)
+    my = y.reduce(block)
+    mxx = block_mean('x * x')
+    myy = block_mean('y * y')
+    mxy = block_mean('x * y')
+
+    ssim_map = image_eval(
+        '(2 * mx * my + c1) * (2 * (mxy - mx * my) + c2) / '
+        '((mx * mx + my * my + c1) * (mxx - mx * mx + myy - my * my + c2))',
+        mx = mx, my = my, mxx = mxx, myy = myy, mxy = mxy, c1 = C1, c2 = C2,
+    )
+    return mean(ssim_map)
+
+
+def choose_subsampling(img, target):
+    """
+    Decides whether an image's colour can be stored at half resolution (4:2:0
+    chroma subsampling) without falling below the quality target. Images with
+    fine, saturated detail (like red text, or flowers) need full resolution
+    colour (4:4:4).
+
+    Parameters
+    ----------
+    img: An RGB `PIL.Image`.
+    target: The SSIM the image's chroma must keep.
+
+    Returns
+    -------
+    The value for Pillow's `subsampling` option.
+    """
+
+    half = (max(img.size[0] // 2, 1), max(img.size[1] // 2, 1))
+    _, cb, cr = img.convert('YCbCr').split()
+    for band in (cb, cr):
+        subsampled = band.resize(half, Image.Resampling.BOX).resize(band.size, Image.Resampling.BILINEAR)
+        if ssim(band, subsampled) < target:
+            return SUBSAMPLING_444
+    return SUBSAMPLING_420
+
+
+def choose_jpeg_settings(img, target, min_quality = 40, max_quality = 95, time_budget = 1.0):
+    """
+    Searches for the lowest JPEG quality that keeps an image's luma at or
+    above an SSIM target, and picks its chroma subsampling.
+
+    The search is a bisection over quality, which stops early once
+    `time_budget` runs out. If no setting is known to meet the target by then,
+    it gives up.
+
+    Parameters
+    ----------
+    img: An RGB `PIL.Image`.
+    target: The SSIM to aim for.
+    min_quality, max_quality: The range of qualities to search. If even
+    `max_quality` misses the target, it's used anyway.
+    time_budget: The most seconds to spend searching.
+
+    Returns
+    -------
+    A dictionary of `quality` and `subsampling` options for saving the image,
+    or None if the search ran out of time.
+    """
+
+    deadline = time.perf_counter() + time_budget
+    subsampling = choose_subsampling(img, target)
+    luma = img.convert('L')
+
+    def score(quality):
+        buffer = io.BytesIO()
+        img.save(buffer, format = 'JPEG', quality = quality, subsampling = subsampling)
+        buffer.seek(0)
+        with Image.open(buffer) as encoded:
+            return ssim(luma, encoded.convert('L'))
+
+    best = None
+    low, high = min_quality, max_quality
+    while low <= high:
+        if time.perf_counter() > deadline:
+            if best is None:
+                return None
+            break
+        quality = (low + high) // 2
+        if score(quality) >= target:
+            best = quality
+            high = quality - 1
+        else:
+            low = quality + 1
+
+    return {
+        'quality': max_quality if best is None else best,
+        'subsampling': subsampling,
+    }
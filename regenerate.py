@@ -0,0 +1,254 @@
+"""
+Regenerates the resized images of existing posts after the sizes or formats
+they're made in have changed.
+
+    python regenerate.py
+    python regenerate.py --workers 4 --dry-run
+
+Each post's markup says which sizes and formats its images were made in. Images
+that don't match the current `sizes` and `extra-formats` are rebuilt in a pool
+of processes, one per core, from the originals archived when they were
+uploaded (see `archive-originals`); files that are already in storage aren't
+uploaded again. The posts' markup is then rewritten to match, and published in
+a single commit and push.
+
+Images uploaded before originals were archived can't be regenerated, and are
+skipped.
+"""
+
+import argparse
+import logging
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import cpu_count, listdir
+from os.path import join
+from tempfile import SpooledTemporaryFile
+
+from PIL import Image
+
+import server
+from postindex import POST_NAME
+
+# An image's markup: a <picture>, or an <img> on its own.
+IMAGE_TAG = re.compile(r'<picture>.*?</picture>|<img [^>]*/>')
+
+# A file in a srcset, and its width.
+SRCSET_ENTRY = re.compile(r'\{\{ site\.assets_url \}\}/(\S+) (\d+)w')
+
+
+def parse_image_tag(tag):
+    """
+    Reads which files an image's markup refers to.
+
+    Parameters
+    ----------
+    tag: An image's markup, from `create_img_tag`.
+
+    Returns
+    -------
+    A dictionary with the image's `name`, the `widths` of its JPEGs, the file
+    `extensions` it was made in, whether it has a `summary`, and the `keys`
+    its files were uploaded as, by file name. None if the markup isn't
+    recognized.
+    """
+
+    name = None
+    widths = set()
+    extensions = set()
+    keys = {}
+
+    for key, width in SRCSET_ENTRY.findall(tag):
+        match = re.match(r'(.+)-%s(?:-[0-9a-f]{16})?\.(\w+)$' % width, key)
+        if match is None:
+            return None
+        name, extension = match.groups()
+        extensions.add(extension)
+        if extension == 'jpg':
+            widths.add(int(width))
+        keys['%s-%s.%s' % (name, width, extension)] = key
+
+    if name is None:
+        return None
+
+    return {
+        'name': name,
+        'widths': sorted(widths),
+        'extensions': extensions,
+        'summary': 'alt="{{ page.summary }}"' in tag,
+        'keys': keys,
+    }
+
+
+def is_current(image):
+    """
+    Returns whether an image (from `parse_image_tag`) was made in the current
+    sizes and formats.
+    """
+
+    extensions = { server.FORMATS[f]['extension'] for f in [ 'jpeg' ] + server.EXTRA_FORMATS }
+    if image['extensions'] != extensions or len(image['widths']) != len(server.SIZES):
+        return False
+
+    # Each width is its size, scaled down by the same amount for portrait
+    # images (give or take rounding).
+    scale = image['widths'][-1] / server.SIZES[-1]
+    return all(abs(w - s * scale) <= 1 for w, s in zip(image['widths'], server.SIZES))
+
+
+def find_outdated(posts_path):
+    """
+    Finds the posts with images that aren't current.
+
+    Returns
+    -------
+    A dictionary mapping the file names of the posts to lists of their
+    outdated images (from `parse_image_tag`).
+    """
+
+    outdated = {}
+    for file_name in sorted(listdir(posts_path)):
+        if POST_NAME.match(file_name) is None:
+            continue
+        with open(join(posts_path, file_name)) as f:
+            contents = f.read()
+        for tag in IMAGE_TAG.findall(contents):
+            image = parse_image_tag(tag)
+            if image is not None and not is_current(image):
+                outdated.setdefault(file_name, []).append(dict(image, tag = tag))
+    return outdated
+
+
+def regenerate_image(name):
+    """
+    Rebuilds an image's resized files from its archived original, in a
+    worker process.
+
+    Returns
+    -------
+    The widths of the resized images and the keys of their files, as from
+    `server.resize_and_upload`. Raises `FileNotFoundError` if the original
+    wasn't archived.
+    """
+
+    with SpooledTemporaryFile(max_size = server.SPOOL_THRESHOLD) as original:
+        with server.storage.get(server.original_key(name)) as body:
+            shutil.copyfileobj(body, original)
+        original.seek(0)
+
+        img = server.decode_image(Image.open(original))
+        return server.resize_and_upload(img, name, skip_existing = True)
+
+
+def rewrite_post(contents, image, widths, keys):
+    """
+    Replaces an image's markup in a post, and any references to its OpenGraph
+    image (in the front matter, or a gallery figure), with the regenerated
+    image's.
+    """
+
+    name = image['name']
+    tag = server.create_img_tag(name, widths, image['summary'], server.EXTRA_FORMATS, keys)
+    contents = contents.replace(image['tag'], tag)
+
+    old_og = image['keys']['%s-%d.jpg' % (name, image['widths'][-1])]
+    new_og = keys['%s-%d.jpg' % (name, max(widths))]
+    contents = contents.replace('og_image: %s\n' % old_og, 'og_image: %s\n' % new_og)
+    contents = contents.replace('/%s"' % old_og, '/%s"' % new_og)
+    return contents
+
+
+def regenerate(workers = None):
+    """
+    Regenerates every outdated image, rewrites their posts, and publishes them
+    in one commit.
+
+    Parameters
+    ----------
+    workers: The number of worker processes. Defaults to one per core.
+
+    Returns
+    -------
+    A list of (name, error) pairs for the images that couldn't be regenerated.
+    """
+
+    failures = []
+    workers = workers or cpu_count()
+    posts_path = join(server.blog_path, '_posts')
+
+    if not server.DRY:
+        server.sync.fetch()
+        server.sync.update()
+
+    outdated = find_outdated(posts_path)
+    images = [ (file_name, image) for file_name, images in outdated.items() for image in images ]
+    logging.info('Regenerating {0} images in {1} posts'.format(len(images), len(outdated)))
+
+    results = {}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(regenerate_image, image['name']): (file_name, image)
+            for file_name, image in images
+        }
+        for future in as_completed(futures):
+            file_name, image = futures[future]
+            if isinstance(future.exception(), FileNotFoundError):
+                logging.warning('Skipping image {0}: no archived original'.format(image['name']))
+            elif future.exception() is not None:
+                logging.error('Failed to regenerate image {0}: {1}'.format(image['name'], future.exception()))
+                failures.append((image['name'], future.exception()))
+            else:
+                results.setdefault(file_name, []).append((image, future.result()))
+
+    posts = []
+    with server.sync.lock:
+        for file_name, regenerated in sorted(results.items()):
+            path = join(posts_path, file_name)
+            with open(path) as f:
+                contents = f.read()
+            for image, (widths, keys) in regenerated:
+                contents = rewrite_post(contents, image, widths, keys)
+            if not server.DRY:
+                with open(path, 'w') as f:
+                    f.write(contents)
+            posts.append((int(POST_NAME.match(file_name).group(2)), join('_posts', file_name)))
+
+    if posts:
+        message = 'Regenerate images for posts {0}'.format(', '.join(str(oid) for oid, _ in posts))
+        errors = server.update_site(posts, message)
+        failures.extend(('post %d' % oid, e) for (oid, _), e in errors.items())
+
+    return failures
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--workers',
+        type = int,
+        default = cpu_count(),
+        help = 'worker processes (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action = 'store_true',
+        help = 'list the outdated images without regenerating them',
+    )
+    args = parser.parse_args(argv)
+
+    if args.dry_run:
+        outdated = find_outdated(join(server.blog_path, '_posts'))
+        for file_name, images in outdated.items():
+            print('{0}: {1}'.format(file_name, ', '.join(image['name'] for image in images)))
+        return 0
+
+    failures = regenerate(args.workers)
+    for name, error in failures:
+        print('Failed to regenerate {0}: {1}'.format(name, error))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,30 +1,66 @@
 import datetime
+import hashlib
 import hmac
 import html
+import io
 import logging
+import math
 import re
-from contextlib import contextmanager
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+from contextlib import contextmanager, nullcontext
 from email.utils import parseaddr
-from os import listdir, remove, environ, getcwd, chdir
-from os.path import join, basename, dirname, realpath
-
-import boto3
-from bottle import abort, post, request, run
-from git import Repo
-from PIL import Image, ImageOps
-from PIL.ExifTags import TAGS as EXIF_TAGS
+from functools import wraps
+from os import cpu_count, environ, getpid
+from os.path import basename, join, dirname, realpath
+from socketserver import ThreadingMixIn
+from tempfile import SpooledTemporaryFile
+from wsgiref.simple_server import WSGIServer, make_server
+
+from bottle import (
+    HTTPError,
+    HTTPResponse,
+    ServerAdapter,
+    abort,
+    default_app,
+    get,
+    hook,
+    post,
+    request,
+    response,
+    run,
+    static_file,
+)
+from git import Git
+from PIL import Image, ImageOps, features
+
+from budget import MemoryBudget
+from dedup import DedupCache, content_key
+from ingest import MultipartError, MultipartReader, RequestTooLarge, parse_content_type
+from jobs import JobQueue, QueueFull
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry
+from postindex import PostIndex
+from probe import DATETIME, UnsupportedImage, probe
+from profiler import Profiler
+from publisher import CommitBatcher, SiteSync
+from quality import choose_jpeg_settings
+from storage import LocalStorage, S3Storage
+
+# HEIC support is optional.
+try:
+    from pillow_heif import register_heif_opener
+except ImportError:
+    register_heif_opener = None
+
+if register_heif_opener is not None:
+    register_heif_opener()
 
 uploader_dirpath = dirname(realpath(__file__))
 rel = lambda f: join(uploader_dirpath, f)
 
-@contextmanager
-def pushd(where):
-    start_dir = getcwd()
-    chdir(where)
-    yield
-    chdir(start_dir)
-
 mode = environ.get('MODE', 'prod')
 config = ConfigParser()
 config.read(rel('config.ini'))
@@ -37,35 +73,275 @@ logging.basicConfig(
     level = logging.DEBUG if DRY else logging.INFO,
 )
 
-S3 = boto3.client(
-    's3',
-    aws_access_key_id = config['aws-access-key-id'],
-    aws_secret_access_key = config['aws-secret-access-key'],
+blog_path = config.get('blog-path', rel('blog'))
+
+# Resized images are stored in an S3 bucket, or in a local directory (which
+# the server serves under /assets).
+if config.get('storage', 's3') == 'local':
+    storage = LocalStorage(config.get('storage-path', rel('assets')))
+else:
+    storage = S3Storage(
+        config['aws-bucket'],
+        config['aws-access-key-id'],
+        config['aws-secret-access-key'],
+        max_connections = config.getint('s3-max-connections', 20),
+        multipart_threshold = config.getint('s3-multipart-threshold', 8 * 1024 * 1024),
+        multipart_chunksize = config.getint('s3-multipart-chunksize', 8 * 1024 * 1024),
+        max_concurrency = config.getint('s3-max-concurrency', 4),
+    )
+dedup = DedupCache(
+    config.get('dedup-path', rel('dedup.db')),
+    max_entries = config.getint('dedup-max-entries', 1000),
+)
+
+# Server processes that share the blog repository take turns with it by
+# locking this file.
+sync = SiteSync(
+    Git(blog_path) if mode == 'prod' else None,
+    interval = config.getfloat('sync-interval', 60.0),
+    lock_path = config.get('lock-path', rel('blog.lock')) if mode == 'prod' else None,
 )
 
-blog_path = config.get('blog-path', rel('blog'))
-git = Repo(blog_path).git if mode == 'prod' else None
+post_index = PostIndex(
+    config.get('index-path', rel('posts.db')),
+    join(blog_path, '_posts'),
+)
+
+# Encoded images are kept in memory unless they're larger than this many
+# bytes, in which case they're spilled to a private temporary file.
+SPOOL_THRESHOLD = config.getint('spool-threshold', 8 * 1024 * 1024)
+
+# The widths (or heights, for portrait images) of the resized images, from
+# smallest to largest. After changing them, regenerate.py brings old posts up
+# to date.
+SIZES = sorted(int(s) for s in config.get('sizes', '320, 640, 960, 1280').replace(',', ' ').split())
+
+# Unless this is turned off, each uploaded image is also stored as it was
+# received, under `original_key`, so that its resized images can be
+# regenerated later.
+ARCHIVE_ORIGINALS = config.getboolean('archive-originals', True)
+
+# The formats resized images can be encoded in: the extension of their files,
+# their content type, and the options they're saved with.
+FORMATS = {
+    'jpeg': {
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'options': { 'format': 'JPEG', 'optimize': True, 'progressive': True },
+    },
+    'webp': {
+        'extension': 'webp',
+        'content_type': 'image/webp',
+        'options': { 'format': 'WEBP', 'quality': 80, 'method': 6 },
+    },
+    'avif': {
+        'extension': 'avif',
+        'content_type': 'image/avif',
+        'options': { 'format': 'AVIF', 'quality': 50, 'speed': 6 },
+    },
+}
+
+# Every image is encoded as a JPEG, and also in these formats, in order of
+# preference. Formats this build of Pillow can't encode are skipped.
+EXTRA_FORMATS = []
+for name in config.get('extra-formats', '').replace(',', ' ').split():
+    if name not in FORMATS or name == 'jpeg':
+        logging.warning('Ignoring unknown image format {0}'.format(name))
+    elif not features.check(name):
+        logging.warning('Ignoring image format {0}: not supported by Pillow'.format(name))
+    else:
+        EXTRA_FORMATS.append(name)
+
+# When set, resized images are uploaded under a key that includes a hash of
+# their contents, so a key never changes what it refers to, and browsers and
+# CDNs can cache them forever.
+HASHED_KEYS = config.getboolean('hashed-keys', False)
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# When set, each JPEG's quality is searched for (within the range, and for at
+# most the time budget, in seconds) to be the lowest that keeps its SSIM at or
+# above this target, and its chroma subsampling is chosen to match.
+JPEG_TARGET_SSIM = config.getfloat('jpeg-target-ssim', 0.0)
+JPEG_MIN_QUALITY = config.getint('jpeg-min-quality', 40)
+JPEG_MAX_QUALITY = config.getint('jpeg-max-quality', 90)
+JPEG_TIME_BUDGET = config.getfloat('jpeg-time-budget', 1.0)
+
+# Images are only shrunk with JPEG draft mode or `Image.reduce` while they stay
+# at least this many times larger than the target size. The last step is
+# always a LANCZOS resample, which keeps the output indistinguishable from a
+# single LANCZOS resize of the original.
+REDUCING_GAP = 3.0
+
+# Images with more pixels than this are refused rather than decoded.
+MAX_PIXELS = config.getint('max-pixels', 100 * 1000 * 1000)
+
+# Full-resolution images being decoded may use this many bytes between them.
+# Decodes that would go over wait for others to finish.
+decode_budget = MemoryBudget(config.getint('decode-memory', 512 * 1024 * 1024))
+
+# The most images of a gallery that are processed at once.
+GALLERY_WORKERS = config.getint('gallery-workers', cpu_count() or 1)
+
+
+# Requests larger than this many bytes are rejected before they're read.
+MAX_REQUEST_SIZE = config.getint('max-request-size', 100 * 1024 * 1024)
+
+# Attachments larger than this many bytes are rejected as they're read.
+MAX_ATTACHMENT_SIZE = config.getint('max-attachment-size', 40 * 1024 * 1024)
+
+# Request fields other than attachments (the subject, sender, etc.) are small.
+MAX_FIELD_SIZE = 1024 * 1024
+
+# Request bodies are read, and attachments spooled, this many bytes at a time.
+INGEST_CHUNK_SIZE = config.getint('ingest-chunk-size', 64 * 1024)
+
+
+# Metrics are kept in memory and served on /metrics in the Prometheus text
+# format. Recording one is a dictionary update under a lock.
+registry = Registry()
+
+# The stages of handling an upload, in order.
+STAGES = [
+    'receive',
+    'sync',
+    'decode',
+    'exif',
+    'transpose',
+    'resize',
+    'encode',
+    'upload',
+    'write_post',
+    'commit',
+    'push',
+]
+
+stage_seconds = registry.histogram(
+    'uploader_stage_seconds',
+    'Time spent in each stage of handling an upload.',
+    [ 'stage' ],
+)
+stage_failures = registry.counter(
+    'uploader_stage_failures_total',
+    'Number of times each stage of handling an upload failed.',
+    [ 'stage' ],
+)
+for name in STAGES:
+    stage_failures.inc(0, stage = name)
+
+request_seconds = registry.histogram(
+    'uploader_request_seconds',
+    'Time spent responding to /upload requests.',
+)
+requests_in_flight = registry.gauge(
+    'uploader_requests_in_flight',
+    'Number of /upload requests being handled.',
+)
+bytes_received = registry.counter(
+    'uploader_received_bytes_total',
+    'Bytes of attachments received.',
+)
+bytes_uploaded = registry.counter(
+    'uploader_uploaded_bytes_total',
+    'Bytes of resized images uploaded to Amazon S3.',
+)
+bytes_saved = registry.counter(
+    'uploader_jpeg_bytes_saved_total',
+    'Bytes saved by quality-targeted JPEG encoding.',
+)
+queued_jobs = registry.gauge(
+    'uploader_jobs',
+    'Number of jobs in the upload queue.',
+    [ 'state' ],
+)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of handling an upload, and counts it as failed if it raises.
+    """
+
+    with stage_seconds.time(stage = name):
+        try:
+            yield
+        except Exception:
+            stage_failures.inc(stage = name)
+            raise
+
+
+def instrumented(f):
+    """
+    Decorates a route to time its requests and count those in flight.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with requests_in_flight.track(), request_seconds.time():
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+# Profiling is off unless requests are sampled (every Nth, set by `PROFILE` or
+# `profile-every`) or a profiling token is configured.
+profiler = Profiler(
+    config.get('profile-path', rel('profiles')),
+    every = int(environ.get('PROFILE') or config.getint('profile-every', 0)),
+    token = config.get('profile-token'),
+    keep = config.getint('profile-keep', 20),
+)
+
+
+def profiled(f):
+    """
+    Decorates a route to profile the requests that the profiler selects. The
+    request's environment records that it was profiled.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not profiler.sample(request.get_header('X-Profile')):
+            return f(*args, **kwargs)
+        request.environ['uploader.profile'] = True
+        with profiler.profile('upload'):
+            return f(*args, **kwargs)
 
-TEMP_PATH = '/tmp'
+    return wrapper
 
 
 authorized_senders = re.compile(config['authorized-senders-pattern'])
+def is_authorized_user(auth):
+    user_authorized = hmac.compare_digest(auth[0], config['sendgrid-user'])
+    pass_authorized = hmac.compare_digest(auth[1], config['sendgrid-pass'])
+    return user_authorized and pass_authorized
+
+
+def is_authorized_sender(sender):
+    _, email = parseaddr(sender or '')
+    return authorized_senders.match(email) is not None
+
+
 def is_authorized(request):
-    _, email = parseaddr(request.params.get('from'))
-    sender_authorized = authorized_senders.match(email) is not None
-    user_authorized = hmac.compare_digest(request.auth[0], config['sendgrid-user'])
-    pass_authorized = hmac.compare_digest(request.auth[1], config['sendgrid-pass'])
-    return sender_authorized and user_authorized and pass_authorized
+    sender_authorized = is_authorized_sender(request.params.get('from'))
+    return sender_authorized and is_authorized_user(request.auth)
 
 
-def get_new_oid():
-    posts = listdir(join(blog_path, '_posts'))
+# `Image.reduce` doesn't support these modes.
+REDUCE_CONVERT_MODES = ('1', 'P', 'I;16')
 
-    if len(posts) == 0:
-        return 0
 
-    sorted_oids = sorted([ int(p.split('.')[0].split('-')[-1]) for p in posts ])
-    return sorted_oids[-1] + 1
+class ImageTooLarge(ValueError):
+    """
+    Raised when an image has more pixels than `MAX_PIXELS`.
+    """
+
+
+def get_new_oid():
+    """
+    Allocates the OID for a new post. In a dry run, the OID isn't used up.
+    """
+
+    return post_index.peek() if DRY else post_index.allocate()
 
 
 def get_img_date(img):
@@ -81,50 +357,43 @@ def get_img_date(img):
     A date string or None, if the date can't be retrieved.
     """
 
-    # Certain image files do not contain EXIF data, and `_getexif()` calls
-    # raise an `AttributeError`. If this happens, just return an empty dict.
+    # Certain image files do not contain EXIF data, and `getexif()` calls
+    # raise an `AttributeError`. If this happens, there's no date.
     try:
-        img_exif = img.getexif()
-        md = {
-            EXIF_TAGS[k]: v for k, v in img_exif.items() if k in EXIF_TAGS
-        }
+        taken = img.getexif().get(DATETIME)
     except AttributeError:
-        md = {}
+        taken = None
 
-    if 'DateTime' in md:
-        ds = md['DateTime'].split(' ')[0].replace(':', '-')
+    # Malformed tags can hold bytes or numbers rather than a string.
+    if isinstance(taken, str) and taken:
+        ds = taken.split(' ')[0].replace(':', '-')
         dt = datetime.date.fromisoformat(ds)
         return dt.strftime('%B %-d, %Y')
 
 
-def delete(*paths):
+def original_key(name):
     """
-    Gathers its arguments into a list of file paths and deletes them.
+    Returns the key an image's original file is archived under.
     """
 
-    for path in paths:
-        logging.info('Deleting {0}'.format(path))
-        if not DRY:
-            remove(path)
+    return 'originals/%s' % name
 
 
-def upload_files(*file_paths):
+def upload_file(key, body, content_type = 'image/jpeg', cache_control = None):
     """
-    Uploads files to the specified Amazon S3 bucket.
+    Uploads a file to the storage backend.
+
+    Parameters
+    ----------
+    key: The name of the file in the bucket.
+    body: A readable file object with the file's contents.
+    content_type: The file's content type.
+    cache_control: The file's Cache-Control header, if any.
     """
 
-    for path in file_paths:
-        file_name = basename(path)
-        logging.info('Uploading {0} to Amazon S3'.format(path))
-        if not DRY:
-            with open(path, 'rb') as f:
-                S3.put_object(
-                    Bucket = config['aws-bucket'],
-                    Key = file_name,
-                    Body = f,
-                    ACL = 'public-read',
-                    ContentType = 'image/jpeg',
-                )
+    logging.info('Uploading {0}'.format(key))
+    if not DRY:
+        storage.put(key, body, content_type, cache_control)
 
 
 def autolink_posts(text):
@@ -141,9 +410,113 @@ def autolink_posts(text):
     )
 
 
+def check_image(info):
+    """
+    Checks that an image can be processed, from its header alone.
+
+    Parameters
+    ----------
+    info: The image's header, from `probe`.
+
+    Raises
+    ------
+    `ImageTooLarge` if the image has more than `MAX_PIXELS` pixels.
+    """
+
+    width, height = info['width'], info['height']
+    if width * height > MAX_PIXELS:
+        raise ImageTooLarge('Image is too large ({0}x{1})'.format(width, height))
+
+
+def draft_image(img):
+    """
+    Asks the decoder of a not-yet-loaded image to decode it at a reduced scale,
+    as long as it stays comfortably larger than the largest resized image. Only
+    JPEG images support this; it's a no-op for other formats.
+
+    Parameters
+    ----------
+    img: A `PIL.Image` that hasn't been loaded yet.
+    """
+
+    width, height = img.size
+    scale = REDUCING_GAP * SIZES[-1] / max(width, height)
+    if scale < 1:
+        img.draft(None, (math.ceil(width * scale), math.ceil(height * scale)))
+
+
+def decoded_size(img):
+    """
+    Estimates the number of bytes it takes to decode an image, at the size its
+    decoder will decode it at.
+    """
+
+    width, height = img.size
+    if img.mode in ('1', 'L', 'P'):
+        per_pixel = 1
+    elif img.mode == 'I;16':
+        per_pixel = 2
+    else:
+        per_pixel = 4
+
+    # These modes have to be converted before they can be reduced, which
+    # takes another copy.
+    if img.mode in REDUCE_CONVERT_MODES:
+        per_pixel += 4
+
+    return width * height * per_pixel
+
+
+def decode_image(img):
+    """
+    Decodes an image at no more than the resolution the resized images need,
+    within the pixel and memory budgets.
+
+    JPEG images are decoded at a reduced scale (see `draft_image`). Other
+    formats can't be, so they're decoded in full and immediately shrunk with
+    `Image.reduce`, before anything else makes a copy of them. Either way, the
+    full-resolution bitmap exists only once, and only while its memory is
+    reserved from `decode_budget`.
+
+    Parameters
+    ----------
+    img: A `PIL.Image` that hasn't been loaded yet.
+
+    Returns
+    -------
+    The decoded `PIL.Image`, at least `REDUCING_GAP` times larger than the
+    largest resized image (unless the original is smaller). It keeps the
+    original's metadata, including its EXIF data.
+    """
+
+    width, height = img.size
+    check_image({ 'width': width, 'height': height })
+
+    draft_image(img)
+
+    with decode_budget.reserve(decoded_size(img)):
+        img.load()
+
+        factor = math.floor(max(img.size) / (REDUCING_GAP * SIZES[-1]))
+        if factor > 1:
+            if img.mode in REDUCE_CONVERT_MODES:
+                converted = img.convert('RGB')
+                img.close()
+                img = converted
+            reduced = img.reduce(factor)
+            img.close()
+            img = reduced
+
+    return img
+
+
 def resize_image(img):
     """
-    Resizes an image into four different sizes.
+    Resizes an image into each of `SIZES`.
+
+    The largest size is resampled from the original, using `Image.reduce` to
+    get most of the way there cheaply. Each smaller size is then resampled from
+    the next larger one, so the full-resolution image is only resampled once.
 
     Parameters
     ----------
@@ -151,48 +524,340 @@ def resize_image(img):
 
     Returns
     -------
-    A list of four resized `PIL.Image`s.
+    A list of resized `PIL.Image`s, from smallest to largest.
     """
 
     width, height = img.size
     larger_dimension = width if width > height else height
-    scales = [ x / larger_dimension for x in [ 320.0, 640.0, 960.0, 1280.0 ] ]
+    scales = [ x / larger_dimension for x in SIZES ]
     new_sizes = [ (round(width * s), round(height * s)) for s in scales ]
-    return [ img.resize(size, Image.Resampling.LANCZOS) for size in new_sizes ]
 
+    resized = []
+    source = img
+    for size in reversed(new_sizes):
+        source = source.resize(
+            size,
+            Image.Resampling.LANCZOS,
+            reducing_gap = REDUCING_GAP,
+        )
+        resized.insert(0, source)
+
+    return resized
+
+
+class SpooledBuffer(SpooledTemporaryFile):
+    """
+    A `SpooledTemporaryFile` that doesn't spill to disk just because someone
+    asked for its file descriptor. Pillow asks for one when saving, and falls
+    back to regular writes when there isn't one.
+    """
+
+    def fileno(self):
+        if not self._rolled:
+            raise io.UnsupportedOperation('fileno')
+        return super().fileno()
+
+
+def encode_image(img, format = 'jpeg'):
+    """
+    Encodes a resized image.
+
+    Parameters
+    ----------
+    img: A `PIL.Image` to encode.
+    format: The name of the format to encode it in (see `FORMATS`).
+
+    Returns
+    -------
+    A file object, rewound to the start, containing the encoded image. It's
+    held in memory unless it's larger than `SPOOL_THRESHOLD`.
+    """
+
+    buffer = SpooledBuffer(max_size = SPOOL_THRESHOLD)
+    try:
+        img.save(buffer, **FORMATS[format]['options'])
+        if format == 'jpeg' and JPEG_TARGET_SSIM:
+            buffer = encode_targeted_jpeg(img, buffer)
+    except Exception:
+        buffer.close()
+        raise
+
+    buffer.seek(0)
+    return buffer
+
+
+def encode_targeted_jpeg(img, baseline):
+    """
+    Encodes an image as a JPEG at the quality and chroma subsampling that meet
+    `JPEG_TARGET_SSIM`, and logs how many bytes that saves.
+
+    Parameters
+    ----------
+    img: A `PIL.Image` to encode.
+    baseline: A file object holding the image encoded with the default
+    settings.
+
+    Returns
+    -------
+    Whichever of the targeted encode and the baseline is smaller. The other is
+    closed.
+    """
+
+    settings = choose_jpeg_settings(
+        img,
+        JPEG_TARGET_SSIM,
+        min_quality = JPEG_MIN_QUALITY,
+        max_quality = JPEG_MAX_QUALITY,
+        time_budget = JPEG_TIME_BUDGET,
+    )
+    if settings is None:
+        logging.info('Ran out of time choosing JPEG quality for {0}x{1} image'.format(*img.size))
+        return baseline
+
+    buffer = SpooledBuffer(max_size = SPOOL_THRESHOLD)
+    try:
+        img.save(buffer, **dict(FORMATS['jpeg']['options'], **settings))
+    except Exception:
+        buffer.close()
+        raise
+
+    saved = baseline.tell() - buffer.tell()
+    logging.info('Encoded {0}x{1} JPEG at quality {2}, subsampling {3}: {4} bytes ({5} saved)'.format(
+        img.size[0], img.size[1], settings['quality'], settings['subsampling'], buffer.tell(), saved,
+    ))
+
+    # Never do worse than the default settings.
+    if saved <= 0:
+        buffer.close()
+        return baseline
+
+    bytes_saved.inc(saved)
+    baseline.close()
+    return buffer
 
-def create_img_tag(oid, widths, summary):
+
+def hashed_key(file_name, buffer):
     """
-    Creates an HTML <img> tag for an image post. Uses the OID, widths, and
-    optional summary for the different components of the tag.
+    Returns the key to upload a file as with `HASHED_KEYS`: its name, followed
+    by the first 16 hex digits of the SHA-256 of its contents. For example,
+    12-640.jpg becomes 12-640-0123456789abcdef.jpg.
 
     Parameters
     ----------
-    oid: A number representing the OID of the <img>'s associated post.
+    file_name: The file's name.
+    buffer: A file object with the file's contents. It's rewound afterwards.
+    """
+
+    digest = hashlib.sha256()
+    buffer.seek(0)
+    for chunk in iter(lambda: buffer.read(64 * 1024), b''):
+        digest.update(chunk)
+    buffer.seek(0)
+
+    name, extension = file_name.rsplit('.', 1)
+    return '%s-%s.%s' % (name, digest.hexdigest()[:16], extension)
+
+
+def encode_and_upload(resized, names, formats = ('jpeg',), skip_existing = False):
+    """
+    Encodes resized images in one or more formats and uploads them, then
+    closes the images. Encoding and uploading overlap: each file starts
+    uploading as soon as it's encoded, while the rest are still being encoded.
+    Pillow releases the GIL while encoding, so the encodes run in parallel too.
+
+    With `HASHED_KEYS`, each file is uploaded under a key that includes a hash
+    of its contents (see `hashed_key`), with a Cache-Control header that lets
+    it be cached forever.
+
+    If any of the encodes or uploads failed, the first error is raised once
+    everything has finished.
+
+    Parameters
+    ----------
+    resized: A list of `PIL.Image`s to encode.
+    names: A list of names to upload each image as, without an extension.
+    formats: The names of the formats to encode each image in.
+    skip_existing: Whether to leave files that are already in storage alone.
+    Without `HASHED_KEYS`, they aren't even encoded.
+
+    Returns
+    -------
+    A dictionary mapping the name of each file ({name}.{extension}) to the
+    key it was uploaded as, in order.
+    """
+
+    errors = []
+    tasks = [
+        (img, format, '%s.%s' % (name, FORMATS[format]['extension']))
+        for img, name in zip(resized, names)
+        for format in formats
+    ]
+    keys = {}
+
+    if skip_existing and not HASHED_KEYS:
+        for _, _, file_name in tasks:
+            if storage.exists(file_name):
+                keys[file_name] = file_name
+        tasks_to_encode = [ t for t in tasks if t[2] not in keys ]
+    else:
+        tasks_to_encode = tasks
+
+    def encode(img, format):
+        with stage('encode'):
+            return encode_image(img, format)
+
+    def upload(file_name, format, buffer):
+        with buffer:
+            size = buffer.seek(0, io.SEEK_END)
+            buffer.seek(0)
+            with stage('upload'):
+                if HASHED_KEYS:
+                    key = hashed_key(file_name, buffer)
+                    if skip_existing and storage.exists(key):
+                        keys[file_name] = key
+                        return
+                    upload_file(
+                        key,
+                        buffer,
+                        FORMATS[format]['content_type'],
+                        cache_control = IMMUTABLE_CACHE_CONTROL,
+                    )
+                else:
+                    key = file_name
+                    upload_file(key, buffer, FORMATS[format]['content_type'])
+            bytes_uploaded.inc(size)
+            keys[file_name] = key
+
+    with ThreadPoolExecutor(max(len(tasks_to_encode), 1)) as encoders, \
+         ThreadPoolExecutor(max(len(tasks_to_encode), 1)) as uploaders:
+
+        encodes = {
+            encoders.submit(encode, img, format): (key, format)
+            for img, format, key in tasks_to_encode
+        }
+
+        uploads = []
+        for future in as_completed(encodes):
+            if future.exception() is not None:
+                errors.append(future.exception())
+                continue
+            key, format = encodes[future]
+            uploads.append(uploaders.submit(upload, key, format, future.result()))
+
+        for img in resized:
+            img.close()
+
+        errors.extend(f.exception() for f in uploads if f.exception() is not None)
+
+    for e in errors[1:]:
+        logging.error('Failed to encode or upload image: %s' % e)
+    if errors:
+        raise errors[0]
+
+    return { file_name: keys[file_name] for _, _, file_name in tasks }
+
+
+def create_img_tag(name, widths, summary, formats = (), keys = None):
+    """
+    Creates an HTML <img> tag for an image post. Uses the name, widths, and
+    optional summary for the different components of the tag. If the image
+    was also encoded in other formats, the <img> is wrapped in a <picture>
+    with a <source> for each of them, and the JPEG is the fallback.
+
+    Parameters
+    ----------
+    name: The name the image's files were uploaded under. This is the OID of
+    the <img>'s associated post, followed by the image's number for all but
+    the first image in a gallery post.
     widths: A list of numbers representing each width of the image.
     summary: A summary image that, if truthy, will cause an "alt" attribute to
     be added to the tag.
+    formats: The names of the other formats the image was encoded in, in
+    order of preference.
+    keys: A dictionary mapping file names ({name}-{width}.{extension}) to the
+    keys they were uploaded as, from `encode_and_upload`. By default, files
+    are assumed to have been uploaded under their names.
 
     Returns
     -------
-    A string <img> tag.
+    A string <img> tag, or <picture> tag.
     """
 
     assets_url = '{{ site.assets_url }}'
+    sizes = 'sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" '
+    keys = keys or {}
+
+    def url(width, extension):
+        file_name = '%s-%d.%s' % (name, width, extension)
+        return '%s/%s' % (assets_url, keys.get(file_name, file_name))
+
+    def srcset(extension):
+        return ', '.join('%s %dw' % (url(w, extension), w) for w in widths)
 
     # Use the second-to-smallest file (widths[1]) as the default.
-    src = '%s/%d-%d.jpg' % (assets_url, oid, widths[1])
-    srcset = [ '%s/%d-%d.jpg %dw' % (assets_url, oid, w, w) for w in widths ]
+    src = url(widths[min(1, len(widths) - 1)], 'jpg')
     img_tag = '<img '
     img_tag += 'alt="{{ page.summary }}" ' if summary else ''
-    img_tag += 'sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" '
+    img_tag += sizes
     img_tag += 'src="{0}" '.format(src)
-    img_tag += 'srcset="{0}, {1}, {2}, {3}" '.format(*srcset)
+    img_tag += 'srcset="{0}" '.format(srcset('jpg'))
     img_tag += '/>'
 
-    return img_tag
+    if not formats:
+        return img_tag
+
+    picture_tag = '<picture>'
+    for format in formats:
+        picture_tag += '<source '
+        picture_tag += 'type="{0}" '.format(FORMATS[format]['content_type'])
+        picture_tag += sizes
+        picture_tag += 'srcset="{0}" '.format(srcset(FORMATS[format]['extension']))
+        picture_tag += '/>'
+    picture_tag += img_tag + '</picture>'
+
+    return picture_tag
+
+def resize_and_upload(img, name, skip_existing = False):
+    """
+    Makes the resized images for a decoded image and uploads them, then
+    closes the image.
+
+    Parameters
+    ----------
+    img: A decoded `PIL.Image`.
+    name: The name to upload the image's files under.
+    skip_existing: Whether to leave files that are already in storage alone
+    (see `encode_and_upload`).
+
+    Returns
+    -------
+    A list of the widths of the resized images, and a dictionary mapping the
+    names of their files to the keys they were uploaded as.
+    """
+
+    with stage('transpose'):
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+    logging.info('Resizing image #%s' % name)
+
+    # 1. Get list of resized `Image`s.
+    with stage('resize'):
+        resized = resize_image(img)
+
+    # 2. Make a list of their widths.
+    widths = [ r.size[0] for r in resized ]
+
+    # 3. Encode them and upload them as {name}-{width}.jpg (or under hashed
+    # keys), and in any extra formats.
+    names = [ '%s-%d' % (name, w) for w in widths ]
+    keys = encode_and_upload(resized, names, [ 'jpeg' ] + EXTRA_FORMATS, skip_existing)
+
+    img.close()
+
+    return widths, keys
 
-def process_image(post_object, img_obj):
+
+def process_image(post_object, img_obj, name = None):
     """
     Processes an uploaded image file, extract information from it to generate
     a post.
@@ -201,47 +866,92 @@ def process_image(post_object, img_obj):
     ----------
     post_object: A dictionary of post data that will be updated.
     img_obj: A bottle FileUpload object representing the uploaded file.
+    name: The name to upload the image's files under. Defaults to the OID.
     """
 
     oid = post_object['oid']
+    name = oid if name is None else name
+
+    logging.info('Making image post #%s' % name)
 
-    logging.info('Making image post #%s' % oid)
+    # Read the image's header first, to turn away images that can't be
+    # processed before any pixels are decoded, and so that only the decoder
+    # for its format is tried.
+    with stage('decode'):
+        info = probe(img_obj)
+        check_image(info)
+        img = Image.open(img_obj, formats = [ info['format'] ])
+        content_type = img.get_format_mimetype()
+        img = decode_image(img)
 
-    img = Image.open(img_obj)
+    if ARCHIVE_ORIGINALS:
+        img_obj.seek(0)
+        with stage('upload'):
+            upload_file(original_key(name), img_obj, content_type or 'application/octet-stream')
 
     # Attempt to extract the date the image was captured from the metadata.
     # This must be done BEFORE the next step, which seems to remove EXIF data.
-    date = get_img_date(img)
+    with stage('exif'):
+        date = get_img_date(img)
     if date is not None:
         post_object['taken'] = date
 
-    img = ImageOps.exif_transpose(img).convert('RGB')
-
-    logging.info('Resizing image #%s' % oid)
+    widths, keys = resize_and_upload(img, name)
 
-    # 1. Get list of resized `Image`s.
-    resized = resize_image(img)
+    # Use the largest of the resized images for the OpenGraph image meta tag.
+    post_object['og_image'] = keys['%s-%d.jpg' % (name, max(widths))]
+    post_object['variants'] = list(keys.values())
+    post_object['content'] = create_img_tag(
+        name,
+        widths,
+        post_object['summary'],
+        EXTRA_FORMATS,
+        keys,
+    )
 
-    # 2. Make a list of their widths.
-    widths = [ r.size[0] for r in resized ]
 
-    # 3. Save them as {oid}-{width}.jpg in a temporary location.
-    new_files = [ join(TEMP_PATH, '%d-%d.jpg' % (oid, w)) for w in widths ]
-    for r, f in zip(resized, new_files):
-        r.save(f, optimize = True, progressive = True)
-        r.close()
+def process_gallery(post_object, img_objs):
+    """
+    Processes one or more uploaded image files in parallel to generate a post.
+    A single image makes a regular image post. More than one makes a gallery
+    post, with one figure per image, in the order they were attached.
 
-    img.close()
+    The first image is uploaded under the post's OID, like a regular image
+    post, and the rest under {oid}-{n}, where n counts from 2.
 
-    # Upload resized images to S3.
-    upload_files(*new_files)
+    Parameters
+    ----------
+    post_object: A dictionary of post data that will be updated.
+    img_objs: A list of file objects, one for each uploaded image.
+    """
 
-    # Clean up temporary files.
-    delete(*new_files)
+    if len(img_objs) == 1:
+        process_image(post_object, img_objs[0])
+        return
 
-    # Use the largest of the resized images for the OpenGraph image meta tag.
-    post_object['og_image'] = '%d-%d.jpg' % (oid, max(widths))
-    post_object['content'] = create_img_tag(oid, widths, post_object['summary'])
+    oid = post_object['oid']
+    images = [ { 'oid': oid, 'summary': post_object['summary'] } for _ in img_objs ]
+    names = [ oid ] + [ '%d-%d' % (oid, n) for n in range(2, len(img_objs) + 1) ]
+
+    with ThreadPoolExecutor(min(len(img_objs), GALLERY_WORKERS)) as pool:
+        futures = [
+            pool.submit(process_image, image, img_obj, name)
+            for image, img_obj, name in zip(images, img_objs, names)
+        ]
+        errors = [ f.exception() for f in futures if f.exception() is not None ]
+
+    for e in errors[1:]:
+        logging.error('Failed to process image: %s' % e)
+    if errors:
+        raise errors[0]
+
+    # The post takes its date and OpenGraph image from the first image.
+    dates = [ image['taken'] for image in images if 'taken' in image ]
+    if dates:
+        post_object['taken'] = dates[0]
+    post_object['og_image'] = images[0]['og_image']
+    post_object['variants'] = [ v for image in images for v in image['variants'] ]
+    post_object['figures'] = [ (image['og_image'], image['content']) for image in images ]
 
 
 def create_post(post_object):
@@ -253,6 +963,10 @@ def create_post(post_object):
     ----------
     post_object: A dictionary of data for the post. Includes things like OID,
     content, summary, date, etc.
+
+    Returns
+    -------
+    The path of the new post, relative to the blog repository.
     """
 
     oid = post_object['oid']
@@ -271,11 +985,21 @@ def create_post(post_object):
     if 'taken' in post_object:
         lines.append('taken: %s' % post_object['taken'])
 
+    lines.extend([ '---', '' ])
+
+    # Gallery posts have one figure per image, all of which share the caption
+    # in the last figure.
+    figures = post_object.get('figures') or [ (None, post_object['content']) ]
+    for i, (og_image, content) in enumerate(figures):
+        data_src = '{{ page.og_image }}' if i == 0 else og_image
+        if i > 0:
+            lines.append('</figure>')
+        lines.extend([
+            '<figure class="post" data-src="{{ site.assets_url }}/%s" data-sub-html="#caption-%s">' % (data_src, oid),
+            content,
+        ])
+
     lines.extend([
-        '---',
-        '',
-        '<figure class="post" data-src="{{ site.assets_url }}/{{ page.og_image }}" data-sub-html="#caption-%s">' % oid,
-        post_object['content'],
         '<figcaption id="caption-%s">' % oid,
         '<time>{{ page.taken | default: page.date | date: "%B %-d, %Y" }}</time>',
     ])
@@ -289,68 +1013,474 @@ def create_post(post_object):
 
     logging.debug(contents)
 
-    file_name = join(blog_path, '_posts/{0}-{1}.md'.format(str(datetime.date.today()), oid))
+    date = str(datetime.date.today())
+    file_name = '{0}-{1}.md'.format(date, oid)
     if not DRY:
-        with open(file_name, 'w') as f:
-            f.write(contents)
-
-def update_site(new_post_number):
+        with stage('write_post'), post_index.record(
+            oid,
+            file_name,
+            date,
+            taken = post_object.get('taken'),
+            summary = post_object['summary'],
+        ):
+            with open(join(blog_path, '_posts', file_name), 'w') as f:
+                f.write(contents)
+
+    return join('_posts', file_name)
+
+def update_site(posts, message = None):
     """
-    Adds a new post and pushes the site to GitHub, where it will be republished.
+    Commits new posts and pushes the site to GitHub, where it will be
+    republished. All of the posts go into a single commit.
 
     Parameters
     ----------
-    new_post_number: The OID/number of the new post (used for logging and for
-    generating the commit message.)
+    posts: A list of (OID, path) pairs for the new posts. The OIDs are used for
+    logging and for generating the commit message.
+    message: The commit message. Defaults to one listing the posts' OIDs.
+
+    Returns
+    -------
+    A dictionary mapping the (OID, path) pairs of any posts that couldn't be
+    added to the commit to the errors that stopped them.
     """
 
-    logging.info('Uploading blog post #{0}'.format(new_post_number))
+    errors = {}
+    oids = ', '.join(str(oid) for oid, _ in posts)
+
+    logging.info('Uploading blog posts #{0}'.format(oids))
 
     if not DRY:
-        with pushd(uploader_dirpath):
-            git.add('_posts')
-            git.commit('-m', 'Add post {0}'.format(new_post_number))
-            git.push('origin', 'master')
+        with sync.lock:
+            # Git won't rebase with changes staged, so catch up first.
+            with stage('sync'):
+                sync.update()
+
+            for oid, path in posts:
+                try:
+                    sync.git.add(path)
+                except Exception as e:
+                    logging.error('Failed to add post #{0}: {1}'.format(oid, e))
+                    errors[(oid, path)] = e
+
+            added = [ (oid, path) for oid, path in posts if (oid, path) not in errors ]
+            if added:
+                if message is None and len(added) == 1:
+                    message = 'Add post {0}'.format(added[0][0])
+                elif message is None:
+                    message = 'Add posts {0}'.format(', '.join(str(oid) for oid, _ in added))
+
+                # If the commit or push fails, leave nothing staged or
+                # committed behind, or every later update would fail too.
+                try:
+                    with stage('commit'):
+                        sync.git.commit('-m', message)
+                except Exception:
+                    sync.git.reset('--', *[ path for _, path in added ])
+                    raise
+                try:
+                    with stage('push'):
+                        sync.push()
+                except Exception:
+                    sync.git.reset('HEAD~1')
+                    raise
+
+    return errors
+
+
+committer = CommitBatcher(
+    update_site,
+    window = config.getfloat('commit-window', 5.0),
+    max_batch = config.getint('commit-max-batch', 20),
+)
+
+
+def discard_post(oid, path, future):
+    """
+    Deletes a post that failed to be committed or pushed, once its batch has
+    failed, so that it isn't counted as published or left behind untracked.
+    If its upload is retried, it's written again under a new OID.
+    """
+
+    if future.exception() is not None and not DRY:
+        logging.info('Discarding post #{0}'.format(oid))
+        with sync.lock:
+            post_index.remove(oid, basename(path))
+
+
+def record_delivery(key, post_object, future):
+    """
+    Records the outcome of publishing an upload in the dedup cache, once its
+    post has been pushed (or has failed to be).
+    """
+
+    if future.exception() is None:
+        dedup.finish(key, post_object['oid'], post_object['variants'])
+    else:
+        dedup.release(key)
+
+
+def publish(job):
+    """
+    Processes a spooled upload job: makes a new image or gallery post from its
+    attachments and queues it to be published to the site.
+
+    Parameters
+    ----------
+    job: A job dictionary from the upload queue.
+
+    Returns
+    -------
+    A `Future` that resolves once the post has been pushed.
+    """
+
+    # Jobs queued by a profiled request are profiled too. This covers the
+    # image processing, but not the commit and push, which happen later.
+    if job.get('profile'):
+        profile = profiler.profile('job-{0}'.format(job['id']))
+    else:
+        profile = nullcontext()
+
+    with profile:
+        key = job.get('key')
+        post_object = {}
+
+        # If anything fails before the post is queued to be committed, the
+        # delivery is forgotten, so that a redelivery of it is published.
+        try:
+            # Pick up any posts that have been fetched from elsewhere before
+            # choosing an OID. This doesn't touch the network.
+            if not DRY:
+                with stage('sync'):
+                    sync.update()
+
+            new_oid = get_new_oid()
+            post_object['oid'] = new_oid
+            post_object['summary'] = html.escape(job['subject'])
+
+            file_objects = [ open(join(job['path'], f), 'rb') for f in job['files'] ]
+            try:
+                process_gallery(post_object, file_objects)
+            finally:
+                for f in file_objects:
+                    f.close()
+
+            with sync.lock:
+                path = create_post(post_object)
+
+            future = committer.submit((new_oid, path))
+        except Exception:
+            if key:
+                dedup.release(key)
+            raise
+
+    future.add_done_callback(lambda f: discard_post(new_oid, path, f))
+    if key:
+        future.add_done_callback(lambda f: record_delivery(key, post_object, f))
+
+    return future
+
+
+jobs = JobQueue(
+    config.get('spool-path', rel('spool')),
+    publish,
+    workers = config.getint('queue-workers', 1),
+    max_depth = config.getint('queue-max-depth', 100),
+)
+
+
+def ingest_upload(spool, reader):
+    """
+    Reads the fields of an upload request and writes its attachments to the
+    upload queue as they're read. Attachments that aren't images (such as
+    vCards or PDFs) are skipped. Reading stops as soon as the sender turns
+    out not to be authorized, or an image turns out to be too large to
+    process (see `check_image`).
+
+    Parameters
+    ----------
+    spool: A `Spool` to write attachments to.
+    reader: A `MultipartReader` for the request body.
+
+    Returns
+    -------
+    A dictionary of the request's fields, and a dictionary mapping the names
+    of the image attachments to SHA-256 hex digests of their content. Raises
+    `UnsupportedImage` if there were attachments, but none were images.
+    """
+
+    fields = {}
+    digests = {}
+    skipped = []
+
+    for part in reader:
+        if part.name and re.fullmatch(r'attachment\d+', part.name):
+            digest = hashlib.sha256()
+            size = 0
+            with spool.open(part.name) as out:
+                for chunk in part:
+                    size += len(chunk)
+                    if size > MAX_ATTACHMENT_SIZE:
+                        raise RequestTooLarge('{0} is too large'.format(part.name))
+                    digest.update(chunk)
+                    out.write(chunk)
+            bytes_received.inc(size)
+
+            # Leave out attachments that aren't images, and turn away images
+            # that can't be processed now, rather than when their job fails.
+            try:
+                info = probe(join(spool.path, part.name))
+            except UnsupportedImage as e:
+                logging.info('Skipping {0}: {1}'.format(part.name, e))
+                spool.discard(part.name)
+                skipped.append(part.name)
+                continue
+            try:
+                check_image(info)
+            except ImageTooLarge as e:
+                raise ImageTooLarge('{0}: {1}'.format(part.name, e)) from e
+
+            digests[part.name] = digest.hexdigest()
+
+        elif part.name and part.filename is None:
+            fields[part.name] = part.read(MAX_FIELD_SIZE).decode('utf-8', 'replace')
+            if part.name == 'from' and not is_authorized_sender(fields['from']):
+                raise PermissionError('Unauthorized sender')
+
+    if skipped and not digests:
+        raise UnsupportedImage('No image attachments ({0})'.format(', '.join(skipped)))
+
+    return fields, digests
+
+
+def queue_full(e):
+    logging.warning(e)
+    raise HTTPError(
+        503,
+        str(e),
+        **{ 'Retry-After': config.get('queue-retry-after', '30') },
+    )
 
 
 @post('/upload')
+@instrumented
+@profiled
 def upload():
 
+    # Everything that can be checked from the request's headers is checked
+    # before any of its body is read.
+
     if request.auth is None:
         logging.info('No webhook request auth provided')
         abort(401)
 
-    if not is_authorized(request):
+    if not is_authorized_user(request.auth):
         logging.info('Unauthorized request to /upload')
         abort(403)
 
-    # Ensure the local blog copy is up to date.
-    with pushd(uploader_dirpath):
-        git.pull('origin', 'master') if not DRY else None
+    length = request.content_length
+    if length < 0:
+        abort(411)
+    if length > MAX_REQUEST_SIZE:
+        logging.info('Request to /upload is too large ({0} bytes)'.format(length))
+        abort(413)
 
+    # Bottle lowercases `request.content_type`, but boundaries are
+    # case-sensitive.
     try:
+        boundary = parse_content_type(request.environ.get('CONTENT_TYPE'))
+    except MultipartError as e:
+        logging.info(e)
+        abort(400)
 
-        post_object = {}
+    try:
+        spool = jobs.spool()
+    except QueueFull as e:
+        queue_full(e)
 
-        new_oid = get_new_oid()
-        post_object['oid'] = new_oid
+    submitted = False
 
-        summary = request.params.get('subject', '')
-        post_object['summary'] = html.escape(summary)
+    try:
+        reader = MultipartReader(
+            request.environ['wsgi.input'],
+            boundary,
+            length,
+            chunk_size = INGEST_CHUNK_SIZE,
+        )
+        with stage('receive'):
+            fields, digests = ingest_upload(spool, reader)
+
+        if not is_authorized_sender(fields.get('from')):
+            raise PermissionError('Unauthorized sender')
+
+        # SendGrid sends attachments as attachment1, attachment2, etc.
+        attachments = sorted(digests, key = lambda k: int(k[len('attachment'):]))
+        if not attachments:
+            logging.info('No attachments in request to /upload')
+            abort(400)
+
+        # SendGrid redelivers emails when we're slow to respond. Recognize
+        # repeats by their content and acknowledge them without doing anything.
+        subject = fields.get('subject', '')
+        key = content_key(subject, [ digests[k] for k in attachments ])
+        original = dedup.claim(key)
+        if original is not None:
+            logging.info('Ignoring repeat delivery of post #{0}'.format(original['oid']))
+            return
+
+        # Profiled uploads are profiled again when they're published.
+        data = { 'subject': subject, 'key': key }
+        if request.environ.get('uploader.profile'):
+            data['profile'] = True
+
+        try:
+            jobs.submit(spool, data, attachments)
+        except Exception:
+            dedup.release(key)
+            raise
+        submitted = True
+
+    except HTTPResponse:
+        raise
+    except PermissionError:
+        logging.info('Unauthorized request to /upload')
+        abort(403)
+    except (RequestTooLarge, ImageTooLarge) as e:
+        logging.info(e)
+        abort(413)
+    except UnsupportedImage as e:
+        logging.info(e)
+        abort(415)
+    except MultipartError as e:
+        logging.info(e)
+        abort(400)
+    except QueueFull as e:
+        queue_full(e)
+    except Exception as e:
+        logging.exception(e)
+        abort(500)
+    finally:
+        if not submitted:
+            jobs.discard(spool)
 
-        file_object = request.files.attachment1.file
+    response.status = 202
 
-        process_image(post_object, file_object)
 
-        create_post(post_object)
+@get('/queue')
+def queue_depth():
+    return jobs.depth()
 
-        update_site(new_oid)
 
-    except Exception as e:
-        logging.exception(e)
-        abort(500)
+@registry.on_collect
+def collect_queue_depth():
+    for state, count in jobs.depth().items():
+        queued_jobs.set(count, state = state)
+
+
+@get('/assets/<key:path>')
+def get_asset(key):
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+    asset = static_file(key, root = storage.path)
+    if HASHED_KEYS and asset.status_code == 200:
+        asset.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+    return asset
+
+
+@get('/metrics')
+def get_metrics():
+    response.content_type = METRICS_CONTENT_TYPE
+    return registry.render()
+
+
+app = default_app()
+
+services_lock = threading.Lock()
+services_pid = None
+
+def start_services():
+    """
+    Starts fetching the blog repository and working through the upload queue
+    in this process, unless it already has. Threads don't survive a fork, so
+    each server process starts its own, when it serves its first request if
+    not before.
+
+    Interrupted jobs aren't recovered here; see `JobQueue.start`.
+    """
+
+    global services_pid
+    with services_lock:
+        if services_pid == getpid():
+            return
+        if not DRY:
+            sync.start()
+        jobs.start(recover = False)
+        services_pid = getpid()
+
+
+@hook('before_request')
+def ensure_services():
+    start_services()
+
+
+def stop_services():
+    """
+    Stops this process's services, letting the upload workers finish their
+    current jobs and then publishing the posts waiting to be committed right
+    away, rather than leaving them to be written again under new OIDs when
+    the jobs are recovered.
+    """
+
+    global services_pid
+    with services_lock:
+        if services_pid != getpid():
+            return
+        jobs.stop()
+        committer.stop()
+        if not DRY:
+            sync.stop()
+        services_pid = None
+
+
+def handle_sigterm(signum, frame):
+    logging.info('Stopping server')
+    stop_services()
+    sys.exit(0)
+
+
+class ThreadedServer(ServerAdapter):
+    """
+    Bottle's default wsgiref server, but handling each request on a thread of
+    its own, so that a slow upload doesn't hold up other requests.
+    """
+
+    def run(self, app):
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        make_server(self.host, int(self.port), app, Server).serve_forever()
 
 
 if __name__ == '__main__':
     logging.info('Starting server')
-    run(host = config.get('host', 'localhost'), port = config.get('port', 8080))
+
+    # Recover interrupted jobs once, before any worker process starts.
+    jobs.recover()
+
+    server = config.get('server', 'threaded')
+    options = {}
+    if server == 'gunicorn':
+        options['workers'] = config.getint('workers', 1)
+        options['post_fork'] = lambda server, worker: start_services()
+        options['worker_exit'] = lambda server, worker: stop_services()
+    else:
+        start_services()
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    run(
+        app,
+        server = ThreadedServer if server == 'threaded' else server,
+        host = config.get('host', 'localhost'),
+        port = config.get('port', 8080),
+        **options,
+    )
@@ -0,0 +1,209 @@
+import io
+import threading
+from os import getpid, makedirs, remove, replace, walk
+from os.path import dirname, exists, join, normpath, relpath, sep
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+class S3Storage:
+    """
+    Stores files in an Amazon S3 bucket.
+
+    Small files are uploaded with a single request. Files larger than
+    `multipart_threshold` are uploaded in parts, several at a time. The
+    connection pool is sized for `max_connections` concurrent requests, so
+    that uploading several files at once doesn't wait on connections.
+
+    Clients can be shared between threads, but not across a fork, so each
+    process makes its own.
+
+    Parameters
+    ----------
+    bucket: The name of the bucket.
+    access_key_id, secret_access_key: AWS credentials.
+    acl: The canned ACL to give each file.
+    max_connections: The size of the connection pool.
+    multipart_threshold: Files larger than this many bytes are uploaded in
+    parts.
+    multipart_chunksize: The size of each part, in bytes.
+    max_concurrency: The number of parts of a file uploaded at once.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        access_key_id = None,
+        secret_access_key = None,
+        acl = 'public-read',
+        max_connections = 20,
+        multipart_threshold = 8 * 1024 * 1024,
+        multipart_chunksize = 8 * 1024 * 1024,
+        max_concurrency = 4,
+    ):
+        self.bucket = bucket
+        self.acl = acl
+        self.max_connections = max_connections
+        self.transfer_config = TransferConfig(
+            multipart_threshold = multipart_threshold,
+            multipart_chunksize = multipart_chunksize,
+            max_concurrency = max_concurrency,
+        )
+
+        self._credentials = {
+            'aws_access_key_id': access_key_id,
+            'aws_secret_access_key': secret_access_key,
+        }
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            pid = getpid()
+            if pid not in self._clients:
+                self._clients[pid] = boto3.client(
+                    's3',
+                    config = Config(max_pool_connections = self.max_connections),
+                    **self._credentials,
+                )
+            return self._clients[pid]
+
+    def put(self, key, body, content_type, cache_control = None):
+        """
+        Uploads a file.
+
+        Parameters
+        ----------
+        key: The name of the file.
+        body: A readable, seekable file object with the file's contents.
+        content_type: The file's content type.
+        cache_control: The value of the file's Cache-Control header, if any.
+        """
+
+        args = { 'ACL': self.acl, 'ContentType': content_type }
+        if cache_control:
+            args['CacheControl'] = cache_control
+
+        start = body.tell()
+        size = body.seek(0, io.SEEK_END) - start
+        body.seek(start)
+
+        if size <= self.transfer_config.multipart_threshold:
+            self.client.put_object(Bucket = self.bucket, Key = key, Body = body, **args)
+        else:
+            self.client.upload_fileobj(
+                body,
+                self.bucket,
+                key,
+                ExtraArgs = args,
+                Config = self.transfer_config,
+            )
+
+    def get(self, key):
+        """
+        Downloads a file.
+
+        Returns
+        -------
+        A readable file object with the file's contents. Raises
+        `FileNotFoundError` if there's no such file.
+        """
+
+        try:
+            return self.client.get_object(Bucket = self.bucket, Key = key)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    def exists(self, key):
+        """
+        Returns whether a file exists.
+        """
+
+        try:
+            self.client.head_object(Bucket = self.bucket, Key = key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        """
+        Deletes a file, if it exists.
+        """
+
+        self.client.delete_object(Bucket = self.bucket, Key = key)
+
+    def list(self, prefix = ''):
+        """
+        Yields the names of the files whose names start with `prefix`.
+        """
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket = self.bucket, Prefix = prefix):
+            for item in page.get('Contents', []):
+                yield item['Key']
+
+
+class LocalStorage:
+    """
+    Stores files in a local directory, for running the pipeline offline or
+    serving assets from disk. Files are written to a temporary file first and
+    renamed into place, so they never appear half-written.
+
+    Content types and Cache-Control headers aren't stored; whatever serves the
+    directory decides them.
+
+    Parameters
+    ----------
+    path: The directory to store files in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key):
+        path = normpath(join(self.path, key))
+        if not path.startswith(normpath(self.path) + sep):
+            raise ValueError('Invalid key: {0}'.format(key))
+        return path
+
+    def put(self, key, body, content_type = None, cache_control = None):
+        path = self._path(key)
+        makedirs(dirname(path), exist_ok = True)
+        with NamedTemporaryFile(dir = dirname(path), prefix = '.', suffix = '.tmp', delete = False) as f:
+            try:
+                copyfileobj(body, f)
+            except Exception:
+                f.close()
+                remove(f.name)
+                raise
+        replace(f.name, path)
+
+    def get(self, key):
+        return open(self._path(key), 'rb')
+
+    def exists(self, key):
+        return exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix = ''):
+        for root, _, files in walk(self.path):
+            for name in files:
+                # Skip files that are still being written.
+                if name.startswith('.'):
+                    continue
+                key = relpath(join(root, name), self.path).replace(sep, '/')
+                if key.startswith(prefix):
+                    yield key
@@ -0,0 +1,35 @@
+import os
+import unittest
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from bench import compare
+
+def tearDownModule():
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+class TestBench(unittest.TestCase):
+
+    def test_compare(self):
+        baseline = { 'cases': {
+            'a': { 'resize': 0.2, 'encode': 0.001, 'pipeline_rss_mb': 100.0, 'source_bytes': 10 },
+            'b': { 'resize': 0.2 },
+        } }
+        results = { 'cases': {
+            'a': { 'resize': 0.3, 'encode': 0.002, 'pipeline_rss_mb': 104.0, 'source_bytes': 20 },
+            'b': { 'resize': 0.21 },
+            'c': { 'resize': 9.0 },
+        } }
+
+        # Only changes that are both relatively and absolutely large count.
+        self.assertEqual(compare(baseline, results, 0.15), [ ('a', 'resize', 0.2, 0.3) ])
+
+        results['cases']['a']['pipeline_rss_mb'] = 130.0
+        self.assertEqual(compare(baseline, results, 0.15), [
+            ('a', 'resize', 0.2, 0.3),
+            ('a', 'pipeline_rss_mb', 100.0, 130.0),
+        ])
@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+from budget import MemoryBudget
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def test_reserve(self):
+        budget = MemoryBudget(100)
+        with budget.reserve(60):
+            self.assertEqual(budget.reserved, 60)
+        self.assertEqual(budget.reserved, 0)
+
+    def test_wait(self):
+        budget = MemoryBudget(100)
+        order = []
+
+        def task(name, size, hold):
+            with budget.reserve(size):
+                order.append(name)
+                time.sleep(hold)
+
+        first = threading.Thread(target = task, args = ('first', 60, 0.2))
+        first.start()
+        time.sleep(0.05)
+        second = threading.Thread(target = task, args = ('second', 60, 0))
+        second.start()
+        time.sleep(0.05)
+
+        # The second task waits for the first.
+        self.assertEqual(order, [ 'first' ])
+        first.join()
+        second.join()
+        self.assertEqual(order, [ 'first', 'second' ])
+
+    def test_larger_than_limit(self):
+        budget = MemoryBudget(100)
+        with budget.reserve(500):
+            self.assertEqual(budget.reserved, 500)
@@ -0,0 +1,49 @@
+import tempfile
+import unittest
+from os.path import join
+
+from dedup import DedupCache, content_key
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DedupCache(join(self.tmp.name, 'dedup.db'), max_entries = 2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_content_key(self):
+        key = content_key('Hi', [ 'abc', 'def' ])
+        self.assertEqual(key, content_key('Hi', [ 'abc', 'def' ]))
+        self.assertNotEqual(key, content_key('Ho', [ 'abc', 'def' ]))
+        self.assertNotEqual(key, content_key('Hi', [ 'abcd', 'ef' ]))
+        self.assertNotEqual(key, content_key('Hi', [ 'def', 'abc' ]))
+
+    def test_claim(self):
+        self.assertIsNone(self.cache.claim('a'))
+        self.assertEqual(self.cache.claim('a'), { 'oid': None, 'variants': None })
+
+        self.cache.finish('a', 5, [ '5-320.jpg' ])
+        self.assertEqual(self.cache.claim('a'), { 'oid': 5, 'variants': [ '5-320.jpg' ] })
+
+    def test_release(self):
+        self.cache.claim('a')
+        self.cache.release('a')
+        self.assertIsNone(self.cache.claim('a'))
+
+    def test_eviction(self):
+        for i, key in enumerate([ 'a', 'b', 'c' ]):
+            self.cache.claim(key)
+            self.cache.finish(key, i, [])
+
+        self.assertIsNone(self.cache.claim('a'))
+        self.assertEqual(self.cache.claim('c')['oid'], 2)
+
+    def test_pending_not_evicted(self):
+        self.cache.claim('pending')
+        for i, key in enumerate([ 'a', 'b', 'c' ]):
+            self.cache.claim(key)
+            self.cache.finish(key, i, [])
+
+        self.assertEqual(self.cache.claim('pending'), { 'oid': None, 'variants': None })
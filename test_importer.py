@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs
+from os.path import join
+from unittest.mock import MagicMock, patch
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from PIL import Image
+
+import server
+from importer import Checkpoint, capture_time, import_photos
+from postindex import PostIndex
+from storage import LocalStorage
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+def write_photo(path, taken = None):
+    exif = Image.Exif()
+    if taken:
+        exif[0x8769] = { 0x9003: taken }
+    Image.new('RGB', (64, 48)).save(path, format = 'JPEG', exif = exif)
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+        self.photos = join(self.tmp, 'photos')
+        self.blog = join(self.tmp, 'blog')
+        makedirs(self.photos)
+        makedirs(join(self.blog, '_posts'))
+
+        self.sync = MagicMock()
+        self.update_site = MagicMock(return_value = {})
+        for p in (
+            patch('server.DRY', None),
+            patch('server.blog_path', self.blog),
+            patch('server.post_index', PostIndex(join(self.tmp, 'posts.db'), join(self.blog, '_posts'))),
+            patch('server.storage', LocalStorage(join(self.tmp, 'assets'))),
+            patch('server.sync', self.sync),
+            patch('server.update_site', self.update_site),
+            # Run the pipeline on threads, so that it sees these patches.
+            patch('importer.ProcessPoolExecutor', ThreadPoolExecutor),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_capture_time(self):
+        write_photo(join(self.photos, 'a.jpg'), '2019:03:04 05:06:07')
+        write_photo(join(self.photos, 'b.jpg'))
+        with open(join(self.photos, 'c.txt'), 'w') as f:
+            f.write('not a photo')
+
+        self.assertEqual(capture_time(join(self.photos, 'a.jpg')), '2019:03:04 05:06:07')
+        self.assertEqual(capture_time(join(self.photos, 'b.jpg')), '')
+        self.assertIsNone(capture_time(join(self.photos, 'c.txt')))
+
+    def test_import_photos(self):
+        write_photo(join(self.photos, 'a.jpg'), '2021:06:05 14:03:01')
+        write_photo(join(self.photos, 'b.jpg'), '2019:01:01 00:00:00')
+        write_photo(join(self.photos, 'c.jpg'))
+        with open(join(self.photos, 'notes.txt'), 'w') as f:
+            f.write('not a photo')
+
+        checkpoint = Checkpoint(join(self.tmp, 'import.json'))
+        self.assertEqual(import_photos(self.photos, checkpoint, workers = 2), [])
+
+        # Photos are numbered in the order they were taken.
+        oids = { name: photo['oid'] for name, photo in checkpoint.photos.items() }
+        self.assertEqual(oids, { 'b.jpg': 0, 'a.jpg': 1, 'c.jpg': 2 })
+        self.assertEqual(len(listdir(join(self.blog, '_posts'))), 3)
+        self.assertIn('0-320.jpg', listdir(join(self.tmp, 'assets')))
+
+        # All of the posts are published in one commit.
+        self.update_site.assert_called_once()
+        posts, message = self.update_site.call_args[0]
+        self.assertEqual([ oid for oid, _ in posts ], [ 0, 1, 2 ])
+        self.assertEqual(message, 'Import posts 0 to 2')
+
+        with open(join(self.tmp, 'import.json')) as f:
+            saved = json.load(f)['photos']
+        self.assertTrue(all(photo['committed'] for photo in saved.values()))
+
+        # Running again only imports new photos.
+        write_photo(join(self.photos, 'd.jpg'), '2018:01:01 00:00:00')
+        checkpoint = Checkpoint(join(self.tmp, 'import.json'))
+        self.assertEqual(import_photos(self.photos, checkpoint, workers = 2), [])
+
+        posts, message = self.update_site.call_args[0]
+        self.assertEqual([ oid for oid, _ in posts ], [ 3 ])
+
+    def test_import_photos_resume(self):
+        write_photo(join(self.photos, 'a.jpg'), '2021:06:05 14:03:01')
+        write_photo(join(self.photos, 'b.jpg'), '2019:01:01 00:00:00')
+
+        process_image = server.process_image
+        def fail_on_a(post_object, f):
+            if f.name.endswith('a.jpg'):
+                raise OSError('interrupted')
+            process_image(post_object, f)
+
+        checkpoint = Checkpoint(join(self.tmp, 'import.json'))
+        with patch('server.process_image', fail_on_a):
+            failures = import_photos(self.photos, checkpoint, workers = 2)
+        self.assertEqual([ name for name, _ in failures ], [ 'a.jpg' ])
+
+        # The failed photo keeps its OID, and is imported on the next run.
+        checkpoint = Checkpoint(join(self.tmp, 'import.json'))
+        self.assertEqual(checkpoint.photos['a.jpg'], { 'oid': 1, 'post': None, 'committed': False })
+        self.assertEqual(import_photos(self.photos, checkpoint, workers = 2), [])
+
+        posts, _ = self.update_site.call_args[0]
+        self.assertEqual([ oid for oid, _ in posts ], [ 1 ])
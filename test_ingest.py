@@ -0,0 +1,83 @@
+import io
+import unittest
+
+from ingest import (
+    MultipartError,
+    MultipartReader,
+    RequestTooLarge,
+    parse_content_type,
+)
+
+def build_body(boundary, parts):
+    lines = [ b'preamble' ]
+    for headers, content in parts:
+        lines.append(b'--' + boundary)
+        lines.extend(headers)
+        lines.extend([ b'', content ])
+    lines.extend([ b'--' + boundary + b'--', b'' ])
+    return b'\r\n'.join(lines)
+
+class TestIngest(unittest.TestCase):
+
+    def test_parse_content_type(self):
+        self.assertEqual(
+            parse_content_type('multipart/form-data; boundary="abc 123"'),
+            b'abc 123',
+        )
+        with self.assertRaises(MultipartError):
+            parse_content_type('application/x-www-form-urlencoded')
+        with self.assertRaises(MultipartError):
+            parse_content_type(None)
+
+    def test_reader(self):
+        photo = bytes(range(256)) * 100
+        body = build_body(b'XyZ', [
+            ([ b'Content-Disposition: form-data; name="from"' ], b'Me <me@a.b>'),
+            ([
+                b'Content-Disposition: form-data; name="attachment1"; filename="a.jpg"',
+                b'Content-Type: image/jpeg',
+            ], photo),
+            ([ b'Content-Disposition: form-data; name="subject"' ], b'Caf\xc3\xa9\r\n--Xy'),
+        ])
+
+        # The chunk size shouldn't matter, even when delimiters are split
+        # across chunks.
+        for chunk_size in [ 1, 5, 64, 1024 * 1024 ]:
+            reader = MultipartReader(io.BytesIO(body), b'XyZ', len(body), chunk_size)
+            parts = [ (p.name, p.filename, p.headers, b''.join(p)) for p in reader ]
+            self.assertEqual(parts, [
+                ('from', None, { 'content-disposition': 'form-data; name="from"' }, b'Me <me@a.b>'),
+                ('attachment1', 'a.jpg', {
+                    'content-disposition': 'form-data; name="attachment1"; filename="a.jpg"',
+                    'content-type': 'image/jpeg',
+                }, photo),
+                ('subject', None, { 'content-disposition': 'form-data; name="subject"' }, b'Caf\xc3\xa9\r\n--Xy'),
+            ])
+
+    def test_reader_skips_unread_parts(self):
+        body = build_body(b'b', [
+            ([ b'Content-Disposition: form-data; name="a"' ], b'x' * 1000),
+            ([ b'Content-Disposition: form-data; name="b"' ], b'y'),
+        ])
+        reader = MultipartReader(io.BytesIO(body), b'b', len(body), 16)
+        parts = [ (p.name, p.read(10) if p.name == 'b' else None) for p in reader ]
+        self.assertEqual(parts, [ ('a', None), ('b', b'y') ])
+
+    def test_reader_reads_only_length(self):
+        body = build_body(b'b', [ ([ b'Content-Disposition: form-data; name="a"' ], b'x') ])
+        stream = io.BytesIO(body + b'trailing garbage')
+        list(MultipartReader(stream, b'b', len(body), 7))
+        self.assertEqual(stream.read(), b'trailing garbage')
+
+    def test_reader_truncated(self):
+        body = build_body(b'b', [ ([ b'Content-Disposition: form-data; name="a"' ], b'x' * 100) ])
+        reader = MultipartReader(io.BytesIO(body[:60]), b'b', 60)
+        with self.assertRaises(MultipartError):
+            for part in reader:
+                b''.join(part)
+
+    def test_part_read_limit(self):
+        body = build_body(b'b', [ ([ b'Content-Disposition: form-data; name="a"' ], b'x' * 100) ])
+        part = next(iter(MultipartReader(io.BytesIO(body), b'b', len(body), 8)))
+        with self.assertRaises(RequestTooLarge):
+            part.read(50)
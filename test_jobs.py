@@ -0,0 +1,100 @@
+import io
+import logging
+import tempfile
+import unittest
+from concurrent.futures import Future
+from os import listdir
+from os.path import join
+from unittest.mock import Mock
+
+from jobs import JobQueue, QueueFull
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.handler = Mock()
+        self.queue = JobQueue(self.tmp.name, self.handler, max_depth = 2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_enqueue_and_run(self):
+        seen = {}
+        def handler(job):
+            with open(join(job['path'], 'attachment1'), 'rb') as f:
+                seen['body'] = f.read()
+            seen['subject'] = job['subject']
+        self.queue.handler = handler
+
+        self.queue.enqueue({ 'subject': 'Hi' }, { 'attachment1': io.BytesIO(b'jpeg') })
+        self.assertEqual(self.queue.depth(), { 'pending': 1, 'active': 0, 'failed': 0 })
+
+        self.assertTrue(self.queue.run_once())
+        self.assertEqual(seen, { 'body': b'jpeg', 'subject': 'Hi' })
+        self.assertEqual(self.queue.depth(), { 'pending': 0, 'active': 0, 'failed': 0 })
+        self.assertFalse(self.queue.run_once())
+
+    def test_jobs_run_in_order(self):
+        for subject in [ 'a', 'b', 'c' ]:
+            self.queue.max_depth = 10
+            self.queue.enqueue({ 'subject': subject }, {})
+
+        while self.queue.run_once():
+            pass
+
+        subjects = [ c[0][0]['subject'] for c in self.handler.call_args_list ]
+        self.assertEqual(subjects, [ 'a', 'b', 'c' ])
+
+    def test_enqueue_full(self):
+        self.queue.enqueue({}, {})
+        self.queue.enqueue({}, {})
+        with self.assertRaises(QueueFull):
+            self.queue.enqueue({}, {})
+
+    def test_failed_job(self):
+        self.handler.side_effect = ValueError
+        self.queue.enqueue({}, {})
+        self.queue.run_once()
+        self.assertEqual(self.queue.depth(), { 'pending': 0, 'active': 0, 'failed': 1 })
+
+    def test_deferred_result(self):
+        futures = [ Future(), Future() ]
+        self.handler.side_effect = futures
+        self.queue.enqueue({}, {})
+        self.queue.enqueue({}, {})
+
+        self.queue.run_once()
+        self.queue.run_once()
+        self.assertEqual(self.queue.depth(), { 'pending': 0, 'active': 2, 'failed': 0 })
+
+        futures[0].set_result(None)
+        futures[1].set_exception(ValueError())
+        self.assertEqual(self.queue.depth(), { 'pending': 0, 'active': 0, 'failed': 1 })
+
+    def test_recover(self):
+        self.queue.enqueue({}, {})
+        job = self.queue.claim()
+        self.assertEqual(self.queue.depth()['active'], 1)
+
+        JobQueue(self.tmp.name, self.handler).recover()
+
+        self.assertEqual(self.queue.depth(), { 'pending': 1, 'active': 0, 'failed': 0 })
+        self.assertEqual(listdir(join(self.tmp.name, 'pending')), [ job['id'] ])
+
+    def test_start_without_recovering(self):
+        self.queue.enqueue({}, {})
+        self.queue.claim()
+
+        # Another process sharing the queue mustn't take this one's jobs.
+        other = JobQueue(self.tmp.name, self.handler)
+        other.start(recover = False)
+        other.stop()
+
+        self.assertEqual(self.queue.depth()['active'], 1)
@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        counter = Counter('uploads_total', 'Uploads.', [ 'status' ])
+        counter.inc(status = 'ok')
+        counter.inc(2, status = 'ok')
+        counter.inc(status = 'failed')
+        self.assertEqual(counter.render(), [
+            '# HELP uploads_total Uploads.',
+            '# TYPE uploads_total counter',
+            'uploads_total{status="failed"} 1',
+            'uploads_total{status="ok"} 3',
+        ])
+
+    def test_labels(self):
+        counter = Counter('uploads_total', 'Uploads.', [ 'status' ])
+        with self.assertRaises(ValueError):
+            counter.inc()
+        counter.inc(status = 'say "hi"\n')
+        self.assertEqual(counter.render()[-1], 'uploads_total{status="say \\"hi\\"\\n"} 1')
+
+    def test_gauge(self):
+        gauge = Gauge('in_flight', 'In flight.')
+        with gauge.track():
+            with gauge.track():
+                self.assertEqual(gauge.render()[-1], 'in_flight 2')
+        self.assertEqual(gauge.render()[-1], 'in_flight 0')
+        gauge.set(7)
+        self.assertEqual(gauge.render()[-1], 'in_flight 7')
+
+    def test_histogram(self):
+        histogram = Histogram('seconds', 'Seconds.', [ 'stage' ], buckets = [ 1, 0.1 ])
+        histogram.observe(0.05, stage = 'resize')
+        histogram.observe(0.1, stage = 'resize')
+        histogram.observe(5, stage = 'resize')
+        self.assertEqual(histogram.render()[2:], [
+            'seconds_bucket{stage="resize",le="0.1"} 2',
+            'seconds_bucket{stage="resize",le="1.0"} 2',
+            'seconds_bucket{stage="resize",le="+Inf"} 3',
+            'seconds_sum{stage="resize"} 5.15',
+            'seconds_count{stage="resize"} 3',
+        ])
+
+    def test_histogram_time(self):
+        histogram = Histogram('seconds', 'Seconds.')
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        self.assertEqual(histogram.render()[-1], 'seconds_count 1')
+
+    def test_threads(self):
+        counter = Counter('count', 'Count.')
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [ threading.Thread(target = work) for _ in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter.render()[-1], 'count 8000')
+
+    def test_registry(self):
+        registry = Registry()
+        gauge = registry.gauge('depth', 'Depth.')
+        registry.counter('total', 'Total.')
+        registry.on_collect(lambda: gauge.set(3))
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP depth Depth.',
+            '# TYPE depth gauge',
+            'depth 3',
+            '# HELP total Total.',
+            '# TYPE total counter',
+            '',
+        ]))
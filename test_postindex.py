@@ -0,0 +1,120 @@
+import logging
+import tempfile
+import threading
+import unittest
+from os import makedirs, remove
+from os.path import exists, join
+
+from postindex import PostIndex, read_front_matter
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+class TestPostIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.posts_path = join(self.tmp.name, '_posts')
+        makedirs(self.posts_path)
+        self.index = PostIndex(join(self.tmp.name, 'posts.db'), self.posts_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_post(self, file_name, *front_matter):
+        with open(join(self.posts_path, file_name), 'w') as f:
+            f.write('\n'.join([ '---', 'layout: post', *front_matter, '---', '' ]))
+
+    def test_allocate_first_post(self):
+        self.assertIsNone(self.index.latest())
+        self.assertEqual(self.index.allocate(), 0)
+        self.assertEqual(self.index.allocate(), 1)
+
+    def test_allocate_existing_posts(self):
+        self.write_post('2012-05-15-0.md')
+        self.write_post('2016-11-02-1.md')
+        self.write_post('2017-01-16-3.md')
+
+        self.assertEqual(self.index.latest(), 3)
+        self.assertEqual(self.index.peek(), 4)
+        self.assertEqual(self.index.allocate(), 4)
+        self.assertEqual(self.index.allocate(), 5)
+
+    def test_count_after(self):
+        self.write_post('2012-05-15-0.md')
+        self.write_post('2016-11-02-1.md')
+        self.write_post('2017-01-16-4.md')
+
+        self.assertEqual(self.index.count_after(0), 2)
+        self.assertEqual(self.index.count_after(1), 1)
+        self.assertEqual(self.index.count_after(4), 0)
+        self.assertEqual(self.index.count_after(-1), 3)
+
+    def test_allocate_concurrently(self):
+        oids = []
+        def allocate():
+            for _ in range(10):
+                oids.append(self.index.allocate())
+
+        threads = [ threading.Thread(target = allocate) for _ in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(oids), list(range(40)))
+
+    def test_record(self):
+        oid = self.index.allocate()
+        with self.index.record(oid, '2022-11-04-0.md', '2022-11-04', 'May 1, 2020', 'Hi'):
+            self.write_post('2022-11-04-0.md')
+
+        self.assertEqual(self.index.get(0), {
+            'oid': 0,
+            'filename': '2022-11-04-0.md',
+            'date': '2022-11-04',
+            'taken': 'May 1, 2020',
+            'summary': 'Hi',
+        })
+        self.assertEqual(self.index.allocate(), 1)
+
+    def test_remove(self):
+        self.write_post('2022-11-03-0.md')
+        oid = self.index.allocate()
+        with self.index.record(oid, '2022-11-04-1.md', '2022-11-04'):
+            self.write_post('2022-11-04-1.md')
+
+        self.index.remove(1, '2022-11-04-1.md')
+        self.index.remove(1, '2022-11-04-1.md')
+
+        self.assertFalse(exists(join(self.posts_path, '2022-11-04-1.md')))
+        self.assertIsNone(self.index.get(1))
+        self.assertEqual(self.index.latest(), 0)
+        # The OID isn't handed out again.
+        self.assertEqual(self.index.allocate(), 2)
+
+    def test_rebuild_on_external_change(self):
+        self.write_post('2012-05-15-0.md', "summary: 'First'", 'taken: May 1, 2012')
+        self.assertEqual(self.index.latest(), 0)
+
+        # Posts pulled from elsewhere are picked up.
+        self.write_post('2012-05-16-7.md')
+        self.assertEqual(self.index.latest(), 7)
+        self.assertEqual(self.index.get(0)['summary'], 'First')
+        self.assertEqual(self.index.get(0)['taken'], 'May 1, 2012')
+
+        # But OIDs aren't reused when posts go away.
+        remove(join(self.posts_path, '2012-05-16-7.md'))
+        self.assertEqual(self.index.latest(), 0)
+        self.assertEqual(self.index.allocate(), 8)
+
+    def test_read_front_matter(self):
+        self.write_post('2012-05-15-0.md', "summary: 'Apples: &amp; Bananas'", 'og_image: 0-1280.jpg')
+        self.assertEqual(read_front_matter(join(self.posts_path, '2012-05-15-0.md')), {
+            'layout': 'post',
+            'summary': 'Apples: &amp; Bananas',
+            'og_image': '0-1280.jpg',
+        })
@@ -0,0 +1,87 @@
+import io
+import unittest
+
+from PIL import Image
+
+from probe import UnsupportedImage, parse_exif, probe
+
+def make_exif(orientation = None, datetime = None, datetime_original = None):
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    if datetime:
+        exif[0x0132] = datetime
+    if datetime_original:
+        exif[0x8769] = { 0x9003: datetime_original }
+    return exif
+
+def encode(size, format, **options):
+    buffer = io.BytesIO()
+    Image.new('RGB', size).save(buffer, format = format, **options)
+    buffer.seek(0)
+    return buffer
+
+class TestProbe(unittest.TestCase):
+
+    def test_jpeg(self):
+        exif = make_exif(6, '2021:06:05 14:03:01', '2021:06:05 14:03:00')
+        buffer = encode((640, 480), 'JPEG', exif = exif)
+        buffer.seek(3)
+
+        self.assertEqual(probe(buffer), {
+            'format': 'JPEG',
+            'width': 640,
+            'height': 480,
+            'orientation': 6,
+            'datetime': '2021:06:05 14:03:01',
+            'datetime_original': '2021:06:05 14:03:00',
+        })
+        # The file is left where it was.
+        self.assertEqual(buffer.tell(), 3)
+
+    def test_jpeg_no_exif(self):
+        buffer = encode((64, 48), 'JPEG', progressive = True)
+        self.assertEqual(probe(buffer), { 'format': 'JPEG', 'width': 64, 'height': 48 })
+
+    def test_jpeg_reads_header_only(self):
+        buffer = encode((2000, 1000), 'JPEG', exif = make_exif(datetime = '2020:01:01 00:00:00'))
+        size = len(buffer.getvalue())
+
+        reads = []
+        read = buffer.read
+        buffer.read = lambda n = -1: reads.append(n) or read(n)
+
+        probe(buffer)
+        self.assertLess(sum(reads), size / 10)
+
+    def test_png(self):
+        buffer = encode((30, 20), 'PNG', exif = make_exif(orientation = 3))
+        self.assertEqual(probe(buffer), {
+            'format': 'PNG',
+            'width': 30,
+            'height': 20,
+            'orientation': 3,
+        })
+
+    def test_other_formats(self):
+        exif = make_exif(datetime_original = '2019:01:01 00:00:00')
+        buffer = encode((30, 20), 'WEBP', exif = exif)
+        self.assertEqual(probe(buffer), {
+            'format': 'WEBP',
+            'width': 30,
+            'height': 20,
+            'datetime_original': '2019:01:01 00:00:00',
+        })
+
+    def test_unsupported(self):
+        for data in (b'BEGIN:VCARD', b'', b'\xff\xd8\xff\xe1\x00'):
+            with self.assertRaises(UnsupportedImage):
+                probe(io.BytesIO(data))
+
+    def test_parse_exif_malformed(self):
+        data = make_exif(6, '2021:06:05 14:03:01').tobytes()[6:]
+        self.assertEqual(parse_exif(data)['orientation'], 6)
+
+        # Truncated data is read as far as it goes.
+        self.assertEqual(parse_exif(data[:20]), {})
+        self.assertEqual(parse_exif(b'nonsense'), {})
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from profiler import Profiler
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_sample_disabled(self):
+        profiler = Profiler(self.tmp.name)
+        self.assertFalse(any(profiler.sample('secret') for _ in range(10)))
+
+    def test_sample_every(self):
+        profiler = Profiler(self.tmp.name, every = 3)
+        self.assertEqual(
+            [ profiler.sample() for _ in range(6) ],
+            [ False, False, True, False, False, True ],
+        )
+
+    def test_sample_token(self):
+        profiler = Profiler(self.tmp.name, token = 'secret')
+        self.assertTrue(profiler.sample('secret'))
+        self.assertFalse(profiler.sample('wrong'))
+        self.assertFalse(profiler.sample(None))
+
+    def test_profile(self):
+        profiler = Profiler(self.tmp.name)
+        with profiler.profile('upload'):
+            data = [ bytearray(1024) for _ in range(100) ]
+
+        files = sorted(os.listdir(self.tmp.name))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith('-upload.pstats'))
+        self.assertTrue(files[1].endswith('-upload.txt'))
+        with open(os.path.join(self.tmp.name, files[1])) as f:
+            report = f.read()
+        self.assertIn('Peak traced memory', report)
+        self.assertIn('test_profiler.py', report)
+
+    def test_profile_error(self):
+        profiler = Profiler(self.tmp.name)
+        with self.assertRaises(ValueError):
+            with profiler.profile('upload'):
+                raise ValueError()
+        self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+
+    def test_profile_nested(self):
+        profiler = Profiler(self.tmp.name)
+        with profiler.profile('outer'):
+            with profiler.profile('inner'):
+                pass
+        self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+
+    def test_rotate(self):
+        profiler = Profiler(self.tmp.name, keep = 2)
+        for name in [ 'a', 'b', 'c' ]:
+            with profiler.profile(name):
+                pass
+        names = sorted(f.rsplit('-', 1)[1] for f in os.listdir(self.tmp.name))
+        self.assertEqual(names, [ 'b.pstats', 'b.txt', 'c.pstats', 'c.txt' ])
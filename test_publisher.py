@@ -0,0 +1,148 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock, call
+
+from publisher import CommitBatcher, RepoLock, SiteSync
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+class TestCommitBatcher(unittest.TestCase):
+
+    def test_batches_burst(self):
+        publish = Mock(return_value = {})
+        batcher = CommitBatcher(publish, window = 0.2)
+
+        futures = [ batcher.submit(i) for i in range(5) ]
+        self.assertEqual([ f.result(timeout = 5) for f in futures ], [ 0, 1, 2, 3, 4 ])
+
+        publish.assert_called_once_with([ 0, 1, 2, 3, 4 ])
+        batcher.stop()
+
+    def test_max_batch(self):
+        publish = Mock(return_value = {})
+        batcher = CommitBatcher(publish, window = 60, max_batch = 2)
+
+        futures = [ batcher.submit(i) for i in range(4) ]
+        for f in futures:
+            f.result(timeout = 5)
+
+        self.assertEqual(publish.call_args_list[0][0][0], [ 0, 1 ])
+        self.assertEqual(publish.call_args_list[1][0][0], [ 2, 3 ])
+        batcher.stop()
+
+    def test_separate_batches(self):
+        publish = Mock(return_value = {})
+        batcher = CommitBatcher(publish, window = 0.05)
+
+        batcher.submit('a').result(timeout = 5)
+        time.sleep(0.1)
+        batcher.submit('b').result(timeout = 5)
+
+        self.assertEqual(publish.call_count, 2)
+        batcher.stop()
+
+    def test_per_item_errors(self):
+        error = ValueError('git add failed')
+        batcher = CommitBatcher(Mock(return_value = { 'b': error }), window = 0.05)
+
+        a, b = batcher.submit('a'), batcher.submit('b')
+        self.assertEqual(a.result(timeout = 5), 'a')
+        self.assertIs(b.exception(timeout = 5), error)
+        batcher.stop()
+
+    def test_publish_error(self):
+        error = OSError('push rejected')
+        batcher = CommitBatcher(Mock(side_effect = error), window = 0.05)
+
+        futures = [ batcher.submit('a'), batcher.submit('b') ]
+        for f in futures:
+            self.assertIs(f.exception(timeout = 5), error)
+        batcher.stop()
+
+    def test_stop_flushes(self):
+        publish = Mock(return_value = {})
+        batcher = CommitBatcher(publish, window = 60)
+
+        future = batcher.submit('a')
+        batcher.stop()
+
+        self.assertEqual(future.result(timeout = 0), 'a')
+
+class TestSiteSync(unittest.TestCase):
+
+    def test_update_unchanged(self):
+        git = Mock(**{ 'rev_list.return_value': '0' })
+        self.assertFalse(SiteSync(git).update())
+        git.rev_list.assert_called_once_with('--count', 'HEAD..origin/master')
+        git.merge.assert_not_called()
+
+    def test_update_fast_forward(self):
+        git = Mock(**{ 'rev_list.side_effect': [ '2', '0' ] })
+        self.assertTrue(SiteSync(git).update())
+        git.merge.assert_called_once_with('--ff-only', 'origin/master')
+        git.rebase.assert_not_called()
+
+    def test_update_rebase(self):
+        git = Mock(**{ 'rev_list.side_effect': [ '2', '1' ] })
+        self.assertTrue(SiteSync(git).update())
+        git.rebase.assert_called_once_with('origin/master')
+        git.merge.assert_not_called()
+
+    def test_push_retry(self):
+        git = Mock(**{
+            'push.side_effect': [ OSError('rejected'), None ],
+            'rev_list.side_effect': [ '1', '1' ],
+        })
+        SiteSync(git).push()
+        git.fetch.assert_called_once_with('origin', 'master')
+        git.rebase.assert_called_once_with('origin/master')
+        self.assertEqual(git.push.call_args_list, [ call('origin', 'master') ] * 2)
+
+    def test_background_fetch(self):
+        git = Mock(**{ 'rev_list.return_value': '0' })
+        sync = SiteSync(git, interval = 0.01)
+        sync.start()
+        time.sleep(0.1)
+        sync.stop()
+        self.assertGreater(git.fetch.call_count, 2)
+
+
+class TestRepoLock(unittest.TestCase):
+
+    def test_reentrant(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lock = RepoLock(os.path.join(tmp, 'lock'))
+            with lock:
+                with lock:
+                    pass
+                self.assertIsNotNone(lock._file)
+            self.assertIsNone(lock._file)
+
+    def test_exclusive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Separate locks on the same file stand in for separate processes.
+            path = os.path.join(tmp, 'lock')
+            first = RepoLock(path)
+            second = RepoLock(path)
+            events = []
+
+            def take_second():
+                with second:
+                    events.append('second')
+
+            with first:
+                thread = threading.Thread(target = take_second)
+                thread.start()
+                time.sleep(0.1)
+                events.append('first')
+            thread.join()
+
+            self.assertEqual(events, [ 'first', 'second' ])
@@ -0,0 +1,48 @@
+import unittest
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from quality import (
+    SUBSAMPLING_420,
+    SUBSAMPLING_444,
+    choose_jpeg_settings,
+    choose_subsampling,
+    ssim,
+)
+
+def smooth_image(size = (320, 240)):
+    img = Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 64)
+    return Image.merge('RGB', [ img, img.transpose(Image.Transpose.FLIP_LEFT_RIGHT), img ]) \
+        .filter(ImageFilter.GaussianBlur(2))
+
+class TestQuality(unittest.TestCase):
+
+    def test_ssim(self):
+        img = smooth_image().convert('L')
+        self.assertAlmostEqual(ssim(img, img), 1.0, places = 5)
+
+        noisy = Image.blend(img, Image.effect_noise(img.size, 64), 0.5)
+        self.assertLess(ssim(img, noisy), 0.9)
+
+    def test_choose_subsampling(self):
+        self.assertEqual(choose_subsampling(smooth_image(), 0.98), SUBSAMPLING_420)
+
+        # One-pixel red and blue stripes lose their colour at half resolution.
+        stripes = Image.new('RGB', (320, 240), 'blue')
+        draw = ImageDraw.Draw(stripes)
+        for x in range(0, 320, 2):
+            draw.line([ (x, 0), (x, 239) ], fill = 'red')
+        self.assertEqual(choose_subsampling(stripes, 0.98), SUBSAMPLING_444)
+
+    def test_choose_jpeg_settings(self):
+        settings = choose_jpeg_settings(smooth_image(), 0.98, min_quality = 40, max_quality = 90)
+        self.assertGreaterEqual(settings['quality'], 40)
+        self.assertLess(settings['quality'], 90)
+        self.assertEqual(settings['subsampling'], SUBSAMPLING_420)
+
+    def test_choose_jpeg_settings_unreachable(self):
+        settings = choose_jpeg_settings(smooth_image(), 1.1, max_quality = 90)
+        self.assertEqual(settings['quality'], 90)
+
+    def test_choose_jpeg_settings_out_of_time(self):
+        self.assertIsNone(choose_jpeg_settings(smooth_image(), 0.98, time_budget = 0))
@@ -0,0 +1,134 @@
+import io
+import logging
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os.path import join
+from unittest.mock import MagicMock, patch
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from PIL import Image
+
+import server
+from postindex import PostIndex
+from regenerate import find_outdated, is_current, parse_image_tag, regenerate
+from storage import LocalStorage
+
+def setUpModule():
+    logging.disable(logging.CRITICAL)
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+class TestRegenerate(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+        self.blog = join(self.tmp, 'blog')
+        makedirs(join(self.blog, '_posts'))
+
+        self.storage = LocalStorage(join(self.tmp, 'assets'))
+        self.update_site = MagicMock(return_value = {})
+        for p in (
+            patch('server.DRY', None),
+            patch('server.blog_path', self.blog),
+            patch('server.post_index', PostIndex(join(self.tmp, 'posts.db'), join(self.blog, '_posts'))),
+            patch('server.storage', self.storage),
+            patch('server.sync', MagicMock()),
+            patch('server.update_site', self.update_site),
+            patch('server.EXTRA_FORMATS', []),
+            # Run the pipeline on threads, so that it sees these patches.
+            patch('regenerate.ProcessPoolExecutor', ThreadPoolExecutor),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def make_post(self, oid, size, summary = 'Hi'):
+        buffer = io.BytesIO()
+        Image.new('RGB', size).save(buffer, format = 'JPEG')
+        buffer.seek(0)
+
+        post_object = { 'oid': oid, 'summary': summary }
+        server.process_image(post_object, buffer)
+        return join(self.blog, server.create_post(post_object))
+
+    def test_parse_image_tag(self):
+        tag = server.create_img_tag(
+            '5-2',
+            [ 320, 640 ],
+            'Summary',
+            [ 'webp' ],
+            { '5-2-640.jpg': '5-2-640-0123456789abcdef.jpg' },
+        )
+
+        image = parse_image_tag(tag)
+        self.assertEqual(image['name'], '5-2')
+        self.assertEqual(image['widths'], [ 320, 640 ])
+        self.assertEqual(image['extensions'], { 'jpg', 'webp' })
+        self.assertTrue(image['summary'])
+        self.assertEqual(image['keys']['5-2-640.jpg'], '5-2-640-0123456789abcdef.jpg')
+        self.assertEqual(image['keys']['5-2-320.webp'], '5-2-320.webp')
+
+    def test_is_current(self):
+        landscape = { 'extensions': { 'jpg' }, 'widths': [ 320, 640, 960, 1280 ] }
+        portrait = { 'extensions': { 'jpg' }, 'widths': [ 213, 427, 640, 853 ] }
+        self.assertTrue(is_current(landscape))
+        self.assertTrue(is_current(portrait))
+
+        with patch('server.SIZES', [ 320, 640, 960, 1280, 1920 ]):
+            self.assertFalse(is_current(landscape))
+        with patch('server.SIZES', [ 320, 640, 1024, 1280 ]):
+            self.assertFalse(is_current(portrait))
+        with patch('server.EXTRA_FORMATS', [ 'webp' ]):
+            self.assertFalse(is_current(landscape))
+
+    def test_regenerate(self):
+        archived = self.make_post(1, (1600, 1200))
+        with patch('server.ARCHIVE_ORIGINALS', False):
+            unarchived = self.make_post(2, (1600, 1200))
+        self.assertEqual(find_outdated(join(self.blog, '_posts')), {})
+
+        with patch('server.SIZES', [ 320, 640, 960, 1280, 1440 ]), \
+             patch('server.EXTRA_FORMATS', [ 'webp' ]):
+            self.assertEqual(len(find_outdated(join(self.blog, '_posts'))), 2)
+            self.assertEqual(regenerate(workers = 2), [])
+
+        with open(archived) as f:
+            contents = f.read()
+        self.assertIn('og_image: 1-1440.jpg\n', contents)
+        self.assertIn('<picture><source type="image/webp"', contents)
+        self.assertIn('{{ site.assets_url }}/1-1440.jpg 1440w', contents)
+        self.assertTrue(self.storage.exists('1-1440.webp'))
+
+        # Posts without an archived original are left alone.
+        with open(unarchived) as f:
+            self.assertNotIn('1440', f.read())
+
+        self.update_site.assert_called_once()
+        posts, message = self.update_site.call_args[0]
+        self.assertEqual(posts, [ (1, join('_posts', os.path.basename(archived))) ])
+        self.assertEqual(message, 'Regenerate images for posts 1')
+
+    @patch('server.HASHED_KEYS', True)
+    def test_regenerate_skips_existing(self):
+        self.make_post(1, (1200, 1600))
+
+        with patch('server.upload_file') as upload_file, \
+             patch('server.SIZES', [ 320, 640, 960, 1280, 1440 ]):
+            self.assertEqual(regenerate(workers = 2), [])
+
+        # Only the new size is uploaded.
+        self.assertEqual(len(upload_file.call_args_list), 1)
+        self.assertRegex(upload_file.call_args[0][0], r'^1-1080-[0-9a-f]{16}\.jpg$')
@@ -1,10 +1,23 @@
 import datetime
+import io
+import hashlib
+import base64
 import logging
 import os
+import tempfile
 import unittest
-from unittest.mock import patch, mock_open, Mock, call, DEFAULT
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, mock_open, MagicMock, Mock, call, DEFAULT
 
-from PIL import Image
+import bottle
+from PIL import Image, ImageChops, ImageStat
+
+from dedup import DedupCache
+from jobs import JobQueue
+from postindex import PostIndex
+from profiler import Profiler
+from publisher import CommitBatcher
+from storage import LocalStorage
 
 old_mode = os.environ.get('MODE', None)
 os.environ['MODE'] = 'test'
@@ -13,13 +26,23 @@ from server import (
     is_authorized,
     get_new_oid,
     get_img_date,
-    delete,
-    upload_files,
+    encode_image,
+    upload_file,
     autolink_posts,
+    draft_image,
+    decode_image,
+    ImageTooLarge,
     resize_image,
+    encode_and_upload,
     create_img_tag,
     process_image,
+    process_gallery,
     create_post,
+    update_site,
+    publish,
+    upload,
+    get_metrics,
+    stop_services,
 )
 
 def setUpModule():
@@ -51,17 +74,17 @@ class TestServer(unittest.TestCase):
             self.assertEqual(is_authorized(request), expected)
 
 
-    @patch('server.listdir', Mock(return_value = [
-        '2012-05-15-0.md',
-        '2016-11-02-1.md',
-        '2017-01-16-3.md',
-    ]))
-    def test_get_new_oid(self):
+    @patch('server.post_index')
+    def test_get_new_oid(self, post_index):
+        post_index.allocate.return_value = 4
         self.assertEqual(get_new_oid(), 4)
 
-    @patch('server.listdir', Mock(return_value = []))
-    def test_get_new_oid_first_post(self):
-        self.assertEqual(get_new_oid(), 0)
+    @patch('server.DRY', '1')
+    @patch('server.post_index')
+    def test_get_new_oid_dry(self, post_index):
+        post_index.peek.return_value = 4
+        self.assertEqual(get_new_oid(), 4)
+        post_index.allocate.assert_not_called()
 
     def test_get_img_date(self):
         img = Mock()
@@ -81,35 +104,18 @@ class TestServer(unittest.TestCase):
         exif = get_img_date(img)
         self.assertIsNone(exif)
 
-    @patch('server.remove')
-    def test_delete(self, remove):
-        delete('1', '2', '3')
-        self.assertEqual(remove.call_args_list, [ call('1'), call('2'), call('3') ])
-
-    @patch('server.remove', Mock(side_effect = OSError))
-    def test_delete_error(self):
-        with self.assertRaises(OSError):
-            delete('os error')
-
-
-    @patch('server.open', mock_open(), create = True)
     @patch('botocore.client.BaseClient._make_api_call')
-    def test_upload_files(self, put_object):
-        files = [ '/tmp/a.jpg', '/tmp/b.jpg', '/tmp/c.jpg' ]
-        upload_files(*files)
-        for i, f in enumerate(files):
-            op, args = put_object.call_args_list[i][0]
-            self.assertEqual(op, 'PutObject')
-
-            # Ignore the 'Body' arg, which is a `MagicMock` object.
-            del args['Body']
-
-            self.assertEqual(args, {
-                'Bucket': 'aws.bucket',
-                'Key': os.path.basename(f),
-                'ACL': 'public-read',
-                'ContentType': 'image/jpeg',
-            })
+    def test_upload_file(self, put_object):
+        body = io.BytesIO(b'jpeg')
+        upload_file('a.jpg', body)
+
+        put_object.assert_called_once_with('PutObject', {
+            'Bucket': 'aws.bucket',
+            'Key': 'a.jpg',
+            'Body': body,
+            'ACL': 'public-read',
+            'ContentType': 'image/jpeg',
+        })
 
     def test_autolink_posts(self):
 
@@ -135,6 +141,75 @@ class TestServer(unittest.TestCase):
         self.assertEqual(resized[2].size, (960, 720))
         self.assertEqual(resized[3].size, (1280, 960))
 
+    def test_resize_image_portrait(self):
+
+        img = Image.new('RGB', size = (3000, 4000))
+        resized = resize_image(img)
+        self.assertEqual([ r.size for r in resized ], [
+            (240, 320), (480, 640), (720, 960), (960, 1280),
+        ])
+
+    def test_resize_image_quality(self):
+
+        # Cascading the resizes should look the same as resizing the original
+        # image directly to each size.
+        img = Image.effect_mandelbrot((4800, 3600), (-2, -1.5, 1, 1.5), 20)
+        img = img.convert('RGB')
+
+        for r in resize_image(img):
+            direct = img.resize(r.size, Image.Resampling.LANCZOS)
+            diff = ImageChops.difference(r, direct).convert('L')
+            self.assertLess(ImageStat.Stat(diff).mean[0], 1.0)
+
+    @patch('PIL.Image.Image.draft')
+    def test_draft_image(self, draft):
+
+        draft_image(Image.new('RGB', size = (8000, 6000)))
+        draft.assert_called_once_with(None, (3840, 2880))
+
+    @patch('PIL.Image.Image.draft')
+    def test_draft_image_small(self, draft):
+
+        draft_image(Image.new('RGB', size = (3000, 2000)))
+        draft.assert_not_called()
+
+
+    def test_decode_image(self):
+
+        img = Image.new('RGB', size = (8000, 6000))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buffer = io.BytesIO()
+        img.save(buffer, format = 'JPEG', exif = exif)
+        buffer.seek(0)
+
+        # Drafted to 4000x3000, then left alone, since halving it again would
+        # take it below three times the largest size.
+        decoded = decode_image(Image.open(buffer))
+        self.assertEqual(decoded.size, (4000, 3000))
+        self.assertEqual(decoded.getexif()[0x0112], 6)
+
+    def test_decode_image_png(self):
+
+        img = Image.new('P', size = (8000, 6000))
+        buffer = io.BytesIO()
+        img.save(buffer, format = 'PNG')
+        buffer.seek(0)
+
+        decoded = decode_image(Image.open(buffer))
+        self.assertEqual(decoded.size, (4000, 3000))
+        self.assertEqual(decoded.mode, 'RGB')
+
+    @patch('server.MAX_PIXELS', 1000 * 1000)
+    def test_decode_image_too_large(self):
+
+        img = Image.new('RGB', size = (2000, 1000))
+        buffer = io.BytesIO()
+        img.save(buffer, format = 'PNG')
+        buffer.seek(0)
+
+        with self.assertRaises(ImageTooLarge):
+            decode_image(Image.open(buffer))
 
     def test_create_image_tag(self):
 
@@ -147,30 +222,57 @@ class TestServer(unittest.TestCase):
                 ( 888, [ 200, 400, 600, 800 ], 'Summary' ),
                 '<img alt="{{ page.summary }}" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" src="{{ site.assets_url }}/888-400.jpg" srcset="{{ site.assets_url }}/888-200.jpg 200w, {{ site.assets_url }}/888-400.jpg 400w, {{ site.assets_url }}/888-600.jpg 600w, {{ site.assets_url }}/888-800.jpg 800w" />',
             ),
+            (
+                ( '999-2', [ 200, 400, 600, 800 ], '' ),
+                '<img sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" src="{{ site.assets_url }}/999-2-400.jpg" srcset="{{ site.assets_url }}/999-2-200.jpg 200w, {{ site.assets_url }}/999-2-400.jpg 400w, {{ site.assets_url }}/999-2-600.jpg 600w, {{ site.assets_url }}/999-2-800.jpg 800w" />',
+            ),
         ]
 
         for args, expected in SPECS:
             self.assertEqual(create_img_tag(*args), expected)
 
+    def test_create_image_tag_formats(self):
+
+        self.assertEqual(
+            create_img_tag(777, [ 300, 500 ], '', [ 'avif', 'webp' ]),
+            '<picture>'
+            '<source type="image/avif" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" srcset="{{ site.assets_url }}/777-300.avif 300w, {{ site.assets_url }}/777-500.avif 500w" />'
+            '<source type="image/webp" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" srcset="{{ site.assets_url }}/777-300.webp 300w, {{ site.assets_url }}/777-500.webp 500w" />'
+            '<img sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" src="{{ site.assets_url }}/777-500.jpg" srcset="{{ site.assets_url }}/777-300.jpg 300w, {{ site.assets_url }}/777-500.jpg 500w" />'
+            '</picture>',
+        )
+
+    def test_create_image_tag_keys(self):
+
+        keys = { '777-300.jpg': '777-300-aaaa.jpg', '777-500.jpg': '777-500-bbbb.jpg' }
+        self.assertEqual(
+            create_img_tag(777, [ 300, 500 ], '', keys = keys),
+            '<img sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" src="{{ site.assets_url }}/777-500-bbbb.jpg" srcset="{{ site.assets_url }}/777-300-aaaa.jpg 300w, {{ site.assets_url }}/777-500-bbbb.jpg 500w" />',
+        )
+
+    @patch('server.ARCHIVE_ORIGINALS', False)
     @patch('PIL.Image.open')
     @patch.multiple(
         'server',
         create_img_tag = DEFAULT,
-        upload_files = DEFAULT,
-        delete = DEFAULT,
+        upload_file = DEFAULT,
         resize_image = DEFAULT,
+        probe = DEFAULT,
     )
     def test_process_image(
         self,
         Image_open,
         resize_image,
-        delete,
-        upload_files,
+        upload_file,
         create_img_tag,
+        probe,
     ):
 
         # Setup
 
+        probe.return_value = { 'format': 'JPEG', 'width': 1000, 'height': 750 }
+        Image_open.return_value.size = (1000, 750)
+
         resized = [
             Mock(size = (150, 100)),
             Mock(size = (200, 300)),
@@ -188,36 +290,160 @@ class TestServer(unittest.TestCase):
 
         # Assert
 
-        Image_open.assert_called_once_with('/path/to/file.jpg')
+        probe.assert_called_once_with('/path/to/file.jpg')
+        Image_open.assert_called_once_with('/path/to/file.jpg', formats = [ 'JPEG' ])
 
-        kwargs = { 'optimize': True, 'progressive': True }
-        resized[0].save.assert_called_once_with('/tmp/111-150.jpg', **kwargs)
-        resized[1].save.assert_called_once_with('/tmp/111-200.jpg', **kwargs)
-        resized[2].save.assert_called_once_with('/tmp/111-300.jpg', **kwargs)
-        resized[3].save.assert_called_once_with('/tmp/111-500.jpg', **kwargs)
+        kwargs = { 'format': 'JPEG', 'optimize': True, 'progressive': True }
+        for r in resized:
+            self.assertEqual(r.save.call_args[1], kwargs)
+            r.close.assert_called_once_with()
 
-        upload_files.assert_called_once_with(
-            '/tmp/111-150.jpg',
-            '/tmp/111-200.jpg',
-            '/tmp/111-300.jpg',
-            '/tmp/111-500.jpg',
-        )
-
-        delete.assert_called_once_with(
-            '/tmp/111-150.jpg',
-            '/tmp/111-200.jpg',
-            '/tmp/111-300.jpg',
-            '/tmp/111-500.jpg',
-        )
+        keys = [ c[0][0] for c in upload_file.call_args_list ]
+        self.assertCountEqual(keys, [
+            '111-150.jpg',
+            '111-200.jpg',
+            '111-300.jpg',
+            '111-500.jpg',
+        ])
 
         self.assertEqual(post_object, {
             'oid': 111,
             'summary': 'Hi hello',
             'og_image': '111-500.jpg',
+            'variants': [ '111-150.jpg', '111-200.jpg', '111-300.jpg', '111-500.jpg' ],
             'content': '<img src="111.jpg" />',
         })
 
-    def test_create_post(self):
+    def test_encode_image(self):
+
+        img = Image.new('RGB', size = (320, 240))
+        with encode_image(img) as buffer:
+            self.assertEqual(Image.open(buffer).size, (320, 240))
+            self.assertFalse(buffer._rolled)
+
+    @patch('server.SPOOL_THRESHOLD', 100)
+    def test_encode_image_spill(self):
+
+        img = Image.effect_noise((320, 240), 64)
+        with encode_image(img) as buffer:
+            self.assertTrue(buffer._rolled)
+            self.assertEqual(buffer.tell(), 0)
+            self.assertEqual(Image.open(buffer).size, (320, 240))
+
+    @patch('server.JPEG_TARGET_SSIM', 0.95)
+    def test_encode_image_targeted(self):
+
+        img = Image.effect_mandelbrot((640, 480), (-2, -1.5, 1, 1.5), 64).convert('RGB')
+        with encode_image(img) as targeted:
+            targeted_size = len(targeted.read())
+        with patch('server.JPEG_TARGET_SSIM', 0.0), encode_image(img) as baseline:
+            baseline_size = len(baseline.read())
+        self.assertLessEqual(targeted_size, baseline_size)
+
+    @patch('server.upload_file')
+    def test_encode_and_upload_formats(self, upload_file):
+
+        resized = [ Image.new('RGB', size = (320, 240)), Image.new('RGB', size = (640, 480)) ]
+        keys = encode_and_upload(resized, [ '1-320', '1-640' ], [ 'jpeg', 'webp' ])
+
+        self.assertEqual(list(keys.items()), [
+            ('1-320.jpg', '1-320.jpg'),
+            ('1-320.webp', '1-320.webp'),
+            ('1-640.jpg', '1-640.jpg'),
+            ('1-640.webp', '1-640.webp'),
+        ])
+        content_types = { c[0][0]: c[0][2] for c in upload_file.call_args_list }
+        self.assertEqual(content_types, {
+            '1-320.jpg': 'image/jpeg',
+            '1-320.webp': 'image/webp',
+            '1-640.jpg': 'image/jpeg',
+            '1-640.webp': 'image/webp',
+        })
+
+    @patch('server.HASHED_KEYS', True)
+    @patch('server.upload_file')
+    def test_encode_and_upload_hashed(self, upload_file):
+
+        resized = [ Image.new('RGB', size = (320, 240)), Image.new('RGB', size = (640, 480)) ]
+        bodies = {}
+        upload_file.side_effect = lambda key, body, *args, **kwargs: bodies.update({ key: body.read() })
+        keys = encode_and_upload(resized, [ '1-320', '1-640' ])
+
+        self.assertEqual(list(keys), [ '1-320.jpg', '1-640.jpg' ])
+        for name, key in keys.items():
+            digest = hashlib.sha256(bodies[key]).hexdigest()[:16]
+            self.assertEqual(key, name.replace('.jpg', '-%s.jpg' % digest))
+        for c in upload_file.call_args_list:
+            self.assertEqual(c[1], { 'cache_control': 'public, max-age=31536000, immutable' })
+
+    @patch('server.upload_file')
+    def test_encode_and_upload_error(self, upload_file):
+
+        resized = [ Mock(), Mock(), Mock() ]
+        resized[1].save.side_effect = OSError('disk full')
+        upload_file.side_effect = [ None, ValueError('S3 down') ]
+
+        with self.assertRaises((OSError, ValueError)):
+            encode_and_upload(resized, [ 'a', 'b', 'c' ])
+
+        # The other images were still uploaded.
+        self.assertCountEqual([ c[0][0] for c in upload_file.call_args_list ], [ 'a.jpg', 'c.jpg' ])
+        for r in resized:
+            r.close.assert_called_once_with()
+
+    @patch('server.process_image')
+    def test_process_gallery_single(self, process_image):
+        post_object = { 'oid': 5, 'summary': '' }
+        process_gallery(post_object, [ 'a.jpg' ])
+        process_image.assert_called_once_with(post_object, 'a.jpg')
+
+    @patch('server.process_image')
+    def test_process_gallery(self, process_image):
+        def fake_process_image(image, img_obj, name):
+            image['og_image'] = '%s-1280.jpg' % name
+            image['variants'] = [ '%s-1280.jpg' % name ]
+            image['content'] = '<img src="%s" />' % img_obj
+            if img_obj != 'a.jpg':
+                image['taken'] = 'Taken %s' % img_obj
+        process_image.side_effect = fake_process_image
+
+        post_object = { 'oid': 5, 'summary': 'Hi' }
+        process_gallery(post_object, [ 'a.jpg', 'b.jpg', 'c.jpg' ])
+
+        self.assertEqual(post_object, {
+            'oid': 5,
+            'summary': 'Hi',
+            'taken': 'Taken b.jpg',
+            'og_image': '5-1280.jpg',
+            'variants': [ '5-1280.jpg', '5-2-1280.jpg', '5-3-1280.jpg' ],
+            'figures': [
+                ('5-1280.jpg', '<img src="a.jpg" />'),
+                ('5-2-1280.jpg', '<img src="b.jpg" />'),
+                ('5-3-1280.jpg', '<img src="c.jpg" />'),
+            ],
+        })
+
+    @patch('server.GALLERY_WORKERS', 2)
+    @patch('server.ThreadPoolExecutor', wraps = ThreadPoolExecutor)
+    @patch('server.process_image')
+    def test_process_gallery_workers(self, process_image, executor):
+        def fake_process_image(image, img_obj, name):
+            image['og_image'] = image['content'] = name
+            image['variants'] = [ name ]
+        process_image.side_effect = fake_process_image
+
+        process_gallery({ 'oid': 5, 'summary': '' }, [ 'a.jpg', 'b.jpg', 'c.jpg' ])
+        executor.assert_called_once_with(2)
+        self.assertEqual(process_image.call_count, 3)
+
+    @patch('server.process_image')
+    def test_process_gallery_error(self, process_image):
+        process_image.side_effect = [ None, OSError('bad image') ]
+        with self.assertRaises(OSError):
+            process_gallery({ 'oid': 5, 'summary': '' }, [ 'a.jpg', 'b.jpg' ])
+
+    @patch('server.post_index')
+    def test_create_post(self, post_index):
 
         today = datetime.datetime.today()
         today_str = today.isoformat().split('T')[0]
@@ -270,6 +496,36 @@ class TestServer(unittest.TestCase):
                     '',
                 ])
             ),
+            (
+                {
+                    'oid': 12,
+                    'summary': 'Trip',
+                    'og_image': '12-1280.jpg',
+                    'figures': [
+                        ('12-1280.jpg', '<img src="12-960.jpg" />'),
+                        ('12-2-1280.jpg', '<img src="12-2-960.jpg" />'),
+                    ],
+                },
+                '\n'.join([
+                    '---',
+                    'layout: post',
+                    "summary: 'Trip'",
+                    'og_image: 12-1280.jpg',
+                    '---',
+                    '',
+                    '<figure class="post" data-src="{{ site.assets_url }}/{{ page.og_image }}" data-sub-html="#caption-12">',
+                    '<img src="12-960.jpg" />',
+                    '</figure>',
+                    '<figure class="post" data-src="{{ site.assets_url }}/12-2-1280.jpg" data-sub-html="#caption-12">',
+                    '<img src="12-2-960.jpg" />',
+                    '<figcaption id="caption-12">',
+                    '<time>{{ page.taken | default: page.date | date: "%B %-d, %Y" }}</time>',
+                    '<p>Trip</p>',
+                    '</figcaption>',
+                    '</figure>',
+                    '',
+                ])
+            ),
         ]
 
         for post_object, expected in SPECS:
@@ -281,3 +537,362 @@ class TestServer(unittest.TestCase):
                 m.assert_called_once_with(post_path, 'w')
                 handle = m()
                 handle.write.assert_called_once_with(expected)
+                post_index.record.assert_called_with(
+                    oid,
+                    os.path.basename(post_path),
+                    today_str,
+                    taken = post_object.get('taken'),
+                    summary = post_object['summary'],
+                )
+
+    @patch('server.DRY', None)
+    @patch('server.sync')
+    def test_update_site(self, sync):
+        errors = update_site([ (5, '_posts/a-5.md'), (6, '_posts/a-6.md') ])
+
+        self.assertEqual(errors, {})
+        # The repository is brought up to date before anything is staged.
+        self.assertEqual(sync.mock_calls, [
+            call.lock.__enter__(),
+            call.update(),
+            call.git.add('_posts/a-5.md'),
+            call.git.add('_posts/a-6.md'),
+            call.git.commit('-m', 'Add posts 5, 6'),
+            call.push(),
+            call.lock.__exit__(None, None, None),
+        ])
+
+    @patch('server.DRY', None)
+    @patch('server.sync')
+    @patch('server.stage_failures')
+    def test_update_site_commit_error(self, stage_failures, sync):
+        sync.git.commit.side_effect = OSError('commit failed')
+
+        with self.assertRaises(OSError):
+            update_site([ (5, '_posts/a-5.md'), (6, '_posts/a-6.md') ])
+
+        # The posts are unstaged.
+        sync.git.reset.assert_called_once_with('--', '_posts/a-5.md', '_posts/a-6.md')
+        sync.push.assert_not_called()
+
+    @patch('server.DRY', None)
+    @patch('server.sync')
+    @patch('server.stage_failures')
+    def test_update_site_push_error(self, stage_failures, sync):
+        sync.push.side_effect = OSError('push failed')
+
+        with self.assertRaises(OSError):
+            update_site([ (5, '_posts/a-5.md') ])
+
+        # The commit is taken back out.
+        sync.git.reset.assert_called_once_with('HEAD~1')
+        stage_failures.inc.assert_called_once_with(stage = 'push')
+
+    @patch('server.DRY', None)
+    @patch('server.sync')
+    def test_update_site_message(self, sync):
+        update_site([ (5, '_posts/a-5.md'), (6, '_posts/a-6.md') ], 'Import posts 5 to 6')
+
+        sync.git.commit.assert_called_once_with('-m', 'Import posts 5 to 6')
+
+    @patch('server.DRY', None)
+    @patch('server.sync')
+    def test_update_site_add_error(self, sync):
+        error = OSError('no such file')
+        sync.git.add.side_effect = [ error, None ]
+
+        errors = update_site([ (5, '_posts/a-5.md'), (6, '_posts/a-6.md') ])
+
+        self.assertEqual(errors, { (5, '_posts/a-5.md'): error })
+        sync.git.commit.assert_called_once_with('-m', 'Add post 6')
+
+
+def make_jpeg(color = 'white'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffer, format = 'JPEG')
+    return buffer.getvalue()
+
+JPEG = make_jpeg()
+
+def build_upload_environ(fields, user = 'yodelist', password = 'blastocyte'):
+    boundary = 'xYzZY'
+    lines = []
+    for name, value in fields:
+        lines.append(b'--' + boundary.encode())
+        if name.startswith('attachment'):
+            lines.append(('Content-Disposition: form-data; name="%s"; filename="%s.jpg"' % (name, name)).encode())
+        else:
+            lines.append(('Content-Disposition: form-data; name="%s"' % name).encode())
+        lines.extend([ b'', value ])
+    lines.extend([ b'--' + boundary.encode() + b'--', b'' ])
+    body = b'\r\n'.join(lines)
+
+    credentials = base64.b64encode(('%s:%s' % (user, password)).encode()).decode()
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/upload',
+        'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % boundary,
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_AUTHORIZATION': 'Basic %s' % credentials,
+        'wsgi.input': io.BytesIO(body),
+    }
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.jobs = JobQueue(os.path.join(self.tmp.name, 'spool'), Mock())
+        self.dedup = DedupCache(os.path.join(self.tmp.name, 'dedup.db'))
+        patchers = [
+            patch('server.jobs', self.jobs),
+            patch('server.dedup', self.dedup),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def call_upload(self, environ):
+        bottle.request.bind(environ)
+        bottle.response.bind()
+        try:
+            upload()
+        except bottle.HTTPResponse as e:
+            return e.status_code
+        return bottle.response.status_code
+
+    def test_upload(self):
+        environ = build_upload_environ([
+            ('from', b'Me <email@add.rs>'),
+            ('subject', b'Caf\xc3\xa9'),
+            ('attachment2', make_jpeg('red')),
+            ('attachment1', JPEG),
+        ])
+        self.assertEqual(self.call_upload(environ), 202)
+
+        job = self.jobs.claim()
+        self.assertEqual(job['subject'], 'Caf\u00e9')
+        self.assertEqual(job['files'], [ 'attachment1', 'attachment2' ])
+        with open(os.path.join(job['path'], 'attachment2'), 'rb') as f:
+            self.assertEqual(f.read(), make_jpeg('red'))
+
+    def test_upload_repeat(self):
+        fields = [ ('from', b'email@add.rs'), ('attachment1', JPEG) ]
+        self.assertEqual(self.call_upload(build_upload_environ(fields)), 202)
+        self.assertEqual(self.call_upload(build_upload_environ(fields)), 200)
+        self.assertEqual(self.jobs.depth()['pending'], 1)
+
+    def test_upload_unauthorized_user(self):
+        environ = build_upload_environ([ ('from', b'email@add.rs') ], password = 'wrong')
+        self.assertEqual(self.call_upload(environ), 403)
+
+        # Nothing was read.
+        self.assertEqual(environ['wsgi.input'].tell(), 0)
+
+    def test_upload_unauthorized_sender(self):
+        environ = build_upload_environ([
+            ('from', b'someone@else.com'),
+            ('attachment1', JPEG),
+        ])
+        self.assertEqual(self.call_upload(environ), 403)
+        self.assertEqual(self.jobs.depth()['pending'], 0)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, 'spool', 'incoming')), [])
+
+    def test_upload_no_attachments(self):
+        environ = build_upload_environ([ ('from', b'email@add.rs') ])
+        self.assertEqual(self.call_upload(environ), 400)
+
+    @patch('server.MAX_REQUEST_SIZE', 100)
+    def test_upload_request_too_large(self):
+        environ = build_upload_environ([ ('from', b'email@add.rs'), ('attachment1', b'x' * 100) ])
+        self.assertEqual(self.call_upload(environ), 413)
+        self.assertEqual(environ['wsgi.input'].tell(), 0)
+
+    @patch('server.MAX_ATTACHMENT_SIZE', 10)
+    def test_upload_attachment_too_large(self):
+        environ = build_upload_environ([ ('from', b'email@add.rs'), ('attachment1', b'x' * 100) ])
+        self.assertEqual(self.call_upload(environ), 413)
+        self.assertEqual(self.jobs.depth()['pending'], 0)
+
+    def test_upload_not_an_image(self):
+        environ = build_upload_environ([
+            ('from', b'email@add.rs'),
+            ('attachment1', b'BEGIN:VCARD'),
+            ('attachment2', JPEG),
+            ('attachment3', b'%PDF-1.4'),
+        ])
+        self.assertEqual(self.call_upload(environ), 202)
+
+        # Only the photo is queued.
+        job = self.jobs.claim()
+        self.assertEqual(job['files'], [ 'attachment2' ])
+        self.assertEqual(sorted(os.listdir(job['path'])), [ 'attachment2', 'job.json' ])
+
+    def test_upload_no_images(self):
+        environ = build_upload_environ([
+            ('from', b'email@add.rs'),
+            ('attachment1', b'BEGIN:VCARD'),
+        ])
+        self.assertEqual(self.call_upload(environ), 415)
+        self.assertEqual(self.jobs.depth()['pending'], 0)
+
+    @patch('server.MAX_PIXELS', 10)
+    def test_upload_too_many_pixels(self):
+        environ = build_upload_environ([ ('from', b'email@add.rs'), ('attachment1', JPEG) ])
+        self.assertEqual(self.call_upload(environ), 413)
+        self.assertEqual(self.jobs.depth()['pending'], 0)
+
+    def test_upload_queue_full(self):
+        self.jobs.max_depth = 0
+        environ = build_upload_environ([ ('from', b'email@add.rs'), ('attachment1', b'x') ])
+        self.assertEqual(self.call_upload(environ), 503)
+
+    def test_upload_profiled(self):
+        profiler = Profiler(os.path.join(self.tmp.name, 'profiles'), token = 'secret')
+        environ = build_upload_environ([ ('from', b'email@add.rs'), ('attachment1', JPEG) ])
+        environ['HTTP_X_PROFILE'] = 'secret'
+
+        with patch('server.profiler', profiler):
+            self.assertEqual(self.call_upload(environ), 202)
+
+        self.assertTrue(self.jobs.claim()['profile'])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, 'profiles'))), 2)
+
+    def test_metrics(self):
+        environ = build_upload_environ([
+            ('from', b'email@add.rs'),
+            ('attachment1', JPEG),
+        ])
+        self.call_upload(environ)
+
+        bottle.response.bind()
+        text = get_metrics()
+        self.assertTrue(bottle.response.content_type.startswith('text/plain; version=0.0.4'))
+
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertGreaterEqual(float(samples['uploader_received_bytes_total']), len(JPEG))
+        self.assertEqual(samples['uploader_requests_in_flight'], '0')
+        self.assertEqual(samples['uploader_jobs{state="pending"}'], '1')
+        self.assertEqual(samples['uploader_stage_failures_total{stage="push"}'], '0')
+        self.assertIn('uploader_stage_seconds_count{stage="receive"}', samples)
+
+class TestPublish(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.jobs = JobQueue(os.path.join(self.tmp.name, 'spool'), publish)
+        self.dedup = DedupCache(os.path.join(self.tmp.name, 'dedup.db'))
+        self.sync = MagicMock()
+
+        blog = os.path.join(self.tmp.name, 'blog')
+        os.makedirs(os.path.join(blog, '_posts'))
+        self.post_index = PostIndex(os.path.join(self.tmp.name, 'posts.db'), os.path.join(blog, '_posts'))
+        self.storage = LocalStorage(os.path.join(self.tmp.name, 'assets'))
+        self.update_site = MagicMock(return_value = {})
+        self.committer = CommitBatcher(self.update_site, window = 0)
+
+        patchers = [
+            patch('server.DRY', None),
+            patch('server.dedup', self.dedup),
+            patch('server.sync', self.sync),
+            patch('server.blog_path', blog),
+            patch('server.post_index', self.post_index),
+            patch('server.storage', self.storage),
+            patch('server.committer', self.committer),
+            patch('server.EXTRA_FORMATS', []),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def enqueue(self, key = 'k1', data = JPEG):
+        self.dedup.claim(key)
+        self.jobs.enqueue({ 'subject': 'Hi', 'key': key }, { 'attachment1': io.BytesIO(data) })
+
+    def run_job(self):
+        self.assertTrue(self.jobs.run_once())
+        # Publish whatever is waiting to be committed, and wait for it.
+        self.committer.stop()
+
+    def test_publish(self):
+        self.enqueue()
+        self.run_job()
+
+        self.sync.update.assert_called_once_with()
+        self.update_site.assert_called_once()
+        (post,), = self.update_site.call_args[0]
+        self.assertEqual(post[0], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'blog', post[1])))
+        self.assertEqual(self.post_index.peek(), 1)
+
+        self.assertEqual(self.jobs.depth(), { 'pending': 0, 'active': 0, 'failed': 0 })
+        delivery = self.dedup.claim('k1')
+        self.assertEqual(delivery['oid'], 0)
+        self.assertTrue(delivery['variants'])
+        for name in delivery['variants']:
+            self.assertTrue(self.storage.exists(name))
+
+    def test_publish_dry(self):
+        self.enqueue()
+        with patch('server.DRY', '1'):
+            self.run_job()
+
+        # Nothing is synced, uploaded or written, and the OID isn't used up.
+        self.sync.update.assert_not_called()
+        self.assertEqual(list(self.storage.list()), [])
+        self.assertEqual(self.post_index.peek(), 0)
+        self.assertEqual(self.dedup.claim('k1')['oid'], 0)
+
+    def test_publish_processing_failure(self):
+        self.enqueue(data = b'not an image')
+        self.run_job()
+
+        self.update_site.assert_not_called()
+        self.assertEqual(self.jobs.depth()['failed'], 1)
+        self.assertIsNone(self.dedup.claim('k1'))
+        # The OID stays used up.
+        self.assertEqual(self.post_index.peek(), 1)
+
+    def test_publish_commit_failure(self):
+        self.update_site.side_effect = OSError('cannot push')
+        self.enqueue()
+        self.run_job()
+
+        self.update_site.assert_called_once()
+        self.assertEqual(self.jobs.depth()['failed'], 1)
+        self.assertIsNone(self.dedup.claim('k1'))
+
+        # The post is deleted rather than left behind untracked.
+        (post,), = self.update_site.call_args[0]
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'blog', post[1])))
+        self.assertIsNone(self.post_index.get(0))
+        self.assertIsNone(self.post_index.latest())
+
+    def test_stop_services(self):
+        jobs = MagicMock()
+        committer = MagicMock()
+        manager = MagicMock()
+        manager.attach_mock(jobs.stop, 'stop_jobs')
+        manager.attach_mock(committer.stop, 'stop_committer')
+
+        with patch('server.jobs', jobs), patch('server.committer', committer), \
+             patch('server.services_pid', os.getpid()):
+            stop_services()
+            stop_services()
+
+        # The workers finish their jobs before the waiting posts are published.
+        self.assertEqual(manager.mock_calls, [ call.stop_jobs(), call.stop_committer() ])
+        self.sync.stop.assert_called_once_with()
+
+    def test_publish_sync_failure(self):
+        self.sync.update.side_effect = OSError('cannot rebase')
+        self.enqueue()
+
+        self.assertTrue(self.jobs.run_once())
+
+        self.assertEqual(self.jobs.depth()['failed'], 1)
+        # The delivery was forgotten, so a redelivery is published.
+        self.assertIsNone(self.dedup.claim('k1'))
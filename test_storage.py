@@ -0,0 +1,86 @@
+import io
+import tempfile
+import unittest
+from os.path import exists, join
+from unittest.mock import patch
+
+from storage import LocalStorage, S3Storage
+
+class TestLocalStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.storage = LocalStorage(self.tmp.name)
+
+    def test_put(self):
+        self.storage.put('a/b.jpg', io.BytesIO(b'jpeg'), 'image/jpeg')
+
+        with open(join(self.tmp.name, 'a', 'b.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'jpeg')
+        self.assertTrue(self.storage.exists('a/b.jpg'))
+        self.assertFalse(self.storage.exists('a/c.jpg'))
+
+        with self.storage.get('a/b.jpg') as f:
+            self.assertEqual(f.read(), b'jpeg')
+        with self.assertRaises(FileNotFoundError):
+            self.storage.get('a/c.jpg')
+
+    def test_put_invalid_key(self):
+        with self.assertRaises(ValueError):
+            self.storage.put('../a.jpg', io.BytesIO(b'jpeg'))
+
+    def test_put_failure(self):
+        body = io.BytesIO(b'jpeg')
+        body.read = lambda *args: 1 / 0
+
+        with self.assertRaises(ZeroDivisionError):
+            self.storage.put('a.jpg', body)
+        self.assertEqual(list(self.storage.list()), [])
+        self.assertFalse(exists(join(self.tmp.name, 'a.jpg')))
+
+    def test_list_and_delete(self):
+        for key in ('1-640.jpg', '1-1280.jpg', '2-640.jpg'):
+            self.storage.put(key, io.BytesIO(b'jpeg'))
+
+        self.assertEqual(sorted(self.storage.list('1-')), [ '1-1280.jpg', '1-640.jpg' ])
+
+        self.storage.delete('1-640.jpg')
+        self.storage.delete('1-640.jpg')
+        self.assertEqual(sorted(self.storage.list()), [ '1-1280.jpg', '2-640.jpg' ])
+
+class TestS3Storage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = S3Storage('bucket', 'id', 'secret', multipart_threshold = 10)
+
+    @patch('botocore.client.BaseClient._make_api_call')
+    def test_put_small(self, api_call):
+        body = io.BytesIO(b'jpeg')
+        self.storage.put('a.jpg', body, 'image/jpeg', cache_control = 'max-age=60')
+
+        api_call.assert_called_once_with('PutObject', {
+            'Bucket': 'bucket',
+            'Key': 'a.jpg',
+            'Body': body,
+            'ACL': 'public-read',
+            'ContentType': 'image/jpeg',
+            'CacheControl': 'max-age=60',
+        })
+
+    def test_put_large(self):
+        body = io.BytesIO(b'x' * 11)
+        with patch.object(self.storage.client, 'upload_fileobj') as upload_fileobj:
+            self.storage.put('a.avif', body, 'image/avif')
+
+        upload_fileobj.assert_called_once_with(
+            body,
+            'bucket',
+            'a.avif',
+            ExtraArgs = { 'ACL': 'public-read', 'ContentType': 'image/avif' },
+            Config = self.storage.transfer_config,
+        )
+
+    def test_client_pool(self):
+        self.assertIs(self.storage.client, self.storage.client)
+        self.assertEqual(self.storage.client.meta.config.max_pool_connections, 20)